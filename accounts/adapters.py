@@ -0,0 +1,60 @@
+"""
+Adapters.py file for accounts app. Allauth adapters
+customized for the project.
+"""
+
+# Import required libraries for Google OAuth
+import jwt
+from allauth.socialaccount.adapter import DefaultSocialAccountAdapter
+from allauth.socialaccount.providers.google.views import ACCESS_TOKEN_URL, AUTHORIZE_URL
+from allauth.socialaccount.providers.google.views import GoogleOAuth2Adapter as BaseGoogleOAuth2Adapter
+from allauth.socialaccount.providers.oauth2.client import OAuth2Error
+
+from . import google_keys
+
+
+# Google adapter that verifies the id_token signature with cached Google signing keys.
+# The keys are cached per process and in the shared cache, so logins do not wait on a
+# certificate fetch, and id_tokens posted directly by a client are verified too.
+# The token and authorization endpoints are read from the cached discovery document, so
+# pointing GOOGLE_DISCOVERY_URL at a stand-in server redirects the whole flow.
+class GoogleOAuth2Adapter(BaseGoogleOAuth2Adapter):
+
+    @property
+    def access_token_url(self):
+        return self._discovered('token_endpoint', ACCESS_TOKEN_URL)
+
+    @property
+    def authorize_url(self):
+        return self._discovered('authorization_endpoint', AUTHORIZE_URL)
+
+    def _discovered(self, name, default):
+        try:
+            return google_keys.discovery.get().get(name, default)
+        except google_keys.KeyFetchError:
+            return default
+
+    def complete_login(self, request, app, token, response, **kwargs):
+        try:
+            identity_data = google_keys.verify_id_token(response["id_token"], audience=app.client_id)
+        except jwt.PyJWTError as e:
+            raise OAuth2Error("Invalid id_token") from e
+        except google_keys.KeyFetchError as e:
+            raise OAuth2Error("Unable to fetch Google signing keys") from e
+        login = self.get_provider().sociallogin_from_response(request, identity_data)
+        return login
+
+
+# Social account adapter that keeps the user's Google profile fields in sync. Runs after
+# allauth has looked up the social account and refreshed its extra_data, for every Google
+# login (dj-rest-auth/google/, the async login view, and the login page). A returning
+# user is only saved when the profile changed, and a new user is saved on signup.
+class SocialAccountAdapter(DefaultSocialAccountAdapter):
+
+    def pre_social_login(self, request, sociallogin):
+        super().pre_social_login(request, sociallogin)
+        if sociallogin.account.provider != 'google':
+            return
+        changed = sociallogin.user.update_google_profile(sociallogin.account.extra_data)
+        if changed and sociallogin.is_existing:
+            sociallogin.user.save(update_fields=changed)
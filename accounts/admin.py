@@ -8,13 +8,20 @@ Date: 2024-06-01
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
+from djgoprod.changelist import LargeTableAdmin
+
 # Import the CustomUser model
 from .models import CustomUser
 
-# Custom Display of Email and Username in Admin
-class CustomUserAdmin(UserAdmin):
+# Custom Display of Email and Username in Admin. The changelist shows an estimated count and
+# pages with a username cursor (LargeTableAdmin), and the searched columns have trigram indexes
+# on PostgreSQL (migration 0005), so it stays fast with millions of users.
+class CustomUserAdmin(LargeTableAdmin, UserAdmin):
     model = CustomUser
     list_display = ["email", "username",]
+    fieldsets = UserAdmin.fieldsets + (
+        ('Google profile', {'fields': ('display_name', 'picture_url', 'locale')}),
+    )
 
 # Register Custom User Model to Admin
 admin.site.register(CustomUser, CustomUserAdmin)
\ No newline at end of file
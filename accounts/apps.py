@@ -6,7 +6,29 @@ Date: 2024-06-01
 """
 
 from django.apps import AppConfig
+from django.conf import settings
 
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self):
+        # Invalidate cached user snapshots when a user changes
+        from django.contrib.auth import get_user_model
+        from django.db.models.signals import post_delete, post_save
+        from .middleware import invalidate_cached_user
+        post_save.connect(invalidate_cached_user, sender=get_user_model(), dispatch_uid='accounts_invalidate_cached_user_save')
+        post_delete.connect(invalidate_cached_user, sender=get_user_model(), dispatch_uid='accounts_invalidate_cached_user_delete')
+
+        # Push login and logout events to WebSocket clients
+        from django.contrib.auth.signals import user_logged_in, user_logged_out
+        from .events import publish_login, publish_logout
+        user_logged_in.connect(publish_login, dispatch_uid='accounts_publish_login')
+        user_logged_out.connect(publish_logout, dispatch_uid='accounts_publish_logout')
+
+        # Time outbound OAuth calls and count login queries for the metrics endpoint
+        if settings.METRICS_ENABLED:
+            from djgoprod.metrics import record_login_queries, record_oauth_call
+            from .signals import oauth_http_call, social_login_persisted
+            oauth_http_call.connect(record_oauth_call, dispatch_uid='accounts_record_oauth_call')
+            social_login_persisted.connect(record_login_queries, dispatch_uid='accounts_record_login_queries')
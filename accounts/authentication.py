@@ -0,0 +1,30 @@
+"""
+Authentication.py file for accounts app. DRF authentication class for the
+access tokens issued in the stateless authentication mode (STATELESS_AUTH).
+"""
+
+# Import required libraries for token authentication
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+from .tokens import TokenError, TokenUser, get_bearer_token, verify_access_token
+
+
+#------- [Classes] -------#
+
+# Authenticates "Authorization: Bearer <access token>" without a database or cache
+# hit. request.user is a TokenUser built from the token's claims.
+class SignedTokenAuthentication(BaseAuthentication):
+
+    def authenticate(self, request):
+        token = get_bearer_token(request)
+        if token is None:
+            return None # Let session authentication handle the request
+        try:
+            claims = verify_access_token(token)
+        except TokenError as e:
+            raise AuthenticationFailed(str(e))
+        return TokenUser(claims), claims
+
+    def authenticate_header(self, request):
+        return 'Bearer'
@@ -0,0 +1,221 @@
+"""
+Concurrency.py file for accounts app. Admission control and single-flight
+coalescing for the Google login endpoints.
+
+Each worker runs a bounded number of logins at once (LOGIN_CONCURRENCY_LIMIT)
+and sheds the rest with a 503 and Retry-After, so a slow Google cannot tie up
+every worker thread. A request from the same client (CSRF or session cookie)
+carrying an authorization code that is still being exchanged waits for that
+login instead of calling Google again. The code can only be exchanged once, so
+a retry or double submit would otherwise fail, or race the first request to
+create the user. Once the login has finished, the code is used up: a request
+repeating it is exchanged with Google as usual, which rejects it.
+"""
+
+# Import required libraries for admission control and coalescing
+import asyncio
+import concurrent.futures
+import hashlib
+import random
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+
+
+#------- [Variables] -------#
+
+# Cache value of a login that is still in progress.
+PENDING = 'pending'
+
+# Seconds a finished login's result is kept for requests in other workers that were
+# waiting for it. The last of them to read it deletes it, so this only matters if a
+# waiting request went away.
+RESULT_SECONDS = 5
+
+# Seconds between checks of the shared cache while waiting for a login in another
+# worker, doubling up to the maximum.
+POLL_SECONDS = 0.05
+MAX_POLL_SECONDS = 0.5
+
+# Longest a sync request waits for another request's login. It holds a worker thread and
+# a login_limiter slot while it waits, so this is far below the login's own time limit.
+SYNC_WAIT_SECONDS = 5
+
+_flights = {} # Cache key -> Future with the result of a login running in this worker
+_flights_lock = threading.Lock()
+
+
+#------- [Classes] -------#
+
+class LoginLimiter:
+    """Logins in progress in this worker, up to LOGIN_CONCURRENCY_LIMIT."""
+
+    def __init__(self):
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        limit = settings.LOGIN_CONCURRENCY_LIMIT
+        with self._lock:
+            if limit and self._active >= limit:
+                return False
+            self._active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._active -= 1
+
+
+class LoginFlight:
+    """
+    One login per authorization code and client. The first request to start()
+    runs the login and calls finish() with its result. Requests with the same
+    code and the same CSRF (or session) cookie that start() while it is still
+    running wait() for that result: on a future in the same worker, or by
+    polling the shared cache (REDIS_URL) in other workers. The result is only
+    handed to the requests that were waiting, and deleted once they have read
+    it. Requests without either cookie are not coalesced.
+    """
+
+    def __init__(self, request, code):
+        binding = request.COOKIES.get(settings.CSRF_COOKIE_NAME) or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        self.key = None
+        if binding:
+            self.key = f'accounts:login:code:{hashlib.sha256(f"{code}:{binding}".encode()).hexdigest()[:32]}'
+            self.waiters_key = f'{self.key}:waiters'
+        self.owner = False
+        self.future = None # The login of this worker that this request waits for
+
+    # Returns True if this request should run the login, False if it should wait for the
+    # login of an earlier request.
+    def start(self):
+        if self.key is None:
+            return True
+        with _flights_lock:
+            self.future = _flights.get(self.key)
+        if self.future is not None:
+            return False
+        if cache.add(self.key, PENDING, timeout=int(flight_seconds()) + RESULT_SECONDS):
+            with _flights_lock:
+                _flights[self.key] = concurrent.futures.Future()
+            self.owner = True
+            return True
+        # Running in another worker. Register before checking it is still pending, so
+        # the result is not deleted before this request reads it.
+        cache.add(self.waiters_key, 0, timeout=int(flight_seconds()) + RESULT_SECONDS)
+        try:
+            cache.incr(self.waiters_key)
+        except ValueError: # Expired meanwhile, so the login is over
+            return True
+        if cache.get(self.key) == PENDING:
+            return False
+        self._leave() # Finished already, so the code is used up
+        return True
+
+    # Hand the result to the waiting requests: the logged in user's id, or the error message.
+    def finish(self, user_id=None, error=None):
+        if not self.owner:
+            return
+        result = ('error', error) if error is not None else ('ok', user_id)
+        cache.set(self.key, result, timeout=RESULT_SECONDS)
+        if not cache.get(self.waiters_key):
+            cache.delete(self.key) # No other worker is waiting
+        self._resolve(result)
+
+    # Give up on the login after an unexpected error, so waiting requests stop waiting.
+    def abandon(self):
+        if not self.owner:
+            return
+        cache.delete(self.key)
+        self._resolve(None)
+
+    # Wait for the login to finish. Returns ('ok', user_id), ('error', message), or None if
+    # the login was abandoned or did not finish in time.
+    def wait(self, timeout=SYNC_WAIT_SECONDS):
+        if self.future is not None:
+            try:
+                return self.future.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                return None
+        deadline = time.monotonic() + timeout
+        delay = POLL_SECONDS
+        try:
+            while True:
+                result = cache.get(self.key)
+                if result != PENDING or time.monotonic() > deadline:
+                    return result if result != PENDING else None
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_POLL_SECONDS)
+        finally:
+            self._leave()
+
+    async def astart(self):
+        return await sync_to_async(self.start)()
+
+    async def afinish(self, user_id=None, error=None):
+        await sync_to_async(self.finish)(user_id=user_id, error=error)
+
+    async def aabandon(self):
+        await sync_to_async(self.abandon)()
+
+    # Like wait(), without blocking the event loop. Only the login's own time limit bounds
+    # the wait, since a waiting coroutine holds no thread.
+    async def await_result(self):
+        timeout = flight_seconds()
+        if self.future is not None:
+            try:
+                # Shielded, so a timeout does not cancel the future other requests wait on
+                return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(self.future)), timeout)
+            except asyncio.TimeoutError:
+                return None
+        deadline = time.monotonic() + timeout
+        delay = POLL_SECONDS
+        try:
+            while True:
+                result = await cache.aget(self.key)
+                if result != PENDING or time.monotonic() > deadline:
+                    return result if result != PENDING else None
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_POLL_SECONDS)
+        finally:
+            await sync_to_async(self._leave)()
+
+    # Stop waiting on the shared cache. The last waiting request deletes the finished result.
+    def _leave(self):
+        try:
+            remaining = cache.decr(self.waiters_key)
+        except ValueError: # Expired
+            remaining = 0
+        if remaining <= 0 and cache.get(self.key) not in (None, PENDING):
+            cache.delete(self.key)
+
+    def _resolve(self, result):
+        with _flights_lock:
+            future = _flights.pop(self.key, None)
+        if future is not None:
+            future.set_result(result)
+
+
+#------- [Functions] -------#
+
+# Longest a login can take: every attempt of the code exchange timing out.
+def flight_seconds():
+    return (settings.OAUTH_HTTP_CONNECT_TIMEOUT + settings.OAUTH_HTTP_READ_TIMEOUT) * (settings.OAUTH_HTTP_RETRIES + 1)
+
+# Response for a login shed by the limiter. The jitter spreads out the clients' retries.
+def overloaded_response():
+    retry_after = settings.LOGIN_RETRY_AFTER
+    response = JsonResponse({'non_field_errors': ['Too many logins in progress. Please retry shortly.']}, status=503)
+    response['Retry-After'] = str(random.randint(retry_after, retry_after * 2))
+    return response
+
+
+#------- [Instances] -------#
+
+# Logins in progress in this worker.
+login_limiter = LoginLimiter()
@@ -0,0 +1,122 @@
+"""
+Consumers.py file for accounts app. WebSocket consumer that pushes auth
+state changes to the client, so frontends do not need to poll check-auth.
+
+Protocol (JSON messages on /ws/auth/):
+    - Server: {"type": "auth.state", "authenticated": true | false}
+        Sent on connect and whenever the connection's auth state changes.
+    - Server: {"type": "auth.event", "event": "login" | "logout" | "session_expired" | "token_expired"}
+        After a login event on an anonymous connection, reconnect so the new
+        session cookie is sent.
+    - Client: {"type": "auth", "access": "<access token>"}
+        Stateless mode only. Authenticates the connection with an access token.
+"""
+
+# Import required libraries for the consumer
+import asyncio
+import random
+import time
+from importlib import import_module
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from django.contrib import auth
+from django.http import HttpRequest
+
+from .events import browser_group, family_group, session_group, user_group
+from .tokens import TokenError, verify_access_token
+
+
+#------- [Variables] -------#
+
+# Session connections check that their session is still valid this often, with
+# jitter so connections opened together do not check together.
+SESSION_RECHECK_SECONDS = 120
+
+
+#------- [Functions] -------#
+
+# Load the user of a session from the session store, as a request would.
+def get_session_user(session_key):
+    request = HttpRequest()
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    return auth.get_user(request)
+
+
+#------- [Classes] -------#
+
+class AuthStateConsumer(AsyncJsonWebsocketConsumer):
+
+    async def connect(self):
+        self.joined = set()
+        self.check_task = None
+        await self.accept()
+        user = self.scope.get('user')
+        session = self.scope.get('session')
+        if user is not None and user.is_authenticated and session is not None and session.session_key:
+            await self.set_groups(user_group(user.pk), session_group(session.session_key))
+            self.watch(self.recheck_session(session.session_key))
+            await self.send_state(True)
+        else:
+            await self.set_anonymous()
+
+    async def disconnect(self, code):
+        self.watch(None)
+        await self.set_groups()
+
+    async def receive_json(self, content, **kwargs):
+        if content.get('type') == 'auth' and settings.STATELESS_AUTH:
+            try:
+                claims = verify_access_token(content.get('access', ''))
+            except TokenError:
+                await self.set_anonymous()
+                return
+            await self.set_groups(user_group(claims['sub']), family_group(claims['sid']))
+            self.watch(self.expire_token(claims['exp']))
+            await self.send_state(True)
+
+    # Handler for the events sent by events.publish.
+    async def auth_event(self, message):
+        event = message['event']
+        await self.send_json({'type': 'auth.event', 'event': event})
+        if event == 'logout':
+            await self.set_anonymous()
+
+    async def set_anonymous(self):
+        self.watch(None)
+        csrf_cookie = self.scope.get('cookies', {}).get(settings.CSRF_COOKIE_NAME)
+        await self.set_groups(*([browser_group(csrf_cookie)] if csrf_cookie else []))
+        await self.send_state(False)
+
+    async def send_state(self, authenticated):
+        await self.send_json({'type': 'auth.state', 'authenticated': authenticated})
+
+    # Leave the groups that are no longer wanted and join the new ones.
+    async def set_groups(self, *groups):
+        wanted = set(groups)
+        for group in self.joined - wanted:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for group in wanted - self.joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.joined = wanted
+
+    # Run a background check for the connection's current auth, replacing the previous one.
+    def watch(self, coroutine):
+        if self.check_task is not None and self.check_task is not asyncio.current_task():
+            self.check_task.cancel()
+        self.check_task = asyncio.ensure_future(coroutine) if coroutine is not None else None
+
+    async def recheck_session(self, session_key):
+        while True:
+            await asyncio.sleep(SESSION_RECHECK_SECONDS * random.uniform(0.75, 1.25))
+            user = await database_sync_to_async(get_session_user)(session_key)
+            if not user.is_authenticated:
+                await self.send_json({'type': 'auth.event', 'event': 'session_expired'})
+                await self.set_anonymous()
+                return
+
+    async def expire_token(self, expires_at):
+        await asyncio.sleep(max(expires_at - time.time(), 0))
+        await self.send_json({'type': 'auth.event', 'event': 'token_expired'})
+        await self.set_anonymous()
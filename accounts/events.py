@@ -0,0 +1,58 @@
+"""
+Events.py file for accounts app. Publishes auth state events (login and
+logout) to the WebSocket clients connected to /ws/auth/, through the
+channel layer. See consumers.py for the client side of the protocol.
+"""
+
+# Import required libraries for publishing to the channel layer
+import hashlib
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+#------- [Functions] -------#
+
+# Groups a connection joins. Names may only use letters, digits, hyphens, and periods.
+def user_group(user_id):
+    return f'auth.user.{user_id}'
+
+def session_group(session_key):
+    return f'auth.session.{session_key}'
+
+def family_group(family):
+    return f'auth.family.{family}'
+
+# Anonymous connections are grouped by browser, using the CSRF cookie that every
+# tab of the browser shares until the login rotates it.
+def browser_group(csrf_cookie):
+    return f'auth.browser.{hashlib.sha256(csrf_cookie.encode()).hexdigest()[:32]}'
+
+# Send an event to a group. Never fails the login or logout that triggered it.
+def publish(group, event):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(group, {'type': 'auth.event', 'event': event})
+    except Exception:
+        logger.warning('Publishing %s to %s failed.', event, group, exc_info=True)
+
+# Connected to user_logged_in, which the Google login endpoints send through allauth.
+# Tells the user's other connections, and the logging in browser's anonymous tabs.
+def publish_login(sender, request, user, **kwargs):
+    publish(user_group(user.pk), 'login')
+    csrf_cookie = request.COOKIES.get(settings.CSRF_COOKIE_NAME)
+    if csrf_cookie:
+        publish(browser_group(csrf_cookie), 'login')
+
+# Connected to user_logged_out, which custom_logout sends before flushing the session.
+# Only the connections of the logged out session are told, not the user's other devices.
+def publish_logout(sender, request, user, **kwargs):
+    session_key = getattr(request, 'session', None) and request.session.session_key
+    if user is not None and session_key:
+        publish(session_group(session_key), 'logout')
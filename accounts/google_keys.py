@@ -0,0 +1,240 @@
+"""
+Google_keys.py file for accounts app. Process-wide and shared-cache
+store for Google's OpenID discovery document and signing keys (JWKS),
+used to verify id_tokens without a network round trip on the login path.
+
+Documents are cached for the Cache-Control max-age sent by Google,
+refreshed in the background before they expire, and served stale for
+a bounded time if Google cannot be reached. A token signed with an unknown
+key refetches the keys at most once per UNKNOWN_KID_REFRESH_SECONDS.
+"""
+
+# Import required libraries for fetching, caching, and verifying
+import logging
+import re
+import threading
+import time
+
+import jwt
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from djgoprod.metrics import record_cache
+
+from .oauth_client import http_request
+
+logger = logging.getLogger(__name__)
+
+
+#------- [Variables] -------#
+
+# Used when the response has no Cache-Control max-age.
+DEFAULT_MAX_AGE = 3600
+
+# Refresh in the background once this fraction of the max-age has passed.
+REFRESH_AHEAD_FRACTION = 0.8
+
+# How long an expired document may still be served while fetches fail.
+MAX_STALE_SECONDS = 24 * 3600
+
+# Wait at least this long between failed fetch attempts.
+RETRY_AFTER_FAILURE_SECONDS = 30
+
+# Refetch the keys for an unknown key id at most this often, so forged tokens cannot
+# make each login call Google. Tokens with a newly rotated key are rejected until then.
+UNKNOWN_KID_REFRESH_SECONDS = 30
+
+# Issuer accepted in addition to the discovery issuer (Google uses both forms).
+GOOGLE_ISSUERS = ('https://accounts.google.com', 'accounts.google.com')
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+
+#------- [Classes] -------#
+
+class KeyFetchError(Exception):
+    pass
+
+
+class CachedJSONDocument:
+    """
+    A JSON document fetched over HTTP and cached in this process and in
+    the shared Django cache, so each worker fetches it at most once per
+    max-age and workers pick up each other's refreshes.
+    """
+
+    def __init__(self, name, get_url):
+        self.name = name
+        self.get_url = get_url # Callable so the URL is read from settings lazily
+        self.cache_key = f'google_keys:{name}'
+        self._entry = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._failed_at = 0
+
+    def get(self):
+        """Return the document, fetching it only if nothing fresh is cached."""
+        now = time.time()
+        entry = self._entry
+        if entry is None or now >= entry['expires_at']:
+            entry = self._load_shared() or entry
+        if entry is not None and now < entry['expires_at']:
+            if now >= entry['refresh_at']:
+                self._refresh_in_background()
+            record_cache(f'google_{self.name}', hit=True)
+            return entry['value']
+
+        # Missing or expired: fetch now, one thread at a time.
+        record_cache(f'google_{self.name}', hit=False)
+        with self._lock:
+            if self._entry is not None and time.time() < self._entry['expires_at']:
+                return self._entry['value'] # Another thread refreshed it
+            try:
+                return self._refresh()['value']
+            except KeyFetchError:
+                if entry is not None and now < entry['stale_until']:
+                    logger.warning('Serving stale %s after failed refresh.', self.name)
+                    return entry['value']
+                raise
+
+    def is_fresh(self):
+        """Return True if get() can answer from this process without fetching."""
+        return self._entry is not None and time.time() < self._entry['refresh_at']
+
+    def refresh(self, min_age=0):
+        """Fetch the document now, ignoring the cache, unless this process fetched it less than min_age seconds ago."""
+        with self._lock:
+            if self._entry is not None and time.time() - self._entry.get('fetched_at', 0) < min_age:
+                return self._entry['value']
+            return self._refresh()['value']
+
+    def clear(self):
+        """Forget the document in this process and the shared cache, for example after changing its URL."""
+        with self._lock:
+            self._entry = None
+            self._failed_at = 0
+            cache.delete(self.cache_key)
+
+    def _refresh(self):
+        if time.time() - self._failed_at < RETRY_AFTER_FAILURE_SECONDS:
+            raise KeyFetchError(f'Recent fetch of {self.name} failed, not retrying yet.')
+        try:
+            value, max_age = self._fetch()
+        except (requests.RequestException, ValueError) as e:
+            self._failed_at = time.time()
+            raise KeyFetchError(f'Unable to fetch {self.name}.') from e
+        self._failed_at = 0
+        return self._store(value, max_age)
+
+    def _fetch(self):
+        response, _ = http_request('GET', self.get_url())
+        response.raise_for_status()
+        return response.json(), parse_max_age(response.headers)
+
+    def _store(self, value, max_age):
+        now = time.time()
+        entry = {
+            'value': value,
+            'fetched_at': now,
+            'refresh_at': now + max_age * REFRESH_AHEAD_FRACTION,
+            'expires_at': now + max_age,
+            'stale_until': now + max_age + MAX_STALE_SECONDS,
+        }
+        self._entry = entry
+        cache.set(self.cache_key, entry, timeout=max_age + MAX_STALE_SECONDS)
+        return entry
+
+    def _load_shared(self):
+        entry = cache.get(self.cache_key)
+        if entry is not None and (self._entry is None or entry['expires_at'] > self._entry['expires_at']):
+            self._entry = entry
+        return self._entry
+
+    def _refresh_in_background(self):
+        # One refresh per process, and one per cluster through the shared cache lock.
+        if self._refreshing or not cache.add(f'{self.cache_key}:refreshing', 1, timeout=RETRY_AFTER_FAILURE_SECONDS):
+            return
+        self._refreshing = True
+        threading.Thread(target=self._background_refresh, name=f'refresh-{self.name}', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except KeyFetchError:
+            logger.warning('Background refresh of %s failed.', self.name, exc_info=True)
+        finally:
+            self._refreshing = False
+
+
+class CachedJWKS(CachedJSONDocument):
+    """A cached JWKS document with its parsed signing keys memoized by key id."""
+
+    def __init__(self, name, get_url):
+        super().__init__(name, get_url)
+        self._keys_source = None
+        self._keys = {}
+
+    def get_signing_key(self, kid):
+        key = self._parsed_keys().get(kid)
+        if key is None:
+            # Unknown key id: Google may have rotated keys before our max-age ran out.
+            try:
+                self.refresh(min_age=UNKNOWN_KID_REFRESH_SECONDS)
+            except KeyFetchError:
+                pass
+            key = self._parsed_keys().get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError(f'Unknown signing key id "{kid}".')
+        return key
+
+    def _parsed_keys(self):
+        value = self.get()
+        if value is not self._keys_source:
+            self._keys = {key.key_id: key for key in jwt.PyJWKSet.from_dict(value).keys}
+            self._keys_source = value
+        return self._keys
+
+
+#------- [Functions] -------#
+
+# Read max-age from the Cache-Control header, minus the Age of the cached response.
+def parse_max_age(headers):
+    match = MAX_AGE_RE.search(headers.get('Cache-Control', ''))
+    if match is None:
+        return DEFAULT_MAX_AGE
+    age = headers.get('Age', '0')
+    return max(int(match.group(1)) - (int(age) if age.isdigit() else 0), 0)
+
+# The JWKS URL comes from settings, or from the discovery document by default.
+def get_jwks_url():
+    return settings.GOOGLE_JWKS_URL or discovery.get()['jwks_uri']
+
+# Verify an id_token's signature, audience, issuer, and expiry and return its claims.
+def verify_id_token(id_token, audience):
+    header = jwt.get_unverified_header(id_token)
+    signing_key = jwks.get_signing_key(header.get('kid'))
+    claims = jwt.decode(
+        id_token,
+        key=signing_key.key,
+        algorithms=['RS256'],
+        audience=audience,
+        options={'require': ['exp', 'iat', 'iss', 'aud'], 'verify_iss': False},
+    )
+    if claims['iss'] != discovery.get()['issuer'] and claims['iss'] not in GOOGLE_ISSUERS:
+        raise jwt.InvalidIssuerError('Invalid issuer')
+    return claims
+
+
+# True if the id_token can be verified from this process without network or cache access.
+def can_verify_locally(id_token):
+    if not (discovery.is_fresh() and jwks.is_fresh()):
+        return False
+    return jwt.get_unverified_header(id_token).get('kid') in jwks._parsed_keys()
+
+
+#------- [Instances] -------#
+
+# Process-wide documents shared by every login in this worker.
+discovery = CachedJSONDocument('discovery', lambda: settings.GOOGLE_DISCOVERY_URL)
+jwks = CachedJWKS('jwks', get_jwks_url)
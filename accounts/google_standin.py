@@ -0,0 +1,191 @@
+"""
+Google_standin.py file for accounts app. A local stand-in for Google's
+OAuth2 and OpenID endpoints (discovery, authorization, token, userinfo,
+and signing keys), so logins, id_token verification, and key caching
+can be exercised and benchmarked without calling Google.
+
+Point GOOGLE_DISCOVERY_URL at the stand-in's discovery_url to use it.
+"""
+
+# Import required libraries for the local HTTP server and token signing
+import json
+import secrets
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+#------- [Classes] -------#
+
+class GoogleStandIn:
+    """
+    Serves Google's OAuth2 and OpenID endpoints on 127.0.0.1 from a background
+    thread and signs id_tokens with its own RSA key. Set fail_keys to make the
+    key endpoints return 503, for example to check stale serving, and
+    token_delay to simulate a slow token endpoint.
+    """
+
+    def __init__(self, port=0, max_age=3600, client_id='stand-in-client'):
+        self.max_age = max_age
+        self.client_id = client_id # Audience of issued id_tokens
+        self.fail_keys = False
+        self.token_delay = 0
+        self.hits = {} # Requests served per path
+        self.codes = {} # Authorization code -> identity, single use
+        self.access_tokens = {} # Access token -> identity
+        self.kid = uuid.uuid4().hex
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self.server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.discovery_url = f'{self.base_url}/.well-known/openid-configuration'
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='google-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def rotate_key(self):
+        self.kid = uuid.uuid4().hex
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    # Claims Google returns for a user, used in id_tokens and userinfo.
+    def identity(self, subject='1234567890', email='user@example.com', **claims):
+        return {
+            'sub': subject,
+            'email': email,
+            'email_verified': True,
+            'name': claims.pop('name', 'Stand-in User'),
+            'given_name': claims.pop('given_name', 'Stand-in'),
+            'family_name': claims.pop('family_name', 'User'),
+            'picture': claims.pop('picture', f'{self.base_url}/picture/{subject}.png'),
+            'locale': claims.pop('locale', 'en'),
+            **claims,
+        }
+
+    def issue_id_token(self, audience=None, lifetime=3600, **identity):
+        now = int(time.time())
+        payload = {
+            'iss': self.base_url,
+            'aud': audience or self.client_id,
+            'iat': now,
+            'exp': now + lifetime,
+            **self.identity(**identity),
+        }
+        return jwt.encode(payload, self.private_key, algorithm='RS256', headers={'kid': self.kid})
+
+    # Create a single-use authorization code for an identity, as if the user approved consent.
+    def issue_code(self, **identity):
+        code = secrets.token_urlsafe(24)
+        with self._lock:
+            self.codes[code] = self.identity(**identity)
+        return code
+
+    def discovery_document(self):
+        return {
+            'issuer': self.base_url,
+            'authorization_endpoint': f'{self.base_url}/o/oauth2/v2/auth',
+            'token_endpoint': f'{self.base_url}/token',
+            'userinfo_endpoint': f'{self.base_url}/v1/userinfo',
+            'jwks_uri': f'{self.base_url}/oauth2/v3/certs',
+            'id_token_signing_alg_values_supported': ['RS256'],
+        }
+
+    def jwks_document(self):
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.private_key.public_key()))
+        jwk.update({'kid': self.kid, 'use': 'sig', 'alg': 'RS256'})
+        return {'keys': [jwk]}
+
+    # Exchange an authorization code for tokens, or return an error body.
+    def exchange_code(self, form):
+        with self._lock:
+            identity = self.codes.pop(form.get('code', ''), None)
+        if identity is None or form.get('grant_type') != 'authorization_code':
+            return 400, {'error': 'invalid_grant'}
+        access_token = secrets.token_urlsafe(32)
+        with self._lock:
+            self.access_tokens[access_token] = identity
+        return 200, {
+            'access_token': access_token,
+            'expires_in': 3599,
+            'token_type': 'Bearer',
+            'scope': 'openid email profile',
+            'id_token': self.issue_id_token(audience=form.get('client_id') or self.client_id, **identity),
+        }
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # Keep-alive, like Google
+            documents = {
+                '/.well-known/openid-configuration': standin.discovery_document,
+                '/oauth2/v3/certs': standin.jwks_document,
+            }
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                self._count(url.path)
+                if url.path in self.documents:
+                    if standin.fail_keys:
+                        return self._send(503, {'error': 'unavailable'})
+                    return self._send(200, self.documents[url.path](), {'Cache-Control': f'public, max-age={standin.max_age}'})
+                if url.path == '/o/oauth2/v2/auth':
+                    return self._authorize(parse_qs(url.query))
+                if url.path == '/v1/userinfo':
+                    token = self.headers.get('Authorization', '').replace('Bearer ', '', 1)
+                    identity = standin.access_tokens.get(token)
+                    return self._send(200, identity) if identity else self._send(401, {'error': 'invalid_token'})
+                self._send(404, {'error': 'not_found'})
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                self._count(url.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                if url.path != '/token':
+                    return self._send(404, {'error': 'not_found'})
+                if standin.token_delay:
+                    time.sleep(standin.token_delay)
+                form = {key: values[0] for key, values in parse_qs(body).items()}
+                self._send(*standin.exchange_code(form))
+
+            # Approve consent immediately and redirect back with a code for the default identity.
+            def _authorize(self, query):
+                redirect_uri = query.get('redirect_uri', [''])[0]
+                params = {'code': standin.issue_code()}
+                if 'state' in query:
+                    params['state'] = query['state'][0]
+                self.send_response(302)
+                self.send_header('Location', f'{redirect_uri}?{urlencode(params)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def _count(self, path):
+                with standin._lock:
+                    standin.hits[path] = standin.hits.get(path, 0) + 1
+
+            def _send(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass # Keep benchmark and test output quiet
+
+        return Handler
@@ -0,0 +1,173 @@
+"""
+Login.py file for accounts app. Completes a Google social login once the
+id_token has been verified: creates or updates the user and social account
+and logs the user in to the session.
+
+Shared by the sync GoogleLogin endpoint and the async Google login view.
+All writes of a login are made in one transaction. Returning users, the
+common case, are loaded with their social account in one query, and rows
+are only written when a value changed.
+"""
+
+# Import required libraries for completing social logins
+import contextlib
+import copy
+import logging
+
+from allauth.account import app_settings as allauth_account_settings
+from allauth.account.adapter import get_adapter as get_account_adapter
+from allauth.exceptions import ImmediateHttpResponse
+from allauth.socialaccount import app_settings as allauth_socialaccount_settings
+from allauth.socialaccount import signals as allauth_socialaccount_signals
+from allauth.socialaccount.adapter import get_adapter as get_socialaccount_adapter
+from allauth.socialaccount.helpers import complete_social_login
+from allauth.socialaccount.models import SocialAccount, SocialLogin, SocialToken
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponseBadRequest
+
+from .signals import social_login_persisted
+
+logger = logging.getLogger(__name__)
+
+
+#------- [Variables] -------#
+
+# id_token claims that differ on every login. A change to only these does not rewrite extra_data.
+VOLATILE_CLAIMS = frozenset(('iat', 'exp', 'at_hash', 'nonce', 'auth_time'))
+
+# Signups that fail on a unique constraint are tried again once.
+SIGNUP_ATTEMPTS = 2
+
+
+#------- [Classes] -------#
+
+class LoginError(Exception):
+    pass
+
+
+#------- [Functions] -------#
+
+# Complete the social login and return the logged in user. Mirrors
+# dj_rest_auth's SocialLoginSerializer and SocialLoginView.process_login.
+def finish_social_login(request, login):
+    # Each attempt starts from the login as verified, since a failed attempt leaves
+    # primary keys and a generated username on the instances.
+    verified_login = copy.deepcopy(login)
+    queries = []
+    with connection.execute_wrapper(lambda execute, *args: queries.append(1) or execute(*args)):
+        for attempt in range(SIGNUP_ATTEMPTS):
+            if attempt:
+                login = copy.deepcopy(verified_login)
+            outcome = 'returning'
+            try:
+                with _login_transaction():
+                    user = _login_returning_user(request, login)
+                    if user is None:
+                        outcome = 'signup'
+                        user = _signup(request, login)
+                break
+            except IntegrityError:
+                # A concurrent signup took the generated username, or created this social
+                # account first. Try again, which finds the account or picks a new username.
+                if attempt == SIGNUP_ATTEMPTS - 1:
+                    raise
+    logger.debug('Google %s login for user %s made %d queries.', outcome, user.pk, len(queries))
+    social_login_persisted.send(sender=SocialLogin, outcome=outcome, queries=len(queries))
+    return user
+
+# Log in the user of a login that another request with the same authorization code
+# completed (see concurrency.LoginFlight), and return the user.
+def resume_social_login(request, user_id):
+    user = get_user_model().objects.filter(pk=user_id).first()
+    if user is None or not user.is_active:
+        raise LoginError('User account is disabled.')
+    if request.user.pk != user.pk:
+        get_account_adapter(request).login(request, user)
+    return user
+
+# One transaction for the whole login. On SQLite it takes the write lock as it begins:
+# a transaction that has already read cannot wait for another connection's write, so
+# concurrent logins would fail with "database is locked" instead of taking turns.
+@contextlib.contextmanager
+def _login_transaction():
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(f'UPDATE {connection.ops.quote_name(SocialAccount._meta.db_table)} SET id = id WHERE 0')
+        yield
+
+# Log in the owner of an existing social account, or return None for a new account.
+# Replaces allauth's lookup, which saves the account (and token) on every login.
+def _login_returning_user(request, login):
+    account = (
+        SocialAccount.objects.select_related('user')
+        .filter(provider=login.account.provider, uid=login.account.uid).first()
+    )
+    if account is None:
+        return None
+    if _stable_claims(account.extra_data) != _stable_claims(login.account.extra_data):
+        account.extra_data = login.account.extra_data
+        account.save(update_fields=['extra_data', 'last_login'])
+    login.account = account
+    login.user = user = account.user
+    if allauth_socialaccount_settings.STORE_TOKENS and login.token and login.token.app.pk:
+        _save_token(login)
+
+    # Same hooks as allauth's complete_social_login. The adapter syncs the Google profile.
+    try:
+        get_socialaccount_adapter(request).pre_social_login(request, login)
+        allauth_socialaccount_signals.pre_social_login.send(sender=SocialLogin, request=request, sociallogin=login)
+    except ImmediateHttpResponse as e:
+        raise LoginError(e.response.content.decode() or 'Login was stopped.') from e
+    if not user.is_active:
+        raise LoginError('User account is disabled.')
+    if request.user.pk != user.pk:
+        get_account_adapter(request).login(request, user)
+    allauth_socialaccount_signals.social_account_updated.send(sender=SocialLogin, request=request, sociallogin=login)
+    return user
+
+def _stable_claims(extra_data):
+    return {claim: value for claim, value in extra_data.items() if claim not in VOLATILE_CLAIMS}
+
+# Store the login's OAuth token, only writing the columns that changed.
+def _save_token(login):
+    token = login.token
+    stored = SocialToken.objects.filter(account=login.account, app=token.app).first()
+    if stored is None:
+        token.account = login.account
+        token.save()
+        return
+    values = {'token': token.token}
+    if token.token != stored.token: # A resent token keeps its expiry, which is computed anew on each login
+        values['expires_at'] = token.expires_at
+    if token.token_secret: # Google does not resend the refresh token on every login
+        values['token_secret'] = token.token_secret
+    changed = [name for name, value in values.items() if getattr(stored, name) != value]
+    for name in changed:
+        setattr(stored, name, values[name])
+    if changed:
+        stored.save(update_fields=changed)
+    login.token = stored
+
+# Sign up a new user through allauth, which also creates the social account,
+# token, and email address rows.
+def _signup(request, login):
+    ret = complete_social_login(request, login)
+    if isinstance(ret, HttpResponseBadRequest):
+        raise LoginError(ret.content.decode())
+
+    if not login.is_existing:
+        # We have an account already signed up in a different flow with the
+        # same email address. This needs to be handled in the frontend.
+        if allauth_account_settings.UNIQUE_EMAIL and login.user.email:
+            if get_user_model().objects.filter_by_email(login.user.email).exists():
+                raise LoginError('User is already registered with this e-mail address.')
+        login.lookup()
+        login.save(request, connect=True)
+
+    user = login.account.user
+    if request.user.pk != user.pk: # complete_social_login already logged in active users
+        get_account_adapter(request).login(request, user)
+    return user
@@ -0,0 +1,58 @@
+"""
+Backfill_google_profiles.py management command for accounts app.
+Copies the Google profile (name, picture, and locale) from existing
+social accounts to the profile fields on their users.
+
+Walks the Google social accounts in primary key order, one batch per
+transaction, and only writes the users whose profile changed. Safe to
+stop and run again, or to resume with --after.
+
+Usage: python manage.py backfill_google_profiles --batch-size 1000
+"""
+
+# Import required libraries for the backfill
+import time
+
+from allauth.socialaccount.models import SocialAccount
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.middleware import invalidate_cached_users
+from accounts.models import CustomUser
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Copy the Google profile from existing social accounts to their users, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Social accounts read per batch.')
+        parser.add_argument('--after', type=int, default=0, help='Start after this social account id, to resume a run.')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to wait between batches, to go easy on the database.')
+        parser.add_argument('--dry-run', action='store_true', help='Count the users that would change without saving them.')
+
+    def handle(self, *args, **options):
+        fields = list(CustomUser.GOOGLE_PROFILE_CLAIMS) + ['profile_version']
+        last_id, scanned, updated = options['after'], 0, 0
+        while True:
+            with transaction.atomic():
+                # Keyset pagination, so each batch is an index range scan however far in we are
+                accounts = list(
+                    SocialAccount.objects.filter(provider='google', pk__gt=last_id)
+                    .select_related('user').order_by('pk')[:options['batch_size']]
+                )
+                if not accounts:
+                    break
+                changed = [account.user for account in accounts if account.user.update_google_profile(account.extra_data)]
+                if changed and not options['dry_run']:
+                    CustomUser.objects.bulk_update(changed, fields)
+                    # bulk_update sends no post_save, so drop the cached user snapshots here
+                    invalidate_cached_users([user.pk for user in changed])
+            last_id = accounts[-1].pk
+            scanned += len(accounts)
+            updated += len(changed)
+            self.stdout.write(f'  up to social account {last_id}: {scanned} scanned, {updated} {"to update" if options["dry_run"] else "updated"}')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f'Done. {scanned} social accounts scanned, {updated} users {"to update" if options["dry_run"] else "updated"}.'))
@@ -0,0 +1,117 @@
+"""
+Bench_email_lookup.py management command for accounts app.
+Benchmarks the email lookups done on Google login at several user
+table sizes, in a separate test database.
+
+Usage: python manage.py bench_email_lookup --sizes 10000 1000000 10000000
+"""
+
+# Import required libraries for the benchmark
+import random
+import statistics
+import time
+
+from allauth.account.utils import filter_users_by_email
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from accounts.models import CustomUser
+from djgoprod.benchmarks import benchmark_database, percentile
+
+
+#------- [Variables] -------#
+
+# Synthetic users are generated in SQL, this many rows per statement.
+INSERT_CHUNK = 1_000_000
+
+# PostgreSQL generates the row numbers with generate_series, SQLite with a recursive CTE.
+POSTGRES_SERIES = 'SELECT i FROM generate_series(%s, %s) AS i'
+SQLITE_SERIES = 'WITH RECURSIVE seq(i) AS (SELECT %s UNION ALL SELECT i + 1 FROM seq WHERE i < %s) SELECT i FROM seq'
+
+UPPER_INDEX = 'accounts_user_email_upper_idx'
+
+
+#------- [Functions] -------#
+
+# Add synthetic users (and their allauth EmailAddress rows) numbered start..end-1.
+def insert_users(start, end):
+    series = POSTGRES_SERIES if connection.vendor == 'postgresql' else SQLITE_SERIES
+    with connection.cursor() as cursor:
+        for chunk_start in range(start, end, INSERT_CHUNK):
+            chunk_end = min(chunk_start + INSERT_CHUNK, end) - 1
+            cursor.execute(
+                'INSERT INTO accounts_customuser (password, is_superuser, username, first_name, last_name, email, is_staff, is_active, date_joined) '
+                "SELECT '!', false, 'bench' || i, '', '', 'User' || i || '@Example.com', false, true, CURRENT_TIMESTAMP "
+                f'FROM ({series}) AS series',
+                [chunk_start, chunk_end],
+            )
+        cursor.execute(
+            'INSERT INTO account_emailaddress (email, verified, "primary", user_id) '
+            'SELECT email, true, true, id FROM accounts_customuser '
+            'WHERE id NOT IN (SELECT user_id FROM account_emailaddress)'
+        )
+        cursor.execute('ANALYZE')
+
+# Run lookup once per email and return the latencies in milliseconds.
+def time_lookups(lookup, emails):
+    timings = []
+    for email in emails:
+        start = time.perf_counter()
+        lookup(email)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+# First line of the query plan for the iexact lookup.
+def query_plan(email):
+    sql, params = CustomUser.objects.filter(email__iexact=email).query.sql_with_params()
+    explain = 'EXPLAIN ' if connection.vendor == 'postgresql' else 'EXPLAIN QUERY PLAN '
+    with connection.cursor() as cursor:
+        cursor.execute(explain + sql, params)
+        row = cursor.fetchone()
+    return str(row[-1])
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Benchmark case-insensitive email lookups at several user table sizes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 1_000_000, 10_000_000])
+        parser.add_argument('--lookups', type=int, default=1000, help='Lookups timed per size and path.')
+        parser.add_argument('--compare-unindexed', action='store_true', help='Also time the lookups with the UPPER(email) index dropped.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database for the next run.')
+
+    def handle(self, *args, **options):
+        with benchmark_database(keepdb=options['keepdb']):
+            self.run(options)
+
+    def run(self, options):
+        paths = {
+            'allauth filter_users_by_email': filter_users_by_email,
+            'email__iexact exists': lambda email: CustomUser.objects.filter(email__iexact=email).exists(),
+            'filter_by_email exists': lambda email: CustomUser.objects.filter_by_email(email).exists(),
+        }
+        self.stdout.write(f'Database: {connection.vendor}')
+        rows = CustomUser.objects.count()
+        for size in sorted(options['sizes']):
+            if rows < size:
+                start = time.perf_counter()
+                insert_users(rows, size)
+                self.stdout.write(f'\nInserted {size - rows} users in {time.perf_counter() - start:.1f}s')
+                rows = size
+            emails = [f'USER{random.randrange(size)}@EXAMPLE.COM' for _ in range(options['lookups'])]
+            self.report(size, paths, emails)
+            if options['compare_unindexed']:
+                with connection.schema_editor() as schema_editor:
+                    index = next(index for index in CustomUser._meta.indexes if index.name == UPPER_INDEX)
+                    schema_editor.remove_index(CustomUser, index)
+                    self.report(size, paths, emails, label=' (no UPPER(email) index)')
+                    schema_editor.add_index(CustomUser, index)
+
+    def report(self, size, paths, emails, label=''):
+        self.stdout.write(f'\n{size:,} users{label}. Plan: {query_plan(emails[0])}')
+        self.stdout.write(f'  {"path":<32}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}')
+        for name, lookup in paths.items():
+            timings = sorted(time_lookups(lookup, emails))
+            self.stdout.write(f'  {name:<32}{statistics.mean(timings):>10.3f}{statistics.median(timings):>10.3f}{percentile(timings, 0.95):>10.3f}')
@@ -0,0 +1,326 @@
+"""
+Bench_login.py management command for accounts app.
+End-to-end benchmark of the login flow against a local Google stand-in.
+
+Drives the accounts endpoints in-process through the project's ASGI
+application (djgoprod/asgi.py), called on one event loop as Uvicorn calls it
+(full middleware stack, async views on the loop, sync views in threads, no
+network between client and app), with the given number of requests in
+flight, in a separate test database, and reports throughput, latency
+percentiles, DB queries per request, and allocations per request. Run it
+once with LOCAL_SQLITE and once with PSQL_DATABASE_URL to compare the
+database configurations.
+
+Usage: python manage.py bench_login --requests 500 --concurrency 8
+"""
+
+# Import required libraries for the benchmark
+import asyncio
+import contextvars
+import json
+import statistics
+import time
+import tracemalloc
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import Client, override_settings
+
+from accounts import google_keys
+from accounts.google_standin import GoogleStandIn
+from accounts.models import CustomUser
+from accounts.oauth_client import close_async_sessions
+from djgoprod.asgi import application
+from djgoprod.benchmarks import benchmark_database, percentile
+
+
+#------- [Variables] -------#
+
+ENDPOINTS = ['google', 'google-async', 'login', 'check-auth', 'get-csrf-token', 'logout']
+
+# Queries made by the request being timed. Sync views run in threads with a copy of the context.
+queries_made = contextvars.ContextVar('bench_login_queries', default=None)
+
+
+#------- [Functions] -------#
+
+def clear_google_keys():
+    google_keys.discovery.clear()
+    google_keys.jwks.clear()
+
+def count_query(execute, sql, params, many, context):
+    executed = queries_made.get()
+    if executed is not None:
+        executed.append(1)
+    return execute(sql, params, many, context)
+
+# Connected to connection_created, since each request's sync work runs in a thread with its own connection.
+def install_query_counter(sender, connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+#------- [Classes] -------#
+
+class AsgiResponse:
+
+    def __init__(self):
+        self.status_code = None
+        self.headers = []
+
+
+class AsgiClient:
+    """
+    Calls the ASGI application in-process with the scope and messages Uvicorn
+    sends, and keeps the cookies it sets, like Django's test client.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.cookies = SimpleCookie()
+
+    async def get(self, path):
+        return await self.request('GET', path)
+
+    async def post(self, path, data, content_type='application/x-www-form-urlencoded'):
+        body = json.dumps(data) if content_type == 'application/json' else urlencode(data)
+        return await self.request('POST', path, body.encode(), content_type)
+
+    async def request(self, method, path, body=b'', content_type=None):
+        headers = [(b'host', b'testserver')]
+        if content_type is not None:
+            headers += [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]
+        if self.cookies:
+            headers.append((b'cookie', '; '.join(f'{morsel.key}={morsel.coded_value}' for morsel in self.cookies.values()).encode()))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '', 'headers': headers,
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        response = AsgiResponse()
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await asyncio.Event().wait() # The client stays connected
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response.status_code = message['status']
+                response.headers = message.get('headers', [])
+                for name, value in response.headers:
+                    if name.lower() == b'set-cookie':
+                        self.set_cookie(value.decode('latin-1'))
+
+        # In a task of its own, as Uvicorn runs each request, so context the app sets does not leak into the next one
+        await asyncio.create_task(self.application(scope, receive, send))
+        return response
+
+    def set_cookie(self, header):
+        cookie = SimpleCookie(header)
+        for key, morsel in cookie.items():
+            if morsel['max-age'] == '0':
+                self.cookies.pop(key, None) # Deleted by the response
+            else:
+                self.cookies[key] = morsel
+
+
+class Scenario:
+    """Requests for one endpoint. prepare() runs untimed, request() is timed."""
+
+    expected_status = 200
+
+    def __init__(self, standin, users):
+        self.standin = standin
+        self.users = users
+
+    def prepare(self, count):
+        pass
+
+    async def request(self, client, i):
+        raise NotImplementedError
+
+    def identity(self, i):
+        n = i % self.users # Returning users after the first pass
+        return {'subject': f'bench{n}', 'email': f'bench{n}@example.com'}
+
+    # A logged in client for request i, created outside the timed section.
+    def logged_in_cookies(self, i):
+        user, _ = CustomUser.objects.get_or_create(username=f'benchsession{i % self.users}')
+        client = Client()
+        client.force_login(user, backend='django.contrib.auth.backends.ModelBackend')
+        return client.cookies
+
+
+class GoogleScenario(Scenario):
+
+    @property
+    def expected_status(self):
+        return 200 if settings.STATELESS_AUTH else 204 # Stateless mode returns signed tokens
+
+    def prepare(self, count):
+        self.codes = [self.standin.issue_code(**self.identity(i)) for i in range(count)]
+
+    async def request(self, client, i):
+        client.cookies.clear()
+        return await client.post('/accounts/dj-rest-auth/google/', {'code': self.codes[i]})
+
+
+class GoogleAsyncScenario(GoogleScenario):
+
+    async def request(self, client, i):
+        client.cookies.clear()
+        return await client.post('/accounts/dj-rest-auth/google/async/', {'code': self.codes[i]}, content_type='application/json')
+
+
+class LoginPageScenario(Scenario):
+
+    async def request(self, client, i):
+        client.cookies.clear()
+        return await client.get('/accounts/login/')
+
+
+class CheckAuthScenario(Scenario):
+
+    def prepare(self, count):
+        self.cookies = [self.logged_in_cookies(i) for i in range(min(count, self.users))]
+
+    async def request(self, client, i):
+        client.cookies = self.cookies[i % len(self.cookies)]
+        return await client.get('/accounts/check-auth/')
+
+
+class CsrfTokenScenario(Scenario):
+
+    async def request(self, client, i):
+        client.cookies.clear()
+        return await client.get('/accounts/get-csrf-token/')
+
+
+class LogoutScenario(Scenario):
+    expected_status = 302
+
+    def prepare(self, count):
+        self.cookies = [self.logged_in_cookies(i) for i in range(count)]
+
+    async def request(self, client, i):
+        client.cookies = self.cookies[i]
+        return await client.get('/accounts/logout/')
+
+
+SCENARIOS = {
+    'google': GoogleScenario,
+    'google-async': GoogleAsyncScenario,
+    'login': LoginPageScenario,
+    'check-auth': CheckAuthScenario,
+    'get-csrf-token': CsrfTokenScenario,
+    'logout': LogoutScenario,
+}
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Benchmark the login endpoints end to end against a local Google stand-in.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+        parser.add_argument('--requests', type=int, default=500, help='Timed requests per endpoint.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at once.')
+        parser.add_argument('--users', type=int, default=100, help='Distinct users logging in.')
+        parser.add_argument('--warmup', type=int, default=20, help='Untimed requests per endpoint before measuring.')
+        parser.add_argument('--alloc-samples', type=int, default=20, help='Sequential requests traced for allocations.')
+        parser.add_argument('--token-delay', type=float, default=0, help='Seconds the stand-in token endpoint waits, to simulate Google latency.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database for the next run.')
+
+    def handle(self, *args, **options):
+        standin = GoogleStandIn(client_id=settings.GOOGLE_CLIENT_ID).start()
+        standin.token_delay = options['token_delay']
+        overrides = {
+            'DEBUG': False, # Query logging under DEBUG would distort the numbers
+            'ALLOWED_HOSTS': settings.ALLOWED_HOSTS + ['testserver'],
+            'GOOGLE_DISCOVERY_URL': standin.discovery_url,
+            'GOOGLE_JWKS_URL': None,
+        }
+        try:
+            with benchmark_database(keepdb=options['keepdb']), override_settings(**overrides):
+                clear_google_keys()
+                self.stdout.write(f'Database: {connection.vendor}, sessions: {settings.SESSION_ENGINE.split(".")[-1]}, '
+                                  f'cache: {settings.CACHES["default"]["BACKEND"].split(".")[-1]}, '
+                                  f'concurrency: {options["concurrency"]}\n')
+                self.stdout.write(f'  {"endpoint":<16}{"requests":>9}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"queries":>9}{"KiB/req":>9}{"errors":>8}')
+                for name in options['endpoints']:
+                    self.run_endpoint(name, SCENARIOS[name](standin, options['users']), options)
+        finally:
+            clear_google_keys() # Drop the stand-in's documents so Google's are fetched again
+            standin.stop()
+
+    def run_endpoint(self, name, scenario, options):
+        warmup, count, samples = options['warmup'], options['requests'], options['alloc_samples']
+        scenario.prepare(warmup + count + samples)
+        timings, queries, errors = [], [], []
+
+        async def send(client, i):
+            executed = []
+            token = queries_made.set(executed)
+            start = time.perf_counter()
+            try:
+                response = await scenario.request(client, i)
+            finally:
+                queries_made.reset(token)
+            elapsed = time.perf_counter() - start
+            if i >= warmup and i < warmup + count:
+                timings.append(elapsed * 1000)
+                queries.append(len(executed))
+                if response.status_code != scenario.expected_status:
+                    errors.append(response.status_code)
+
+        # One event loop for the endpoint, as in a Uvicorn worker, so pooled connections are reused
+        async def run():
+            client = AsgiClient(application)
+            for i in range(warmup):
+                await send(client, i)
+
+            numbers = iter(range(warmup, warmup + count))
+            async def sender():
+                client = AsgiClient(application)
+                for i in numbers:
+                    await send(client, i)
+            start = time.perf_counter()
+            await asyncio.gather(*(sender() for _ in range(options['concurrency'])))
+            wall = time.perf_counter() - start
+
+            # Allocations are traced in a separate sequential pass since tracing slows everything down.
+            allocated = []
+            tracemalloc.start()
+            for i in range(warmup + count, warmup + count + samples):
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                await send(client, i)
+                allocated.append((tracemalloc.get_traced_memory()[1] - baseline) / 1024)
+            tracemalloc.stop()
+            await close_async_sessions() # As the worker's lifespan shutdown does
+            return wall, allocated
+
+        connection_created.connect(install_query_counter, dispatch_uid='bench_login_install_query_counter')
+        for existing in connections.all():
+            install_query_counter(None, existing)
+        try:
+            # In an empty context, as in a Uvicorn worker. prepare() may leave asgiref state in this one.
+            wall, allocated = contextvars.Context().run(asyncio.run, run())
+        finally:
+            connection_created.disconnect(dispatch_uid='bench_login_install_query_counter')
+
+        timings.sort()
+        self.stdout.write(
+            f'  {name:<16}{count:>9}{count / wall:>9.1f}{percentile(timings, 0.50):>9.2f}{percentile(timings, 0.95):>9.2f}'
+            f'{percentile(timings, 0.99):>9.2f}{statistics.mean(queries):>9.1f}{statistics.mean(allocated or [0]):>9.1f}{len(errors):>8}'
+        )
+        if errors:
+            self.stdout.write(self.style.WARNING(f'    unexpected statuses: {sorted(set(errors))}'))
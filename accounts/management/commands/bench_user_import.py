@@ -0,0 +1,90 @@
+"""
+Bench_user_import.py management command for accounts app.
+Benchmarks import_users and export_users with synthetic users, in a
+separate test database.
+
+Writes --rows records (each with an email address and a Google social
+account) to a temporary file, imports them, imports them again with
+--update, and exports them, reporting rows per second and the process's
+peak memory after each step. Peak memory should stay flat as --rows grows.
+
+Usage: python manage.py bench_user_import --rows 1000000 --batch-size 5000
+"""
+
+# Import required libraries for the benchmark
+import json
+import os
+import resource
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from accounts.provisioning import export_users, import_users
+from djgoprod.benchmarks import benchmark_database
+
+
+#------- [Functions] -------#
+
+# Write count synthetic records to a JSON Lines file. version changes the profile fields,
+# so importing the file again with update=True updates every user.
+def write_records(path, count, version=0):
+    with open(path, 'w', encoding='utf-8') as stream:
+        for i in range(count):
+            uid = str(100_000_000_000_000_000_000 + i)
+            extra_data = {'sub': uid, 'email': f'user{i}@example.com', 'email_verified': True, 'name': f'User {i} v{version}', 'locale': 'en'}
+            stream.write(json.dumps({
+                'username': f'user{i}', 'email': f'user{i}@example.com', 'email_verified': True,
+                'date_joined': '2024-06-01T00:00:00+00:00', 'google': {'uid': uid, 'extra_data': extra_data},
+            }, separators=(',', ':')))
+            stream.write('\n')
+
+# Peak resident memory of this process so far, in MB.
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Benchmark streaming user import and export.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Synthetic users imported and exported.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Records per transaction or query.')
+        parser.add_argument('--no-copy', action='store_true', help='Use INSERTs instead of COPY on PostgreSQL.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database for the next run.')
+
+    def handle(self, *args, **options):
+        # With DEBUG on, Django keeps the last 9000 queries, which would show up as memory growth
+        with benchmark_database(keepdb=options['keepdb']), override_settings(DEBUG=False), tempfile.TemporaryDirectory() as directory:
+            self.run(directory, options)
+
+    def run(self, directory, options):
+        rows, batch_size = options['rows'], options['batch_size']
+        use_copy = not options['no_copy']
+        self.stdout.write(f'Database: {connection.vendor}, {"COPY" if use_copy and connection.vendor == "postgresql" else "INSERT"}, {rows:,} rows, batches of {batch_size}')
+        self.stdout.write(f'Peak memory before: {peak_rss_mb():.0f} MB')
+        self.stdout.write(f'  {"step":<12}{"seconds":>10}{"rows/s":>12}{"peak MB":>10}')
+
+        path = os.path.join(directory, 'users.jsonl')
+        write_records(path, rows)
+        self.step('import', rows, lambda: self.import_file(path, batch_size, False, use_copy))
+        write_records(path, rows, version=1)
+        self.step('update', rows, lambda: self.import_file(path, batch_size, True, use_copy))
+        with open(os.path.join(directory, 'export.jsonl'), 'w', encoding='utf-8') as stream:
+            self.step('export', rows, lambda: export_users(stream, batch_size))
+
+    def import_file(self, path, batch_size, update, use_copy):
+        with open(path, encoding='utf-8') as stream:
+            stats = import_users(stream, batch_size, update, use_copy)
+        if stats.invalid or stats.created + stats.updated != stats.read:
+            self.stderr.write(self.style.WARNING(f'  {stats.created} created, {stats.updated} updated, {stats.skipped} skipped, {stats.invalid} invalid'))
+
+    def step(self, name, rows, function):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'  {name:<12}{elapsed:>10.1f}{rows / elapsed:>12,.0f}{peak_rss_mb():>10.0f}')
@@ -0,0 +1,46 @@
+"""
+Export_users.py management command for accounts app.
+Writes every user, with their email addresses and Google social account,
+as JSON Lines that import_users reads back.
+
+Reads the users in primary key batches, so memory use stays flat however
+many there are.
+
+Usage: python manage.py export_users users.jsonl
+       python manage.py export_users - --include-passwords | gzip > users.jsonl.gz
+"""
+
+# Import required libraries for the export
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.provisioning import export_users
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Export users, email addresses, and Google social accounts as JSON Lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to write, or - for stdout.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Users read per query.')
+        parser.add_argument('--include-passwords', action='store_true', help='Include the password hashes, so users keep their passwords.')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+
+        def progress(exported):
+            self.stderr.write(f'  {exported} exported, {exported / (time.monotonic() - start):.0f} rows/s')
+
+        stream = sys.stdout if options['path'] == '-' else open(options['path'], 'w', encoding='utf-8')
+        try:
+            exported = export_users(stream, options['batch_size'], options['include_passwords'], progress)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        elapsed = time.monotonic() - start
+        self.stderr.write(self.style.SUCCESS(f'Exported {exported} users in {elapsed:.1f}s ({exported / elapsed if elapsed else 0:.0f} rows/s).'))
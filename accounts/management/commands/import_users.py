@@ -0,0 +1,55 @@
+"""
+Import_users.py management command for accounts app.
+Creates or updates users, their email addresses, and their Google social
+accounts from a JSON Lines file (see accounts/provisioning.py for the format).
+
+Reads the file as a stream and imports it in batches, one transaction per
+batch, so memory use stays flat however large the file is. Users that
+already exist (by username) are skipped, or updated with --update. Safe to
+run again on the same file.
+
+Usage: python manage.py import_users users.jsonl --batch-size 5000
+       gunzip -c users.jsonl.gz | python manage.py import_users -
+"""
+
+# Import required libraries for the import
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.provisioning import import_users
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Import users, email addresses, and Google social accounts from JSON Lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSON Lines file to import, or - for stdin.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Records imported per transaction.')
+        parser.add_argument('--update', action='store_true', help='Update existing users with the fields their record sets.')
+        parser.add_argument('--no-copy', action='store_true', help='Use INSERTs instead of COPY on PostgreSQL.')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+
+        def progress(stats):
+            elapsed = time.monotonic() - start
+            self.stderr.write(f'  {stats.read} read, {stats.created} created, {stats.updated} updated, {stats.read / elapsed:.0f} rows/s')
+
+        stream = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8')
+        try:
+            stats = import_users(stream, options['batch_size'], options['update'], not options['no_copy'], progress)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        elapsed = time.monotonic() - start
+        for line_number, message in stats.errors:
+            self.stderr.write(self.style.WARNING(f'  line {line_number}: {message}'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Read {stats.read} records in {elapsed:.1f}s ({stats.read / elapsed if elapsed else 0:.0f} rows/s): '
+            f'{stats.created} created, {stats.updated} updated, {stats.skipped} skipped, {stats.invalid} invalid.'
+        ))
@@ -0,0 +1,34 @@
+"""
+Run_google_standin.py management command for accounts app.
+Runs the local Google stand-in (OAuth2, OpenID, and key endpoints)
+until interrupted.
+
+Usage: python manage.py run_google_standin --port 9000
+"""
+
+# Import required libraries for the management command
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts.google_standin import GoogleStandIn
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for Google\'s OAuth2, OpenID, and signing key endpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=9000)
+        parser.add_argument('--max-age', type=int, default=3600, help='Cache-Control max-age of the key documents.')
+
+    def handle(self, *args, **options):
+        standin = GoogleStandIn(port=options['port'], max_age=options['max_age'], client_id=settings.GOOGLE_CLIENT_ID).start()
+        self.stdout.write(f'Google stand-in running. Set GOOGLE_DISCOVERY_URL={standin.discovery_url}')
+        self.stdout.write('Sample id_token for GOOGLE_CLIENT_ID:')
+        self.stdout.write(standin.issue_id_token())
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            standin.stop()
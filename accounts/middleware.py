@@ -0,0 +1,123 @@
+"""
+Middleware.py file for accounts app. Authentication middleware that
+serves request.user from a cached snapshot of the user instead of
+selecting the user from the database on every request.
+"""
+
+# Import required libraries for the cached user lookup
+import hashlib
+import secrets
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import router, transaction
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+
+from djgoprod.metrics import record_cache
+
+
+#------- [Variables] -------#
+
+# User fields kept in a snapshot: what requests read from request.user. The password hash
+# is left out, so it is never copied to the cache. Other fields load from the database
+# if a request reads them.
+SNAPSHOT_FIELDS = (
+    'id', 'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser',
+    'date_joined', 'display_name', 'picture_url', 'locale', 'profile_version',
+)
+
+
+#------- [Functions] -------#
+
+def user_cache_key(user_id):
+    return f'accounts:user:{user_id}'
+
+# Random version of a user's snapshot, replaced whenever the user changes. A snapshot is
+# only used while its version is current, so a request that read the user before a change
+# can never cache the old row, however late it writes it.
+def user_version_key(user_id):
+    return f'accounts:user:{user_id}:version'
+
+def snapshot_user(user):
+    return tuple(getattr(user, field.attname) for field in snapshot_fields(type(user)))
+
+def user_from_snapshot(values):
+    User = auth.get_user_model()
+    field_names = [field.attname for field in snapshot_fields(User)]
+    return User.from_db(router.db_for_read(User), field_names, values)
+
+# In the model's order, which from_db expects for a partial row.
+def snapshot_fields(User):
+    return [field for field in User._meta.concrete_fields if field.name in SNAPSHOT_FIELDS]
+
+# Digest of the session auth hash stored with a snapshot, to check the session against.
+def session_hash_digest(session_hash):
+    return hashlib.sha256(session_hash.encode()).hexdigest()
+
+# Drop the snapshots of users, now and again when the current transaction commits, so a
+# request cannot cache a row read before the change was committed.
+def invalidate_cached_users(user_ids):
+    keys = [key for user_id in user_ids for key in (user_version_key(user_id), user_cache_key(user_id))]
+    if not keys:
+        return
+    cache.delete_many(keys)
+    using = router.db_for_write(auth.get_user_model())
+    if transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
+
+# Connected to CustomUser save and delete, which includes password changes and the
+# last_login update on each login. Bulk updates call invalidate_cached_users themselves.
+def invalidate_cached_user(sender, instance, **kwargs):
+    invalidate_cached_users([instance.pk])
+
+# Same result as django.contrib.auth.get_user, but an authenticated user is read from the
+# cache. The snapshot stores a digest of the session auth hash it was verified with, so it
+# is only used by sessions with that hash. On a miss the user is loaded and verified as usual.
+def get_cached_user(request):
+    try:
+        user_id = auth._get_user_session_key(request)
+        backend_path = request.session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+    session_hash = request.session.get(HASH_SESSION_KEY)
+    if not session_hash or backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return auth.get_user(request)
+
+    key, version_key = user_cache_key(user_id), user_version_key(user_id)
+    found = cache.get_many([key, version_key])
+    entry, version = found.get(key), found.get(version_key)
+    digest = session_hash_digest(session_hash)
+    if entry is not None and version is not None and entry[0] == version and constant_time_compare(entry[1], digest):
+        record_cache('user', hit=True)
+        return user_from_snapshot(entry[2])
+
+    record_cache('user', hit=False)
+    if version is None:
+        # Taken before reading the user, so a change made meanwhile replaces it
+        version = secrets.token_hex(8)
+        if not cache.add(version_key, version, timeout=settings.AUTH_USER_CACHE_TIMEOUT):
+            version = cache.get(version_key)
+    user = auth.get_user(request)
+    if user.is_authenticated and version is not None:
+        cache.set(key, (version, digest, snapshot_user(user)), timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+    return user
+
+def get_user(request):
+    if not hasattr(request, '_cached_user'):
+        request._cached_user = get_cached_user(request)
+    return request._cached_user
+
+
+#------- [Classes] -------#
+
+# Drop-in replacement for django.contrib.auth.middleware.AuthenticationMiddleware.
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+
+    def process_request(self, request):
+        super().process_request(request) # Keeps the session middleware check
+        request.user = SimpleLazyObject(lambda: get_user(request))
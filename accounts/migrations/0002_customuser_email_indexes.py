@@ -0,0 +1,41 @@
+# Generated by Django 4.0.4 on 2026-10-17 23:36
+
+import accounts.models
+from django.db import migrations, models
+import django.db.models.functions.text
+import djgoprod.migration_operations
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction. The indexes are
+    # built without blocking writes, so this is safe to apply on a live database.
+    atomic = False
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('account', '0002_email_max_length'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='customuser',
+            managers=[
+                ('objects', accounts.models.CustomUserManager()),
+            ],
+        ),
+        djgoprod.migration_operations.AddIndexConcurrently(
+            model_name='customuser',
+            index=models.Index(fields=['email'], name='accounts_user_email_idx'),
+        ),
+        djgoprod.migration_operations.AddIndexConcurrently(
+            model_name='customuser',
+            index=models.Index(django.db.models.functions.text.Upper('email'), name='accounts_user_email_upper_idx'),
+        ),
+        # allauth looks up EmailAddress rows with email__iexact, which PostgreSQL
+        # compiles to UPPER(email::text) = UPPER(%s).
+        djgoprod.migration_operations.PostgresRunSQL(
+            sql='CREATE INDEX CONCURRENTLY IF NOT EXISTS account_emailaddress_email_upper_idx ON account_emailaddress (UPPER(email));',
+            reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS account_emailaddress_email_upper_idx;',
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.4 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_refreshtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='display_name',
+            field=models.CharField(blank=True, max_length=150),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='locale',
+            field=models.CharField(blank=True, max_length=35),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='picture_url',
+            field=models.URLField(blank=True, max_length=500),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='profile_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
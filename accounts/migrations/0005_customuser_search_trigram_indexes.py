@@ -0,0 +1,37 @@
+# Generated by Django 4.0.4 on 2026-10-18 12:00
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+import djgoprod.migration_operations
+
+
+# The admin searches users with icontains, which PostgreSQL compiles to
+# UPPER(column::text) LIKE UPPER('%term%'). A B-tree cannot serve a LIKE with a
+# leading wildcard, but a trigram GIN index on the same expression can (for
+# terms of three or more characters). Django 4.0 cannot declare an operator
+# class on an expression index, so these are raw SQL and not in Meta.indexes.
+def trigram_index(column):
+    name = f'accounts_user_{column}_trgm_idx'
+    return djgoprod.migration_operations.PostgresRunSQL(
+        sql=f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON accounts_customuser USING gin (UPPER({column}::text) gin_trgm_ops);',
+        reverse_sql=f'DROP INDEX CONCURRENTLY IF EXISTS {name};',
+    )
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction. The indexes are
+    # built without blocking writes, so this is safe to apply on a live database.
+    atomic = False
+
+    dependencies = [
+        ('accounts', '0004_customuser_google_profile'),
+    ]
+
+    operations = [
+        TrigramExtension(), # Only runs on PostgreSQL
+        trigram_index('username'),
+        trigram_index('email'),
+        trigram_index('first_name'),
+        trigram_index('last_name'),
+    ]
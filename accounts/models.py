@@ -6,12 +6,106 @@ Date: 2024-06-01
 """
 
 from django.db import models
-from django.contrib.auth.models import AbstractUser
+from django.db.models.functions import Upper
+from django.contrib.auth.models import AbstractUser, UserManager
+
+# Custom User Manager
+class CustomUserManager(UserManager):
+
+    # Case-insensitive email lookup written as UPPER(email) = UPPER(value), which matches
+    # the functional index on both PostgreSQL and SQLite. (email__iexact only uses the
+    # index on PostgreSQL.)
+    def filter_by_email(self, email):
+        return self.annotate(email_upper=Upper('email')).filter(email_upper=email.upper())
 
 # Custom User Model
 class CustomUser(AbstractUser):
-    pass
-    # Additional fields can be added here
+    # Google profile, copied from the social account on each login so it can be shown
+    # without reading SocialAccount.extra_data. See update_google_profile.
+    display_name = models.CharField(max_length=150, blank=True)
+    picture_url = models.URLField(max_length=500, blank=True)
+    locale = models.CharField(max_length=35, blank=True)
+    # Bumped whenever the profile served by /accounts/me/ changes, which versions its cache entry.
+    # save() bumps it, but QuerySet.update() does not: an update() that changes a PROFILE_FIELDS
+    # column must also set profile_version=F('profile_version') + 1, or /me keeps serving the
+    # old profile (and the cached user snapshot stays until invalidate_cached_users is called).
+    profile_version = models.PositiveIntegerField(default=0)
+
+    # Profile fields and the Google claims they are copied from.
+    GOOGLE_PROFILE_CLAIMS = {'display_name': 'name', 'picture_url': 'picture', 'locale': 'locale'}
+
+    # Fields served by /accounts/me/. A save that changes any of them bumps profile_version.
+    PROFILE_FIELDS = ('username', 'email', 'first_name', 'last_name', 'display_name', 'picture_url', 'locale')
+
+    objects = CustomUserManager()
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Exact email lookups, such as the duplicate check on social signup.
+            models.Index(fields=['email'], name='accounts_user_email_idx'),
+            # Case-insensitive email lookups (email__iexact and filter_by_email).
+            models.Index(Upper('email'), name='accounts_user_email_upper_idx'),
+        ]
+
+    def __str__(self):
+        return self.username
+
+    # Remember the profile as loaded, so save() can tell whether it changed without a query.
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._saved_profile = user._profile_values()
+        return user
+
+    # Bump profile_version when a saved profile field changed, unless the caller already did
+    # (update_google_profile, bulk updates).
+    def save(self, *args, **kwargs):
+        saved = getattr(self, '_saved_profile', None)
+        update_fields = kwargs.get('update_fields')
+        if saved is not None and self.profile_version == saved.get('profile_version', self.profile_version):
+            current = self._profile_values()
+            if any(
+                current[name] != saved[name] for name in self.PROFILE_FIELDS
+                if name in current and name in saved and (update_fields is None or name in update_fields)
+            ):
+                self.profile_version += 1
+                if update_fields is not None:
+                    kwargs['update_fields'] = {*update_fields, 'profile_version'}
+        super().save(*args, **kwargs)
+        self._saved_profile = self._profile_values()
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._saved_profile = self._profile_values()
+
+    # Loaded profile fields and profile_version. Deferred fields are left out rather than loaded.
+    def _profile_values(self):
+        return {name: self.__dict__[name] for name in (*self.PROFILE_FIELDS, 'profile_version') if name in self.__dict__}
+
+    # Copy the Google profile from a social account's extra_data. Returns the names of the
+    # fields that changed, including profile_version when any did, for save(update_fields=...).
+    def update_google_profile(self, extra_data):
+        changed = []
+        for field, claim in self.GOOGLE_PROFILE_CLAIMS.items():
+            value = str(extra_data.get(claim) or '')[:self._meta.get_field(field).max_length]
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+                changed.append(field)
+        if changed:
+            self.profile_version += 1
+            changed.append('profile_version')
+        return changed
+
+# Refresh tokens issued in the stateless authentication mode (STATELESS_AUTH).
+# Each is used once, then replaced by a new token in the same family (login).
+class RefreshToken(models.Model):
+    jti = models.CharField(max_length=32, unique=True)
+    family = models.CharField(max_length=32, db_index=True)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='refresh_tokens')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    used_at = models.DateTimeField(null=True, blank=True)
+    revoked_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
-        return self.username
\ No newline at end of file
+        return self.jti
@@ -0,0 +1,200 @@
+"""
+Oauth_client.py file for accounts app. Shared keep-alive HTTP session
+and OAuth2 client used for outbound calls to Google.
+
+Each worker process keeps one pooled requests session, so logins reuse
+open TLS connections to Google instead of doing a new handshake per call.
+aiohttp is only imported by the first async call, since importing it takes
+longer than the rest of this module's imports (python manage.py profile_startup).
+The pooled aiohttp session of the worker's event loop is closed when the ASGI
+server shuts the worker down (the lifespan handler in djgoprod/asgi.py).
+"""
+
+# Import required libraries for pooled HTTP calls
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import parse_qsl
+
+import requests
+from allauth.socialaccount.providers.oauth2.client import OAuth2Client as BaseOAuth2Client
+from allauth.socialaccount.providers.oauth2.client import OAuth2Error
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .signals import oauth_http_call
+
+logger = logging.getLogger(__name__)
+
+
+#------- [Variables] -------#
+
+# Status codes worth retrying for idempotent calls.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Backoff between retries is 0.2s, 0.4s, 0.8s, ... capped at this many seconds.
+RETRY_BACKOFF_MAX = 2
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_async_sessions = {} # aiohttp session per long-lived event loop
+
+
+#------- [Functions] -------#
+
+# Build a session with a connection pool and a bounded retry budget.
+# Connection errors are retried for every method since the request was never sent.
+# Read errors and retryable statuses are only retried for idempotent methods (not POST).
+def _build_session():
+    retry = Retry(
+        total=settings.OAUTH_HTTP_RETRIES,
+        connect=settings.OAUTH_HTTP_RETRIES,
+        read=settings.OAUTH_HTTP_RETRIES,
+        status=settings.OAUTH_HTTP_RETRIES,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=0.1,
+        backoff_max=RETRY_BACKOFF_MAX,
+        respect_retry_after_header=False, # Keep the backoff bounded
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.OAUTH_HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Return this worker's shared session. A forked worker builds its own so
+# pooled sockets are never shared between processes.
+def get_http_session():
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = _build_session()
+                _session_pid = os.getpid()
+    return _session
+
+# Make an outbound call with the shared session and the configured timeouts.
+# Returns the response and the wall time in seconds, and sends oauth_http_call.
+def http_request(method, url, **kwargs):
+    kwargs.setdefault('timeout', (settings.OAUTH_HTTP_CONNECT_TIMEOUT, settings.OAUTH_HTTP_READ_TIMEOUT))
+    start = time.perf_counter()
+    status = None
+    try:
+        response = get_http_session().request(method, url, **kwargs)
+        status = response.status_code
+        return response, time.perf_counter() - start
+    finally:
+        seconds = time.perf_counter() - start
+        logger.debug('%s %s -> %s in %.1fms', method, url, status, seconds * 1000)
+        oauth_http_call.send(sender=http_request, method=method, url=url, status=status, seconds=seconds)
+
+
+# Return an aiohttp session for the running event loop.
+# ASGI workers run one long-lived loop in the main thread, which keeps a pooled session.
+# Short-lived loops (async views under WSGI) get a session that is closed after the call.
+def _get_async_session():
+    loop = asyncio.get_running_loop()
+    if threading.current_thread() is not threading.main_thread():
+        return _new_async_session(), True
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        session = _async_sessions[loop] = _new_async_session()
+    return session, False
+
+# Close the running event loop's pooled session. Called when the ASGI server shuts the worker down,
+# so a worker replaced after its max requests closes its connections to Google cleanly.
+async def close_async_sessions():
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+def _new_async_session():
+    import aiohttp
+    timeout = aiohttp.ClientTimeout(sock_connect=settings.OAUTH_HTTP_CONNECT_TIMEOUT, sock_read=settings.OAUTH_HTTP_READ_TIMEOUT)
+    return aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(ttl_dns_cache=300))
+
+# Async counterpart of http_request for event-loop views. Connection errors are
+# retried with the same bounded backoff. Returns the status, the decoded JSON
+# body (or None), and the wall time in seconds, and sends oauth_http_call.
+async def async_http_request(method, url, **kwargs):
+    import aiohttp
+    session, close_after = _get_async_session()
+    start = time.perf_counter()
+    status = None
+    try:
+        for attempt in range(settings.OAUTH_HTTP_RETRIES + 1):
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    status = response.status
+                    text = await response.text()
+                break
+            except aiohttp.ClientConnectorError:
+                if attempt == settings.OAUTH_HTTP_RETRIES:
+                    raise
+                await asyncio.sleep(min(0.1 * 2 ** attempt, RETRY_BACKOFF_MAX))
+        try:
+            body = json.loads(text)
+        except ValueError:
+            body = None
+        return status, body, time.perf_counter() - start
+    finally:
+        seconds = time.perf_counter() - start
+        logger.debug('%s %s -> %s in %.1fms', method, url, status, seconds * 1000)
+        oauth_http_call.send(sender=async_http_request, method=method, url=url, status=status, seconds=seconds)
+        if close_after:
+            await session.close()
+
+
+#------- [Classes] -------#
+
+# OAuth2 client that exchanges the authorization code through the shared session.
+# The last call's wall time is kept on last_call_seconds.
+class OAuth2Client(BaseOAuth2Client):
+    last_call_seconds = None
+
+    def get_access_token(self, code, pkce_code_verifier=None):
+        data = {
+            "redirect_uri": self.callback_url,
+            "grant_type": "authorization_code",
+            "code": code,
+        }
+        if self.basic_auth:
+            auth = requests.auth.HTTPBasicAuth(self.consumer_key, self.consumer_secret)
+        else:
+            auth = None
+            data.update({"client_id": self.consumer_key, "client_secret": self.consumer_secret})
+        params = None
+        self._strip_empty_keys(data)
+        if self.access_token_method == "GET":
+            params = data
+            data = None
+        if data and pkce_code_verifier:
+            data["code_verifier"] = pkce_code_verifier
+        try:
+            resp, self.last_call_seconds = http_request(
+                self.access_token_method,
+                self.access_token_url,
+                params=params,
+                data=data,
+                headers=self.headers,
+                auth=auth,
+            )
+        except requests.RequestException as e:
+            raise OAuth2Error("Error retrieving access token: %s" % e) from e
+
+        access_token = None
+        if resp.status_code in [200, 201]:
+            if resp.headers.get("content-type", "").split(";")[0] == "application/json" or resp.text[:2] == '{"':
+                access_token = resp.json()
+            else:
+                access_token = dict(parse_qsl(resp.text))
+        if not access_token or "access_token" not in access_token:
+            raise OAuth2Error("Error retrieving access token: %s" % resp.content)
+        return access_token
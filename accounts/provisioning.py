@@ -0,0 +1,339 @@
+"""
+Provisioning.py file for accounts app. Streams users, their email
+addresses, and their Google social accounts in and out as JSON Lines,
+for migrating and syncing users from other systems.
+
+One user per line:
+    {"username": "ada", "email": "ada@example.com", "first_name": "Ada",
+     "last_name": "Lovelace", "is_active": true, "date_joined": "2024-06-01T00:00:00+00:00",
+     "display_name": "Ada Lovelace", "picture_url": "https://...", "locale": "en",
+     "password": "<Django password hash, optional>",
+     "emails": [{"email": "ada@example.com", "verified": true, "primary": true}],
+     "google": {"uid": "1234567890", "extra_data": {...}}}
+
+Only username is required. Without "emails", the user's email is added as
+their primary address, verified if "email_verified" is true. Without the
+profile fields, they are taken from the Google extra_data.
+Each record's values are checked against the model fields (types, lengths,
+formats), and a record that does not fit is counted as invalid and skipped.
+
+Records are read and written in batches, so memory use does not grow with
+the file. On PostgreSQL new users are loaded with COPY into a staging table
+and inserted from there, other databases use multi-row INSERTs.
+"""
+
+# Import required libraries for streaming imports and exports
+import io
+import json
+import secrets
+from datetime import datetime
+
+from allauth.account import app_settings as allauth_account_settings
+from allauth.account.models import EmailAddress
+from allauth.socialaccount.models import SocialAccount
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+from django.db.models.functions import Upper
+from django.utils import timezone
+
+from .middleware import invalidate_cached_users
+from .models import CustomUser
+
+
+#------- [Variables] -------#
+
+# User fields read from and written to each record, besides the emails and Google account.
+USER_FIELDS = (
+    'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser',
+    'date_joined', 'last_login', 'display_name', 'picture_url', 'locale',
+)
+
+# Fields changed on existing users by an import with update=True.
+UPDATE_FIELDS = ('email', 'first_name', 'last_name', 'is_active', 'display_name', 'picture_url', 'locale')
+
+DATETIME_FIELDS = ('date_joined', 'last_login')
+
+
+#------- [Classes] -------#
+
+class RecordError(ValueError):
+    pass
+
+
+class ImportRecord:
+    """An unsaved user, the fields its record set, and its email addresses and Google account."""
+
+    __slots__ = ('user', 'fields', 'emails', 'google')
+
+    def __init__(self, user, fields, emails, google):
+        self.user = user
+        self.fields = fields
+        self.emails = emails # (email, verified, primary) tuples
+        self.google = google # {'uid': ..., 'extra_data': ...} or None
+
+
+class ImportStats:
+
+    def __init__(self):
+        self.read = 0
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0 # Existing users (unless updating), or emails used by another user
+        self.invalid = 0
+        self.errors = [] # First few (line number, message) pairs
+
+
+#------- [Functions] -------#
+
+# Parse one record into an ImportRecord.
+def parse_record(record):
+    if not isinstance(record, dict) or not record.get('username'):
+        raise RecordError('username is required')
+    values = {name: record[name] for name in USER_FIELDS if record.get(name) is not None}
+    for name in DATETIME_FIELDS:
+        if name in values:
+            try:
+                values[name] = datetime.fromisoformat(values[name])
+            except (TypeError, ValueError) as e:
+                raise RecordError(f'{name} is not an ISO 8601 datetime') from e
+            if timezone.is_naive(values[name]):
+                values[name] = timezone.make_aware(values[name], timezone.utc)
+    user = CustomUser(**values)
+    # Unusable unless a hash is given. Same as make_password(None), which is slow to draw its random suffix
+    user.password = record.get('password') or UNUSABLE_PASSWORD_PREFIX + secrets.token_hex(20)
+    user.date_joined = user.date_joined or timezone.now()
+    fields = set(values)
+
+    # Check the values the record gave (types, lengths, formats), so a bad one makes the record
+    # invalid instead of failing its whole batch. Uniqueness is checked per batch.
+    checked = fields | ({'password'} if record.get('password') else set())
+    try:
+        user.clean_fields(exclude=[field.name for field in CustomUser._meta.fields if field.name not in checked])
+    except ValidationError as e:
+        raise RecordError('; '.join(f'{name}: {" ".join(messages)}' for name, messages in e.message_dict.items())) from e
+
+    google = record.get('google')
+    if google is not None and not (isinstance(google, dict) and google.get('uid')):
+        raise RecordError('google.uid is required')
+    if google and not isinstance(google.get('extra_data') or {}, dict):
+        raise RecordError('google.extra_data must be an object')
+    if google:
+        google['uid'] = _clean_value(SocialAccount, 'uid', str(google['uid']), 'google.uid')
+    if google and not fields.intersection(CustomUser.GOOGLE_PROFILE_CLAIMS):
+        fields.update(user.update_google_profile(google.get('extra_data') or {}))
+
+    emails = record.get('emails')
+    if emails is None:
+        emails = [{'email': user.email, 'verified': bool(record.get('email_verified')), 'primary': True}] if user.email else []
+    emails = [
+        (_clean_value(EmailAddress, 'email', entry['email'], 'emails.email'), bool(entry.get('verified')), bool(entry.get('primary')))
+        for entry in emails if isinstance(entry, dict) and entry.get('email')
+    ]
+    return ImportRecord(user, fields, emails, google)
+
+# Validate a value for a model field, raising RecordError if it does not fit.
+def _clean_value(model, name, value, label):
+    try:
+        return model._meta.get_field(name).clean(value, None)
+    except ValidationError as e:
+        raise RecordError(f'{label}: {" ".join(e.messages)}') from e
+
+def record_from_user(user, emails, google, include_password=False):
+    record = {}
+    for name in USER_FIELDS:
+        value = getattr(user, name)
+        record[name] = value.isoformat() if isinstance(value, datetime) else value
+    if include_password:
+        record['password'] = user.password
+    record['emails'] = [{'email': email, 'verified': verified, 'primary': primary} for email, verified, primary in emails]
+    if google is not None:
+        record['google'] = {'uid': google.uid, 'extra_data': google.extra_data}
+    return record
+
+# Read JSON Lines from a text stream and import them in batches of batch_size, one
+# transaction per batch. Existing users (matched by username) are skipped, or with
+# update set, get the fields their record sets. progress(stats) is called after each batch.
+def import_users(stream, batch_size=5000, update=False, use_copy=True, progress=None):
+    stats = ImportStats()
+    batch = {}
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        stats.read += 1
+        try:
+            record = parse_record(json.loads(line))
+        except (ValueError, TypeError) as e:
+            stats.invalid += 1
+            if len(stats.errors) < 20:
+                stats.errors.append((line_number, str(e)))
+            continue
+        batch[record.user.username] = record # A username repeated in a batch keeps its last record
+        if len(batch) >= batch_size:
+            _import_batch(list(batch.values()), stats, update, use_copy)
+            batch = {}
+            if progress:
+                progress(stats)
+    if batch:
+        _import_batch(list(batch.values()), stats, update, use_copy)
+        if progress:
+            progress(stats)
+    return stats
+
+def _import_batch(records, stats, update, use_copy):
+    with transaction.atomic():
+        existing = dict(CustomUser.objects.filter(username__in=[record.user.username for record in records]).values_list('username', 'pk'))
+        new = [record for record in records if record.user.username not in existing]
+        old = [record for record in records if record.user.username in existing]
+        stats.skipped += len(old)
+
+        # Keep emails unique across users, as allauth does with UNIQUE_EMAIL
+        if allauth_account_settings.UNIQUE_EMAIL:
+            emails = {record.user.email.upper() for record in new if record.user.email}
+            taken = set(
+                CustomUser.objects.annotate(email_upper=Upper('email'))
+                .filter(email_upper__in=emails).values_list('email_upper', flat=True)
+            ) if emails else set()
+            kept = []
+            for record in new:
+                email = record.user.email.upper()
+                if email and email in taken:
+                    stats.skipped += 1
+                    continue
+                kept.append(record)
+                if email:
+                    taken.add(email)
+            new = kept
+
+        if new:
+            users = [record.user for record in new]
+            if use_copy and connection.vendor == 'postgresql':
+                created = _copy_insert(users)
+            else:
+                created = _bulk_insert(users)
+            # Users created meanwhile by someone else are skipped, and get none of the record's rows
+            stats.skipped += len(new) - len(created)
+            new = [record for record in new if record.user.username in created]
+            for record in new:
+                record.user.pk = created[record.user.username]
+            stats.created += len(new)
+
+        if update and old:
+            stored = CustomUser.objects.in_bulk([existing[record.user.username] for record in old])
+            updated, fields = [], set()
+            for record in old:
+                user = stored[existing[record.user.username]]
+                changed = [name for name in UPDATE_FIELDS if name in record.fields and getattr(user, name) != getattr(record.user, name)]
+                for name in changed:
+                    setattr(user, name, getattr(record.user, name))
+                if changed:
+                    user.profile_version += 1
+                    updated.append(user)
+                    fields.update(changed)
+                record.user = user
+            if updated:
+                # Only the columns some user changed, since bulk_update's CASE per column is slow to build
+                fields = sorted(fields) + ['profile_version']
+                if use_copy and connection.vendor == 'postgresql':
+                    _copy_update(updated, fields)
+                else:
+                    CustomUser.objects.bulk_update(updated, fields, batch_size=1000)
+                # bulk_update sends no post_save, so drop the cached user snapshots here
+                invalidate_cached_users([user.pk for user in updated])
+            stats.updated += len(updated)
+            stats.skipped -= len(updated)
+            new += old
+
+        EmailAddress.objects.bulk_create([
+            EmailAddress(user_id=record.user.pk, email=email, verified=verified, primary=primary)
+            for record in new for email, verified, primary in record.emails
+        ], batch_size=1000, ignore_conflicts=True)
+        SocialAccount.objects.bulk_create([
+            SocialAccount(user_id=record.user.pk, provider='google', uid=record.google['uid'], extra_data=record.google.get('extra_data') or {})
+            for record in new if record.google
+        ], batch_size=1000, ignore_conflicts=True)
+
+# Insert users with PostgreSQL COPY into a staging table, skipping the ones whose
+# username was taken meanwhile. Returns {username: pk} of the users inserted.
+def _copy_insert(users):
+    fields = [field for field in CustomUser._meta.concrete_fields if not field.primary_key]
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    returned = ', '.join(connection.ops.quote_name(field.column) for field in (CustomUser._meta.pk, CustomUser._meta.get_field('username')))
+    with connection.cursor() as cursor:
+        _copy_to_staging(cursor, 'import_users', users, fields)
+        cursor.execute(f'INSERT INTO {_table()} ({columns}) SELECT {columns} FROM import_users ON CONFLICT DO NOTHING RETURNING {returned}')
+        return {username: pk for pk, username in cursor.fetchall()}
+
+# Insert users with multi-row INSERTs. If one conflicts with a user created meanwhile, the
+# batch is inserted again a user at a time, skipping the conflicting ones. Returns
+# {username: pk} of the users inserted.
+def _bulk_insert(users):
+    try:
+        with transaction.atomic():
+            CustomUser.objects.bulk_create(users, batch_size=1000)
+    except IntegrityError:
+        inserted = []
+        for user in users:
+            user.pk = None
+            try:
+                with transaction.atomic():
+                    CustomUser.objects.bulk_create([user])
+            except IntegrityError:
+                continue
+            inserted.append(user)
+        users = inserted
+    if users and users[0].pk is None:
+        # The database does not return the new ids. Every username inserted here is one of ours.
+        return dict(CustomUser.objects.filter(username__in=[user.username for user in users]).values_list('username', 'pk'))
+    return {user.username: user.pk for user in users}
+
+# Update the given fields of users with PostgreSQL COPY into a staging table.
+def _copy_update(users, names):
+    fields = [CustomUser._meta.pk] + [CustomUser._meta.get_field(name) for name in names]
+    pk = connection.ops.quote_name(CustomUser._meta.pk.column)
+    assignments = ', '.join(f'{column} = staged.{column}' for column in (connection.ops.quote_name(field.column) for field in fields[1:]))
+    with connection.cursor() as cursor:
+        _copy_to_staging(cursor, 'import_user_updates', users, fields)
+        cursor.execute(f'UPDATE {_table()} SET {assignments} FROM import_user_updates AS staged WHERE {_table()}.{pk} = staged.{pk}')
+
+# Create a temporary table with the columns of fields, dropped at commit, and COPY the users into it.
+def _copy_to_staging(cursor, staging, users, fields):
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    buffer = io.StringIO()
+    for user in users:
+        buffer.write('\t'.join(_copy_value(field.get_db_prep_save(getattr(user, field.attname), connection)) for field in fields))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.execute(f'CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {columns} FROM {_table()} WITH NO DATA')
+    cursor.copy_expert(f'COPY {staging} ({columns}) FROM STDIN', buffer)
+
+def _table():
+    return connection.ops.quote_name(CustomUser._meta.db_table)
+
+# A value in PostgreSQL's COPY text format.
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# Write every user as JSON Lines to a text stream, batch_size users at a time in primary
+# key order, with two more queries per batch for their emails and Google accounts.
+def export_users(stream, batch_size=5000, include_password=False, progress=None):
+    exported = 0
+    last_pk = 0
+    while True:
+        users = list(CustomUser.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not users:
+            return exported
+        user_ids = [user.pk for user in users]
+        emails = {}
+        for user_id, email, verified, primary in EmailAddress.objects.filter(user_id__in=user_ids).order_by('pk').values_list('user_id', 'email', 'verified', 'primary'):
+            emails.setdefault(user_id, []).append((email, verified, primary))
+        google = {account.user_id: account for account in SocialAccount.objects.filter(user_id__in=user_ids, provider='google')}
+        for user in users:
+            stream.write(json.dumps(record_from_user(user, emails.get(user.pk, []), google.get(user.pk), include_password), separators=(',', ':')))
+            stream.write('\n')
+        exported += len(users)
+        last_pk = users[-1].pk
+        if progress:
+            progress(exported)
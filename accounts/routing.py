@@ -0,0 +1,12 @@
+"""
+Routing.py file for accounts app. WebSocket routes, served by the
+ASGI application in djgoprod/asgi.py.
+"""
+
+from django.urls import path
+from . import consumers
+
+# WebSocket url patterns for accounts app
+websocket_urlpatterns = [
+    path('ws/auth/', consumers.AuthStateConsumer.as_asgi()), # Auth state push (replaces check-auth polling)
+]
@@ -0,0 +1,13 @@
+"""
+Signals.py file for accounts app. Custom signals sent by the accounts app.
+"""
+
+from django.dispatch import Signal
+
+# Sent after each outbound OAuth HTTP call with method, url, status (None on
+# connection failure), and seconds (wall time including retries).
+oauth_http_call = Signal()
+
+# Sent after each Google login is persisted, with outcome (returning or signup)
+# and queries (database queries made to persist the login and log in).
+social_login_persisted = Signal()
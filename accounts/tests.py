@@ -1,3 +1,591 @@
-from django.test import TestCase
+"""
+Tests.py file for accounts app. Run with python manage.py test accounts.
 
-# Create your tests here.
+Google is replaced by the local stand-in (google_standin.py), so the tests
+sign and verify real id_tokens without network access beyond 127.0.0.1.
+"""
+
+# Import required libraries for the tests
+import io
+import json
+from unittest import mock
+
+import jwt
+from allauth.account.models import EmailAddress
+from allauth.socialaccount.models import SocialAccount, SocialApp, SocialToken
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import HASH_SESSION_KEY, get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sites.models import Site
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import concurrency, google_keys, middleware, provisioning, tokens
+from .google_standin import GoogleStandIn
+from .models import RefreshToken
+from .views import token_logout, token_refresh
+
+
+#------- [Variables] -------#
+
+JWKS_PATH = '/oauth2/v3/certs'
+
+TOKEN_PATH = '/token'
+
+LOGIN_URL = '/accounts/dj-rest-auth/google/'
+
+BOOTSTRAP_URL = '/accounts/bootstrap/'
+
+ME_URL = '/accounts/me/'
+
+
+#------- [Classes] -------#
+
+class StandInTestCase(TestCase):
+    """Points the Google endpoints at a stand-in for the class, with empty key caches for each test."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.standin = GoogleStandIn(client_id=settings.GOOGLE_CLIENT_ID).start()
+        cls.addClassCleanup(cls.standin.stop)
+        overrides = override_settings(
+            GOOGLE_DISCOVERY_URL=cls.standin.discovery_url,
+            GOOGLE_JWKS_URL=None,
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+        )
+        overrides.enable()
+        cls.addClassCleanup(overrides.disable)
+
+    def setUp(self):
+        self.standin.fail_keys = False
+        self.standin.hits.clear()
+        cache.clear()
+        self.clear_google_keys()
+        self.addCleanup(self.clear_google_keys)
+
+    def clear_google_keys(self):
+        google_keys.discovery.clear()
+        google_keys.jwks.clear()
+
+
+class IdTokenVerificationTests(StandInTestCase):
+
+    def test_valid_token_returns_claims(self):
+        token = self.standin.issue_id_token(subject='ada', email='ada@example.com')
+        claims = google_keys.verify_id_token(token, audience=settings.GOOGLE_CLIENT_ID)
+        self.assertEqual(claims['sub'], 'ada')
+        self.assertEqual(claims['email'], 'ada@example.com')
+
+    def test_token_signed_with_another_key_is_rejected(self):
+        google_keys.jwks.get()
+        other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        claims = jwt.decode(self.standin.issue_id_token(), options={'verify_signature': False})
+        forged = jwt.encode(claims, other_key, algorithm='RS256', headers={'kid': self.standin.kid})
+        with self.assertRaises(jwt.InvalidSignatureError):
+            google_keys.verify_id_token(forged, audience=settings.GOOGLE_CLIENT_ID)
+
+    def test_wrong_audience_is_rejected(self):
+        token = self.standin.issue_id_token(audience='another-client')
+        with self.assertRaises(jwt.InvalidAudienceError):
+            google_keys.verify_id_token(token, audience=settings.GOOGLE_CLIENT_ID)
+
+    def test_expired_token_is_rejected(self):
+        token = self.standin.issue_id_token(lifetime=-60)
+        with self.assertRaises(jwt.ExpiredSignatureError):
+            google_keys.verify_id_token(token, audience=settings.GOOGLE_CLIENT_ID)
+
+    def test_unknown_issuer_is_rejected(self):
+        claims = jwt.decode(self.standin.issue_id_token(), options={'verify_signature': False})
+        token = jwt.encode({**claims, 'iss': 'https://issuer.example.com'}, self.standin.private_key, algorithm='RS256', headers={'kid': self.standin.kid})
+        with self.assertRaises(jwt.InvalidIssuerError):
+            google_keys.verify_id_token(token, audience=settings.GOOGLE_CLIENT_ID)
+
+    def test_keys_are_fetched_once_and_verified_locally(self):
+        for _ in range(3):
+            google_keys.verify_id_token(self.standin.issue_id_token(), audience=settings.GOOGLE_CLIENT_ID)
+        self.assertEqual(self.standin.hits[JWKS_PATH], 1)
+        self.assertTrue(google_keys.can_verify_locally(self.standin.issue_id_token()))
+
+
+class KeyRotationTests(StandInTestCase):
+
+    def age_keys(self):
+        google_keys.jwks._entry = {**google_keys.jwks._entry, 'fetched_at': 0} # Fetched long ago
+
+    def test_rotated_key_is_fetched_on_unknown_kid(self):
+        google_keys.verify_id_token(self.standin.issue_id_token(), audience=settings.GOOGLE_CLIENT_ID)
+        self.age_keys()
+        self.standin.rotate_key()
+        token = self.standin.issue_id_token(subject='rotated')
+        self.assertFalse(google_keys.can_verify_locally(token)) # The cached keys do not have the new kid
+        claims = google_keys.verify_id_token(token, audience=settings.GOOGLE_CLIENT_ID)
+        self.assertEqual(claims['sub'], 'rotated')
+        self.assertEqual(self.standin.hits[JWKS_PATH], 2)
+
+    def test_unknown_kids_fetch_the_keys_at_most_once_in_a_while(self):
+        google_keys.jwks.get()
+        self.age_keys()
+        claims = jwt.decode(self.standin.issue_id_token(), options={'verify_signature': False})
+        forged = jwt.encode(claims, self.standin.private_key, algorithm='RS256', headers={'kid': 'forged'})
+        for _ in range(2):
+            with self.assertRaisesMessage(jwt.InvalidTokenError, 'Unknown signing key id'):
+                google_keys.verify_id_token(forged, audience=settings.GOOGLE_CLIENT_ID)
+        self.assertEqual(self.standin.hits[JWKS_PATH], 2) # One refetch for both tokens
+
+    def test_rotated_key_is_rejected_until_the_keys_can_be_refetched(self):
+        google_keys.verify_id_token(self.standin.issue_id_token(), audience=settings.GOOGLE_CLIENT_ID)
+        self.standin.rotate_key()
+        with self.assertRaises(jwt.InvalidTokenError):
+            google_keys.verify_id_token(self.standin.issue_id_token(), audience=settings.GOOGLE_CLIENT_ID)
+        self.assertEqual(self.standin.hits[JWKS_PATH], 1)
+
+    def test_unknown_kid_is_rejected_when_keys_cannot_be_fetched(self):
+        google_keys.jwks.get()
+        self.age_keys()
+        self.standin.rotate_key()
+        self.standin.fail_keys = True
+        with self.assertRaises(jwt.InvalidTokenError):
+            google_keys.verify_id_token(self.standin.issue_id_token(), audience=settings.GOOGLE_CLIENT_ID)
+
+    def test_cached_keys_still_verify_while_google_is_down(self):
+        token = self.standin.issue_id_token()
+        google_keys.verify_id_token(token, audience=settings.GOOGLE_CLIENT_ID)
+        self.standin.fail_keys = True
+        self.assertEqual(google_keys.verify_id_token(token, audience=settings.GOOGLE_CLIENT_ID)['sub'], '1234567890')
+
+    def test_expired_keys_are_served_stale_when_refresh_fails(self):
+        token = self.standin.issue_id_token()
+        google_keys.verify_id_token(token, audience=settings.GOOGLE_CLIENT_ID)
+        for document in (google_keys.discovery, google_keys.jwks):
+            document._entry = {**document._entry, 'refresh_at': 0, 'expires_at': 0} # Past its max-age
+        cache.clear()
+        self.standin.fail_keys = True
+        with self.assertLogs('accounts.google_keys', 'WARNING') as logs:
+            self.assertEqual(google_keys.verify_id_token(token, audience=settings.GOOGLE_CLIENT_ID)['sub'], '1234567890')
+        self.assertIn('Serving stale jwks', '\n'.join(logs.output))
+
+    def test_keys_are_not_served_without_a_cached_copy(self):
+        self.standin.fail_keys = True
+        with self.assertRaises(google_keys.KeyFetchError):
+            google_keys.verify_id_token(self.standin.issue_id_token(), audience=settings.GOOGLE_CLIENT_ID)
+
+
+class RefreshTokenTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username='ada', email='ada@example.com')
+        self.factory = RequestFactory()
+
+    def test_rotation_issues_new_tokens_and_uses_up_the_old_one(self):
+        issued = tokens.issue_tokens(self.user)
+        rotated = tokens.rotate_refresh_token(issued['refresh'])
+        self.assertNotEqual(rotated['refresh'], issued['refresh'])
+        old = RefreshToken.objects.get(jti=tokens.decode_token(issued['refresh'], 'refresh')['jti'])
+        self.assertIsNotNone(old.used_at)
+        claims = tokens.verify_access_token(rotated['access'])
+        self.assertEqual(claims['sub'], str(self.user.pk))
+        self.assertEqual(claims['sid'], tokens.decode_token(issued['access'], 'access')['sid']) # Same login
+
+    def test_reused_refresh_token_revokes_its_login(self):
+        issued = tokens.issue_tokens(self.user)
+        rotated = tokens.rotate_refresh_token(issued['refresh'])
+        with self.assertLogs('accounts.tokens', 'WARNING'), self.assertRaises(tokens.TokenError):
+            tokens.rotate_refresh_token(issued['refresh'])
+        with self.assertRaises(tokens.TokenError):
+            tokens.rotate_refresh_token(rotated['refresh']) # The latest token is revoked too
+        with self.assertRaisesMessage(tokens.TokenError, 'Token has been revoked.'):
+            tokens.verify_access_token(rotated['access'])
+        self.assertFalse(RefreshToken.objects.filter(user=self.user, revoked_at__isnull=True).exists())
+
+    def test_other_logins_survive_a_reuse(self):
+        other = tokens.issue_tokens(self.user)
+        issued = tokens.issue_tokens(self.user)
+        tokens.rotate_refresh_token(issued['refresh'])
+        with self.assertLogs('accounts.tokens', 'WARNING'), self.assertRaises(tokens.TokenError):
+            tokens.rotate_refresh_token(issued['refresh'])
+        tokens.verify_access_token(other['access'])
+        tokens.rotate_refresh_token(other['refresh'])
+
+    def test_access_token_is_not_a_refresh_token(self):
+        issued = tokens.issue_tokens(self.user)
+        with self.assertRaisesMessage(tokens.TokenError, 'Invalid refresh token.'):
+            tokens.rotate_refresh_token(issued['access'])
+
+    def test_inactive_user_cannot_refresh(self):
+        issued = tokens.issue_tokens(self.user)
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(tokens.TokenError):
+            tokens.rotate_refresh_token(issued['refresh'])
+
+    def test_logout_with_access_token_revokes_the_login(self):
+        issued = tokens.issue_tokens(self.user)
+        request = self.factory.post('/accounts/token/logout/', HTTP_AUTHORIZATION=f'Bearer {issued["access"]}')
+        self.assertEqual(token_logout(request).status_code, 204)
+        with self.assertRaises(tokens.TokenError):
+            tokens.verify_access_token(issued['access'])
+        response = token_refresh(self.factory.post('/accounts/token/refresh/', {'refresh': issued['refresh']}))
+        self.assertEqual(response.status_code, 401)
+
+    def test_logout_without_a_valid_token_is_rejected(self):
+        request = self.factory.post('/accounts/token/logout/', HTTP_AUTHORIZATION='Bearer not-a-token')
+        self.assertEqual(token_logout(request).status_code, 401)
+
+    def test_revocation_reaches_other_workers_through_the_cache(self):
+        issued = tokens.issue_tokens(self.user)
+        family = tokens.decode_token(issued['access'], 'access')['sid']
+        other_worker = tokens.RevocationList()
+        self.assertFalse(other_worker.is_revoked(family))
+        tokens.revoke_family(family)
+        other_worker.sync()
+        self.assertTrue(other_worker.is_revoked(family))
+
+
+class LoginFlightTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def client_request(self, csrf_cookie='client-a'):
+        request = self.factory.post(LOGIN_URL)
+        if csrf_cookie:
+            request.COOKIES[settings.CSRF_COOKIE_NAME] = csrf_cookie
+        return request
+
+    def test_repeated_code_waits_for_the_first_login(self):
+        first = concurrency.LoginFlight(self.client_request(), 'code')
+        second = concurrency.LoginFlight(self.client_request(), 'code')
+        self.assertTrue(first.start())
+        self.assertFalse(second.start())
+        first.finish(user_id=7)
+        self.assertEqual(second.wait(timeout=1), ('ok', 7))
+        self.assertIsNone(cache.get(first.key)) # No other worker was waiting
+
+    def test_error_is_shared_with_the_waiting_request(self):
+        first = concurrency.LoginFlight(self.client_request(), 'code')
+        second = concurrency.LoginFlight(self.client_request(), 'code')
+        first.start()
+        second.start()
+        first.finish(error='Incorrect value')
+        self.assertEqual(second.wait(timeout=1), ('error', 'Incorrect value'))
+
+    def test_abandoned_login_stops_the_wait(self):
+        first = concurrency.LoginFlight(self.client_request(), 'code')
+        second = concurrency.LoginFlight(self.client_request(), 'code')
+        first.start()
+        second.start()
+        first.abandon()
+        self.assertIsNone(second.wait(timeout=1))
+
+    def test_login_in_another_worker_is_read_from_the_cache_once(self):
+        key = concurrency.LoginFlight(self.client_request(), 'code').key
+        cache.set(key, concurrency.PENDING) # Started by another worker
+        waiter = concurrency.LoginFlight(self.client_request(), 'code')
+        self.assertFalse(waiter.start())
+        cache.set(key, ('ok', 7)) # The other worker finished, with a request waiting
+        self.assertEqual(waiter.wait(timeout=1), ('ok', 7))
+        self.assertIsNone(cache.get(key)) # Deleted by the last waiting request
+
+    def test_login_that_ends_while_joining_it_is_run_again(self):
+        key = concurrency.LoginFlight(self.client_request(), 'code').key
+        cache.set(key, concurrency.PENDING)
+        with mock.patch.object(caches['default'], 'incr', side_effect=ValueError): # The waiters count expired
+            self.assertTrue(concurrency.LoginFlight(self.client_request(), 'code').start())
+
+    def test_other_clients_and_requests_without_cookies_are_not_coalesced(self):
+        first = concurrency.LoginFlight(self.client_request(), 'code')
+        self.assertTrue(first.start())
+        self.assertTrue(concurrency.LoginFlight(self.client_request('client-b'), 'code').start())
+        self.assertTrue(concurrency.LoginFlight(self.client_request(csrf_cookie=None), 'code').start())
+        first.abandon()
+
+    def test_finished_login_does_not_share_its_result(self):
+        first = concurrency.LoginFlight(self.client_request(), 'code')
+        first.start()
+        first.finish(user_id=7)
+        replay = concurrency.LoginFlight(self.client_request(), 'code')
+        self.assertTrue(replay.start()) # Exchanged again, and rejected by Google
+        replay.finish(error='Failed to exchange code for access token')
+
+
+@override_settings(LOGIN_CONCURRENCY_LIMIT=1, LOGIN_RETRY_AFTER=2)
+class LoginLimiterTests(TestCase):
+
+    def test_logins_over_the_limit_are_shed(self):
+        limiter = concurrency.LoginLimiter()
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        limiter.release()
+        self.assertTrue(limiter.try_acquire())
+
+    @override_settings(LOGIN_CONCURRENCY_LIMIT=0)
+    def test_zero_means_no_limit(self):
+        limiter = concurrency.LoginLimiter()
+        self.assertTrue(all(limiter.try_acquire() for _ in range(100)))
+
+    def test_shed_login_gets_503_with_retry_after(self):
+        self.assertTrue(concurrency.login_limiter.try_acquire())
+        self.addCleanup(concurrency.login_limiter.release)
+        for url in (LOGIN_URL, f'{LOGIN_URL}async/'):
+            response = self.client.post(url, {'code': 'code'})
+            self.assertEqual(response.status_code, 503)
+            self.assertIn(int(response['Retry-After']), range(2, 5))
+
+
+class GoogleLoginTests(StandInTestCase):
+
+    def login(self, code, url=LOGIN_URL):
+        return self.client.post(url, {'code': code})
+
+    def test_code_logs_the_user_in(self):
+        response = self.login(self.standin.issue_code(subject='ada', email='ada@example.com'))
+        self.assertEqual(response.status_code, 204, response.content)
+        self.assertEqual(self.client.get('/accounts/check-auth/').json(), {'authenticated': True})
+        self.assertTrue(get_user_model().objects.filter(email='ada@example.com').exists())
+
+    def test_replayed_code_is_rejected(self):
+        for url in (LOGIN_URL, f'{LOGIN_URL}async/'):
+            with self.subTest(url=url):
+                code = self.standin.issue_code(subject='ada', email='ada@example.com')
+                self.assertEqual(self.login(code, url).status_code, 204)
+                self.client.logout()
+                self.assertEqual(self.login(code, url).status_code, 400) # Used up once the first login finished
+                self.assertEqual(self.standin.hits[TOKEN_PATH], 2)
+                self.standin.hits.clear()
+
+
+
+# Google app stored in the database instead of settings, so the logins store their tokens.
+@override_settings(SOCIALACCOUNT_PROVIDERS={'google': {}}, SOCIALACCOUNT_STORE_TOKENS=True)
+class LoginPersistenceTests(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        app = SocialApp.objects.create(provider='google', name='Google', client_id=settings.GOOGLE_CLIENT_ID, secret='secret')
+        app.sites.add(Site.objects.get_current())
+
+    # Log in with a code. The stand-in's access tokens are all the same, as if Google resent the same one.
+    def login(self, **identity):
+        code = self.standin.issue_code(subject='ada', email='ada@example.com', **identity)
+        with mock.patch('accounts.google_standin.secrets.token_urlsafe', return_value='access-token'):
+            return self.client.post(LOGIN_URL, {'code': code})
+
+    def test_returning_login_with_unchanged_data_skips_the_account_and_token_writes(self):
+        self.assertEqual(self.login().status_code, 204)
+        self.assertEqual(SocialToken.objects.get().token, 'access-token')
+        self.client.logout()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.login().status_code, 204)
+        writes = [query['sql'] for query in queries if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertFalse([sql for sql in writes if 'socialaccount_' in sql], writes)
+
+    def test_changed_claims_are_written(self):
+        self.login()
+        self.client.logout()
+        self.login(name='Ada Lovelace')
+        self.assertEqual(SocialAccount.objects.get().extra_data['name'], 'Ada Lovelace')
+        self.assertEqual(get_user_model().objects.get().display_name, 'Ada Lovelace')
+
+    def test_failed_login_writes_nothing(self):
+        self.login()
+        self.client.logout()
+        with mock.patch('accounts.adapters.SocialAccountAdapter.pre_social_login', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            self.login(name='Ada Lovelace') # Fails after its extra_data was saved
+        self.assertEqual(SocialAccount.objects.get().extra_data['name'], 'Stand-in User')
+
+
+class ImportUsersTests(TestCase):
+
+    def import_lines(self, *lines):
+        stream = io.StringIO(''.join(f'{line if isinstance(line, str) else json.dumps(line)}\n' for line in lines))
+        return provisioning.import_users(stream)
+
+    def test_bad_records_are_counted_and_the_rest_imported(self):
+        get_user_model().objects.create_user(username='existing', email='existing@example.com')
+        stats = self.import_lines(
+            {'username': 'ada', 'email': 'ada@example.com', 'email_verified': True, 'google': {'uid': '1', 'extra_data': {'name': 'Ada'}}},
+            '{"username": "broken"', # Malformed JSON
+            ['not', 'an', 'object'],
+            {'email': 'nobody@example.com'}, # No username
+            {'username': 'x' * 151}, # Too long
+            {'username': 'bad-email', 'email': 'not an email'},
+            {'username': 'bad-extra', 'google': {'uid': '2', 'extra_data': 'not an object'}},
+            {'username': 'existing'}, # Duplicate of a stored user
+            {'username': 'grace', 'email': 'grace@example.com'},
+        )
+        self.assertEqual((stats.read, stats.created, stats.skipped, stats.invalid), (9, 2, 1, 6))
+        self.assertEqual(len(stats.errors), 6)
+        ada = get_user_model().objects.get(username='ada')
+        self.assertEqual(ada.display_name, 'Ada')
+        self.assertTrue(EmailAddress.objects.get(user=ada).verified)
+        self.assertEqual(SocialAccount.objects.get(user=ada).uid, '1')
+        self.assertFalse(get_user_model().objects.filter(username__in=['bad-email', 'bad-extra']).exists())
+
+    def test_user_created_meanwhile_gets_none_of_the_records_rows(self):
+        other = get_user_model().objects.create_user(username='ada')
+        created = provisioning._bulk_insert([get_user_model()(username='ada'), get_user_model()(username='grace')])
+        self.assertEqual(list(created), ['grace'])
+        self.assertNotIn(other.pk, created.values())
+
+
+class CachedUserTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username='ada', email='ada@example.com', password='first password')
+        self.client.force_login(self.user)
+        self.factory = RequestFactory()
+
+    def request(self):
+        request = self.factory.get('/')
+        request.session = self.client.session
+        request.session.keys() # Loads the session, so only the user lookup is counted
+        return request
+
+    def cached_user(self):
+        return middleware.get_cached_user(self.request())
+
+    def test_cached_user_needs_no_queries(self):
+        self.cached_user()
+        request = self.request()
+        with self.assertNumQueries(0):
+            user = middleware.get_cached_user(request)
+        self.assertEqual((user.pk, user.username, user.email), (self.user.pk, 'ada', 'ada@example.com'))
+
+    def test_snapshot_leaves_out_the_password_and_session_hash(self):
+        self.cached_user()
+        entry = cache.get(middleware.user_cache_key(self.user.pk))
+        self.assertNotIn(self.user.password, entry[2])
+        self.assertNotEqual(entry[1], self.client.session[HASH_SESSION_KEY])
+
+    def test_save_drops_the_snapshot(self):
+        self.cached_user()
+        self.user.first_name = 'Ada'
+        self.user.save()
+        self.assertEqual(self.cached_user().first_name, 'Ada')
+
+    def test_delete_drops_the_snapshot(self):
+        self.cached_user()
+        self.user.delete()
+        self.assertIsInstance(self.cached_user(), AnonymousUser)
+
+    def test_password_change_logs_the_session_out(self):
+        self.cached_user()
+        self.user.set_password('second password')
+        self.user.save()
+        self.assertIsInstance(self.cached_user(), AnonymousUser)
+
+    def test_session_with_another_hash_is_logged_out(self):
+        self.cached_user()
+        session = self.client.session
+        session[HASH_SESSION_KEY] = 'another hash'
+        session.save()
+        self.assertIsInstance(self.cached_user(), AnonymousUser)
+
+    def test_user_read_before_a_change_is_not_served(self):
+        get_user = auth.get_user
+
+        # The user is changed after this request read it, before it caches it
+        def get_user_then_change(request):
+            user = get_user(request)
+            changed = get_user_model().objects.get(pk=self.user.pk)
+            changed.first_name = 'Ada'
+            changed.save()
+            return user
+
+        with mock.patch.object(auth, 'get_user', get_user_then_change):
+            self.assertEqual(self.cached_user().first_name, '')
+        self.assertEqual(self.cached_user().first_name, 'Ada')
+
+
+class BootstrapTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='ada', email='ada@example.com')
+
+    def bootstrap(self, etag=None):
+        return self.client.get(BOOTSTRAP_URL, **({'HTTP_IF_NONE_MATCH': etag} if etag else {}))
+
+    def test_matching_etag_gets_an_empty_304(self):
+        etag = self.bootstrap()['ETag']
+        response = self.bootstrap(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_response_is_private_and_always_revalidated(self):
+        response = self.bootstrap()
+        self.assertEqual(set(response['Cache-Control'].split(', ')), {'private', 'no-cache'})
+        self.assertEqual(self.bootstrap(response['ETag'])['Cache-Control'], response['Cache-Control'])
+
+    def test_login_profile_change_and_logout_change_the_etag(self):
+        anonymous = self.bootstrap()
+        self.assertEqual(anonymous.json()['authenticated'], False)
+        self.client.force_login(self.user)
+        logged_in = self.bootstrap(anonymous['ETag'])
+        self.assertEqual(logged_in.status_code, 200)
+        self.assertEqual(logged_in.json()['user']['username'], 'ada')
+
+        self.user.first_name = 'Ada'
+        self.user.save()
+        edited = self.bootstrap(logged_in['ETag'])
+        self.assertEqual(edited.status_code, 200)
+        self.assertEqual(edited.json()['user']['first_name'], 'Ada')
+
+        self.client.logout()
+        logged_out = self.bootstrap(edited['ETag'])
+        self.assertEqual(logged_out.status_code, 200)
+        self.assertEqual((logged_out.json()['authenticated'], logged_out.json()['user']), (False, None))
+        self.assertEqual(len({anonymous['ETag'], logged_in['ETag'], edited['ETag'], logged_out['ETag']}), 4)
+
+
+class ProfileVersionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username='ada', email='ada@example.com')
+        self.client.force_login(self.user)
+
+    def stored_version(self):
+        return get_user_model().objects.get(pk=self.user.pk).profile_version
+
+    def test_changing_a_me_field_bumps_the_version_and_the_me_response(self):
+        self.assertEqual(self.client.get(ME_URL).json()['display_name'], '')
+        version = self.stored_version()
+        self.user.display_name = 'Ada Lovelace'
+        self.user.save(update_fields=['display_name'])
+        self.assertEqual(self.stored_version(), version + 1)
+        response = self.client.get(ME_URL)
+        self.assertEqual(response.json()['display_name'], 'Ada Lovelace')
+        self.assertEqual(response['ETag'], f'"{self.user.pk}.{version + 1}"')
+
+    def test_unrelated_save_keeps_the_version(self):
+        etag = self.client.get(ME_URL)['ETag']
+        version = self.stored_version()
+        self.user.is_staff = True
+        self.user.save(update_fields=['is_staff'])
+        self.user.display_name = 'Not saved' # Changed, but not in update_fields
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual(self.stored_version(), version)
+        self.assertEqual(self.client.get(ME_URL, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_backfill_copies_the_google_profile(self):
+        SocialAccount.objects.create(user=self.user, provider='google', uid='1', extra_data={'name': 'Ada Lovelace', 'locale': 'en-GB'})
+        unchanged = get_user_model().objects.create_user(username='grace', display_name='Grace', locale='en')
+        SocialAccount.objects.create(user=unchanged, provider='google', uid='2', extra_data={'name': 'Grace', 'locale': 'en'})
+        version = self.stored_version()
+        stdout = io.StringIO()
+        call_command('backfill_google_profiles', batch_size=1, stdout=stdout)
+        user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertEqual((user.display_name, user.locale, user.profile_version), ('Ada Lovelace', 'en-GB', version + 1))
+        self.assertEqual(get_user_model().objects.get(pk=unchanged.pk).profile_version, unchanged.profile_version)
+        self.assertIn('2 social accounts scanned, 1 users updated', stdout.getvalue())
+        self.assertEqual(self.client.get(ME_URL).json()['display_name'], 'Ada Lovelace')
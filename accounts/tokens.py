@@ -0,0 +1,281 @@
+"""
+Tokens.py file for accounts app. Signed access and refresh tokens for the
+stateless authentication mode (STATELESS_AUTH).
+
+Access tokens are short-lived and verified from their signature alone, so
+API requests need no session, user, or cache lookup. Refresh tokens are
+rotated on every use and stored in the database, so a reused refresh token
+revokes its whole login. Logouts are spread to every worker through a
+compact revocation list kept in memory.
+"""
+
+# Import required libraries for signing, storing, and revoking tokens
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+import jwt
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from .events import family_group, publish
+from .models import RefreshToken
+
+logger = logging.getLogger(__name__)
+
+
+#------- [Variables] -------#
+
+ALGORITHM = 'HS256'
+
+# Workers pick up logouts from other workers this often.
+REVOCATION_SYNC_SECONDS = 5
+
+# Recent revocations read again on each sync, in case one was numbered but not yet stored.
+REVOCATION_SYNC_OVERLAP = 50
+
+# Revocations read per cache call when a worker first loads the list.
+REVOCATION_SYNC_CHUNK = 500
+
+REVOCATION_GENERATION_KEY = 'accounts:revocations:generation'
+
+
+#------- [Classes] -------#
+
+class TokenError(Exception):
+    pass
+
+
+class TokenUser:
+    """
+    The user an access token was issued to, built from the token's claims
+    without a database query. Call get_user() for the full user object.
+    """
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, claims):
+        self.claims = claims
+        self.pk = self.id = int(claims['sub'])
+        self.username = claims.get('username', '')
+        self.email = claims.get('email', '')
+        self.is_staff = claims.get('staff', False)
+        self.is_superuser = claims.get('superuser', False)
+        self.profile_version = claims.get('pv', 0)
+
+    def __str__(self):
+        return self.username
+
+    def get_user(self):
+        return get_user_model().objects.get(pk=self.pk)
+
+
+class RevocationList:
+    """
+    Token families (logins) revoked on logout. Each worker keeps the list in
+    memory and syncs it from the shared cache in a background thread, so
+    checking an access token needs no cache hit. Revocations are stored in
+    the cache as numbered entries, and each entry is only kept for as long as
+    an access token issued before the logout could still be valid.
+    """
+
+    def __init__(self):
+        self._revoked = {} # Family -> time the entry can be dropped
+        self._seen = 0 # Last revocation number read from the cache
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def revoke(self, family):
+        expires_at = time.time() + settings.STATELESS_ACCESS_TOKEN_LIFETIME
+        with self._lock: # Not while a sync replaces the list, which would drop it
+            self._revoked[family] = expires_at
+        cache.add(REVOCATION_GENERATION_KEY, 0, timeout=None) # Create the counter if missing
+        number = cache.incr(REVOCATION_GENERATION_KEY)
+        cache.set(revocation_key(number), (family, expires_at), timeout=settings.STATELESS_ACCESS_TOKEN_LIFETIME)
+
+    def is_revoked(self, family):
+        if self._pid != os.getpid():
+            self._start()
+        expires_at = self._revoked.get(family)
+        return expires_at is not None and expires_at > time.time()
+
+    def sync(self):
+        with self._lock:
+            generation = cache.get(REVOCATION_GENERATION_KEY, 0)
+            if generation < self._seen:
+                self._seen = 0 # The cache was cleared
+            if self._seen:
+                numbers = range(max(self._seen - REVOCATION_SYNC_OVERLAP, 0) + 1, generation + 1)
+                entries = list(cache.get_many([revocation_key(number) for number in numbers]).values())
+            else:
+                entries = self._load_recent(generation)
+            now = time.time()
+            revoked = {family: expires_at for family, expires_at in self._revoked.items() if expires_at > now}
+            revoked.update((family, expires_at) for family, expires_at in entries if expires_at > now)
+            self._revoked = revoked
+            self._seen = generation
+
+    # Read revocations newest first until reaching ones that have already expired from the cache.
+    def _load_recent(self, generation):
+        entries = []
+        end = generation
+        while end > 0:
+            numbers = range(max(end - REVOCATION_SYNC_CHUNK, 0) + 1, end + 1)
+            found = cache.get_many([revocation_key(number) for number in numbers])
+            entries.extend(found.values())
+            if len(found) < len(numbers):
+                break
+            end = numbers.start - 1
+        return entries
+
+    # Load the list and start the background sync. Runs once in each worker process.
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._seen = 0
+        self.sync()
+        threading.Thread(target=self._sync_forever, name='revocation-sync', daemon=True).start()
+
+    def _sync_forever(self):
+        while True:
+            time.sleep(REVOCATION_SYNC_SECONDS)
+            try:
+                self.sync()
+            except Exception:
+                logger.warning('Syncing the token revocation list failed.', exc_info=True)
+
+
+#------- [Functions] -------#
+
+def revocation_key(number):
+    return f'accounts:revocations:{number}'
+
+# Signing key derived from SECRET_KEY, so tokens cannot be forged with other signed values.
+@functools.lru_cache(maxsize=2)
+def get_signing_key(secret_key):
+    return salted_hmac('accounts.tokens', 'signing key', secret=secret_key).digest()
+
+def encode_token(claims, lifetime):
+    now = int(time.time())
+    payload = {**claims, 'iat': now, 'exp': now + lifetime}
+    return jwt.encode(payload, get_signing_key(settings.SECRET_KEY), algorithm=ALGORITHM)
+
+def decode_token(token, token_type):
+    try:
+        claims = jwt.decode(
+            token,
+            key=get_signing_key(settings.SECRET_KEY),
+            algorithms=[ALGORITHM],
+            options={'require': ['exp', 'iat', 'sub', 'sid', 'typ']},
+        )
+    except jwt.PyJWTError as e:
+        raise TokenError(f'Invalid {token_type} token.') from e
+    if claims['typ'] != token_type:
+        raise TokenError(f'Invalid {token_type} token.')
+    return claims
+
+# Read the token from an "Authorization: Bearer <token>" header, or return None.
+def get_bearer_token(request):
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return token.strip()
+
+# Verify an access token in CPU only (signature, expiry, and the in-memory revocation list).
+def verify_access_token(token):
+    claims = decode_token(token, 'access')
+    if revocations.is_revoked(claims['sid']):
+        raise TokenError('Token has been revoked.')
+    return claims
+
+# Issue an access token and a new refresh token for a user. Tokens from one
+# login share a family, so they can be revoked together.
+def issue_tokens(user, family=None):
+    family = family or uuid.uuid4().hex
+    jti = uuid.uuid4().hex
+    lifetime = settings.STATELESS_REFRESH_TOKEN_LIFETIME
+    RefreshToken.objects.create(
+        jti=jti,
+        family=family,
+        user=user,
+        expires_at=timezone.now() + timedelta(seconds=lifetime),
+    )
+    access = encode_token({
+        'typ': 'access',
+        'sub': str(user.pk),
+        'sid': family,
+        'username': user.get_username(),
+        'email': user.email,
+        'staff': user.is_staff,
+        'superuser': user.is_superuser,
+        'pv': user.profile_version, # Lets /accounts/me/ find the cached profile without a query
+    }, settings.STATELESS_ACCESS_TOKEN_LIFETIME)
+    refresh = encode_token({'typ': 'refresh', 'sub': str(user.pk), 'sid': family, 'jti': jti}, lifetime)
+    return {
+        'access': access,
+        'refresh': refresh,
+        'access_expires_in': settings.STATELESS_ACCESS_TOKEN_LIFETIME,
+    }
+
+# Response data for a completed Google login in stateless mode. allauth logs the
+# user in to the session while completing the login, which is dropped here.
+def issue_login_tokens(request, user):
+    request.session.flush()
+    return issue_tokens(user)
+
+# Exchange a refresh token for new tokens. The old refresh token is used up, and
+# presenting it again means it was copied, so its whole family is revoked.
+def rotate_refresh_token(token):
+    claims = decode_token(token, 'refresh')
+    with transaction.atomic():
+        stored = RefreshToken.objects.select_for_update().select_related('user').filter(jti=claims.get('jti')).first()
+        if stored is None or stored.revoked_at is not None or not stored.user.is_active:
+            raise TokenError('Invalid refresh token.')
+        reused = stored.used_at is not None
+        if not reused:
+            stored.used_at = timezone.now()
+            stored.save(update_fields=['used_at'])
+            return issue_tokens(stored.user, family=stored.family)
+    logger.warning('Refresh token reused, revoking its login (user %s).', stored.user_id)
+    revoke_family(stored.family)
+    raise TokenError('Invalid refresh token.')
+
+# Log out a token family: its refresh tokens stop working at once, its access tokens
+# within REVOCATION_SYNC_SECONDS on every worker.
+def revoke_family(family):
+    RefreshToken.objects.filter(family=family, revoked_at__isnull=True).update(revoked_at=timezone.now())
+    revocations.revoke(family)
+    publish(family_group(family), 'logout')
+
+# Revoke the login of the access token (or refresh token) sent with a request, if any.
+# Expired tokens are still revoked, since their refresh token may be valid.
+def revoke_request_tokens(request, refresh_token=None):
+    for token, token_type in ((get_bearer_token(request), 'access'), (refresh_token, 'refresh')):
+        if not token:
+            continue
+        try:
+            claims = jwt.decode(token, key=get_signing_key(settings.SECRET_KEY), algorithms=[ALGORITHM], options={'verify_exp': False})
+        except jwt.PyJWTError:
+            continue
+        if claims.get('typ') == token_type and claims.get('sid'):
+            revoke_family(claims['sid'])
+            return True
+    return False
+
+
+#------- [Instances] -------#
+
+# Revoked token families in this worker.
+revocations = RevocationList()
@@ -6,15 +6,119 @@ Date: 2024-06-01
 """
 
 # Import required libraries for Google OAuth
-from allauth.socialaccount.providers.google.views import GoogleOAuth2Adapter
-from allauth.socialaccount.providers.oauth2.client import OAuth2Client
+from allauth.socialaccount.providers.oauth2.client import OAuth2Error
+from dj_rest_auth.registration.serializers import SocialLoginSerializer
 from dj_rest_auth.registration.views import SocialLoginView
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.response import Response
+from .adapters import GoogleOAuth2Adapter
+from .concurrency import LoginFlight, login_limiter, overloaded_response
+from .login import LoginError, finish_social_login, resume_social_login
+from .oauth_client import OAuth2Client
+from .tokens import issue_login_tokens
+
+# dj-rest-auth's social login serializer for Google, with the login persisted and the
+# user logged in by finish_social_login (one transaction, unchanged rows not written).
+# Requests from the same client repeating an authorization code wait for the first
+# one's login while it is in progress.
+class GoogleLoginSerializer(SocialLoginSerializer):
+
+    def validate(self, attrs):
+        request = self._get_request()
+        if not attrs.get('code'):
+            attrs['user'] = self.google_login(attrs)
+            return attrs
+
+        flight = LoginFlight(request, attrs['code'])
+        if not flight.start():
+            result = flight.wait()
+            if result is None:
+                raise serializers.ValidationError('Failed to exchange code for access token')
+            outcome, value = result
+            if outcome == 'error':
+                raise serializers.ValidationError(value)
+            try:
+                attrs['user'] = resume_social_login(request, value)
+            except LoginError as e:
+                raise serializers.ValidationError(str(e))
+            return attrs
+
+        try:
+            attrs['user'] = self.google_login(attrs)
+        except serializers.ValidationError as e:
+            flight.finish(error=str(e.detail[0]))
+            raise
+        except BaseException:
+            flight.abandon()
+            raise
+        flight.finish(user_id=attrs['user'].pk)
+        return attrs
+
+    def google_login(self, attrs):
+        view = self.context['view']
+        request = self._get_request()
+        adapter = view.adapter_class(request)
+        app = adapter.get_provider().get_app(request)
+
+        # Case 1: Exchange the authorization code for tokens
+        if attrs.get('code'):
+            self.set_callback_url(view=view, adapter_class=view.adapter_class)
+            scope = adapter.get_provider().get_scope(request)
+            client = view.client_class(
+                request, app.client_id, app.secret, adapter.access_token_method, adapter.access_token_url,
+                self.callback_url, scope, scope_delimiter=adapter.scope_delimiter, headers=adapter.headers, basic_auth=adapter.basic_auth,
+            )
+            try:
+                token = client.get_access_token(attrs['code'])
+            except OAuth2Error as ex:
+                raise serializers.ValidationError('Failed to exchange code for access token') from ex
+            response = token
+            tokens_to_parse = {key: token[key] for key in ('access_token', 'refresh_token', 'id_token', adapter.expires_in_key) if key in token}
+
+        # Case 2: The client sent the id_token directly (as access_token)
+        elif attrs.get('access_token'):
+            response = {'id_token': attrs['access_token']}
+            tokens_to_parse = {'access_token': attrs['access_token']}
+        else:
+            raise serializers.ValidationError('Incorrect input. access_token or code is required.')
+
+        social_token = adapter.parse_token(tokens_to_parse)
+        social_token.app = app
+        try:
+            login = self.get_social_login(adapter, app, social_token, response)
+        except OAuth2Error as ex:
+            raise serializers.ValidationError('Incorrect value') from ex
+        try:
+            return finish_social_login(request, login)
+        except LoginError as e:
+            raise serializers.ValidationError(str(e))
 
 # Create a GoogleLogin class to handle the Google OAuth login
 class GoogleLogin(SocialLoginView):
     adapter_class = GoogleOAuth2Adapter
     callback_url = 'http://localhost:8000/accounts/dj-rest-auth/google/'
     client_class = OAuth2Client
+    serializer_class = GoogleLoginSerializer
+
+    # Each worker runs at most LOGIN_CONCURRENCY_LIMIT logins, and sheds the rest at once.
+    def post(self, request, *args, **kwargs):
+        if not login_limiter.try_acquire():
+            return overloaded_response()
+        try:
+            return super().post(request, *args, **kwargs)
+        finally:
+            login_limiter.release()
+
+    # The serializer has already logged the user in.
+    def process_login(self):
+        pass
+
+    # In stateless mode, respond with signed tokens instead of the session login.
+    def get_response(self):
+        if settings.STATELESS_AUTH:
+            return Response(issue_login_tokens(self.request, self.user))
+        return super().get_response()
 
 # Import required libraries for settings urls
 from django.urls import path
@@ -23,8 +127,18 @@ from . import views
 # Urls for accounts app
 urlpatterns = [
     path('dj-rest-auth/google/', GoogleLogin.as_view(), name='google_login'), # Google OAuth login
+    path('dj-rest-auth/google/async/', views.google_login_async, name='google_login_async'), # Google OAuth login on the event loop
     path('login/', views.custom_google_login, name='login'), # Custom login page
     path('logout/', views.custom_logout, name='logout'), # Custom logout page
     path('check-auth/', views.check_auth, name='check_auth'), # Check auth status
     path('get-csrf-token/', views.get_csrf_token, name='get_csrf_token'), # Get CSRF token
+    path('bootstrap/', views.bootstrap, name='bootstrap'), # Auth status, CSRF token, and profile in one request
+    path('me/', views.me, name='me'), # Profile of the logged in user, including the Google profile
 ]
+
+# Token endpoints for the stateless authentication mode
+if settings.STATELESS_AUTH:
+    urlpatterns += [
+        path('token/refresh/', views.token_refresh, name='token_refresh'), # Rotate the refresh token
+        path('token/logout/', views.token_logout, name='token_logout'), # Revoke the tokens of a login
+    ]
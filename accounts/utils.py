@@ -0,0 +1,27 @@
+"""
+Utils.py file for accounts app. Helper functions
+shared by the account views.
+"""
+
+# Import required libraries for async user resolution
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+
+
+#------- [Functions] -------#
+
+# Force the lazy request.user and return the resolved user object.
+def _resolve_user(request):
+    user = request.user
+    user.is_authenticated # Evaluates the SimpleLazyObject (session + user lookup)
+    return user
+
+# Resolve request.user from an async view.
+# Requests without a session cookie cannot be authenticated, so they are answered
+# on the event loop. Otherwise the session and user are loaded in one thread hop,
+# since Django 4.0 has no async session or ORM API.
+async def aget_user(request):
+    if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+        return AnonymousUser()
+    return await sync_to_async(_resolve_user)(request)
@@ -6,30 +6,285 @@ Date: 2024-06-01
 """
 
 # Import required libraries for render, redirect, and logout
-from django.shortcuts import render
+import asyncio
+import hashlib
+import json
+
+import jwt
+from asgiref.sync import sync_to_async
 from django.shortcuts import redirect
+from django.conf import settings
 from django.contrib.auth import logout
-from django.http import JsonResponse
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
 from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST, require_safe
+from djgoprod.db import primary_database
+from djgoprod.pages import render_anonymous_page
+
+from . import google_keys
+from .adapters import GoogleOAuth2Adapter
+from .concurrency import LoginFlight, login_limiter, overloaded_response
+from .login import LoginError, finish_social_login, resume_social_login
+from .oauth_client import async_http_request
+from .tokens import TokenError, TokenUser, get_bearer_token, issue_login_tokens, revoke_request_tokens, rotate_refresh_token, verify_access_token
+from .utils import aget_user
 
 
 # View for logging in with google
 def custom_google_login(request):
     if request.user.is_authenticated: # If the user is already logged in, redirect to "/". Note: Update "/" if is not the home page.
         return redirect("/")
-    return render(request, 'login.html')
+    return render_anonymous_page(request, 'login.html') # Cached, see djgoprod/pages.py
 
-# View for logging out
+# View for logging out. Writes on GET, so it reads from the primary database.
+@primary_database
 def custom_logout(request):
     logout(request) # Logout the user
+    if settings.STATELESS_AUTH:
+        revoke_request_tokens(request) # Also revoke a signed token sent with the request
     return redirect("/")
 
-# View to check auth
-def check_auth(request):
-    if request.user.is_authenticated:
+# View to check auth. Async so frequent SPA polls are served by the event loop.
+async def check_auth(request):
+    token = get_bearer_token(request) if settings.STATELESS_AUTH else None
+    if token is not None:
+        try:
+            verify_access_token(token) # CPU only, no thread hop needed
+            return JsonResponse({'authenticated': True})
+        except TokenError:
+            return JsonResponse({'authenticated': False}, status=403)
+    user = await aget_user(request)
+    if user.is_authenticated:
         return JsonResponse({'authenticated': True})
     else:
         return JsonResponse({'authenticated': False}, status=403)
 
-def get_csrf_token(request):
+# View to get the CSRF token. Async since get_token only reads and sets the CSRF cookie.
+async def get_csrf_token(request):
     return JsonResponse({'csrfToken': get_token(request)})
+
+# Basic profile of the user returned by bootstrap.
+def _profile(user):
+    return {'id': user.pk, 'username': user.username, 'email': user.email, 'first_name': getattr(user, 'first_name', ''), 'last_name': getattr(user, 'last_name', '')}
+
+# View for SPA startup. Returns auth status, the CSRF token, and the basic profile in one
+# round trip. The strong ETag is derived from the session (or token login), the CSRF
+# secret, and the profile, so a client that sends If-None-Match gets an empty 304 until
+# one of them changes. Any masked CSRF token for the same secret stays valid.
+async def bootstrap(request):
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    token = get_bearer_token(request) if settings.STATELESS_AUTH else None
+    if token is not None:
+        try:
+            claims = verify_access_token(token) # CPU only, no thread hop needed
+            user, login_key = TokenUser(claims), claims['sid']
+        except TokenError:
+            user, login_key = AnonymousUser(), ''
+    else:
+        user = await aget_user(request)
+        login_key = (request.session.session_key or '') if user.is_authenticated else ''
+    csrf_token = get_token(request)
+    profile = _profile(user) if user.is_authenticated else None
+
+    version = json.dumps([login_key, request.META['CSRF_COOKIE'], profile], sort_keys=True)
+    etag = quote_etag(hashlib.sha256(version.encode()).hexdigest()[:32])
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = JsonResponse({'authenticated': user.is_authenticated, 'csrfToken': csrf_token, 'user': profile})
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True) # Always revalidate, never in shared caches
+    patch_vary_headers(response, ('Cookie', 'Authorization'))
+    return response
+
+# Seconds a profile is kept in the cache. Entries are versioned, so a changed profile
+# is read from the database on the next request rather than waiting for this.
+ME_CACHE_TIMEOUT = 3600
+
+def _me_cache_key(user_id, profile_version):
+    return f'accounts:me:{user_id}:{profile_version}'
+
+# Profile of the user returned by me.
+def _me_profile(user):
+    return {
+        **_profile(user),
+        'display_name': user.display_name,
+        'picture_url': user.picture_url,
+        'locale': user.locale,
+    }
+
+# View for the logged in user's profile. Served from a cache entry keyed by the user's
+# profile_version, so token requests (stateless mode) need no query while the profile is
+# unchanged, and clients revalidating with If-None-Match get an empty 304. The version of
+# a token user comes from the access token, so a profile change shows for them after
+# their next refresh.
+@require_safe
+def me(request):
+    token = get_bearer_token(request) if settings.STATELESS_AUTH else None
+    if token is not None:
+        try:
+            user = TokenUser(verify_access_token(token))
+        except TokenError as e:
+            return JsonResponse({'detail': str(e)}, status=401)
+    else:
+        user = request.user
+        if not user.is_authenticated:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=403)
+
+    etag = quote_etag(f'{user.pk}.{user.profile_version}')
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        key = _me_cache_key(user.pk, user.profile_version)
+        profile = cache.get(key)
+        if profile is None:
+            if isinstance(user, TokenUser):
+                user = get_user_model().objects.filter(pk=user.pk, is_active=True).first()
+                if user is None:
+                    return JsonResponse({'detail': 'User not found.'}, status=401)
+            profile = _me_profile(user)
+            cache.set(key, profile, timeout=ME_CACHE_TIMEOUT)
+        response = JsonResponse(profile)
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie', 'Authorization'))
+    return response
+
+# Async view for logging in with google. Takes the same input and gives the same response
+# as dj-rest-auth/google/, but the code exchange runs on the event loop, so a worker can
+# hold many logins that are waiting on Google. Saving the user still needs a thread since
+# Django 4.0 has no async ORM. Shares the concurrency limit and code coalescing of the
+# sync endpoint.
+async def google_login_async(request):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'non_field_errors': ['Invalid JSON body.']}, status=400)
+    else:
+        data = request.POST
+
+    if not login_limiter.try_acquire():
+        return overloaded_response()
+    try:
+        user = await _google_login_once(request, data)
+        if settings.STATELESS_AUTH:
+            return JsonResponse(await sync_to_async(issue_login_tokens)(request, user))
+        return HttpResponse(status=204)
+    except LoginError as e:
+        return JsonResponse({'non_field_errors': [str(e)]}, status=400)
+    finally:
+        login_limiter.release()
+
+# Run the login, or wait for the login of an earlier request from this client with the same
+# authorization code that is still in progress.
+async def _google_login_once(request, data):
+    code = data.get('code')
+    if not code:
+        return await _google_login(request, data)
+    flight = LoginFlight(request, code)
+    if not await flight.astart():
+        result = await flight.await_result()
+        if result is None:
+            raise LoginError('Failed to exchange code for access token')
+        outcome, value = result
+        if outcome == 'error':
+            raise LoginError(value)
+        return await sync_to_async(resume_social_login)(request, value)
+    try:
+        user = await _google_login(request, data)
+    except LoginError as e:
+        await flight.afinish(error=str(e))
+        raise
+    except BaseException:
+        await flight.aabandon()
+        raise
+    await flight.afinish(user_id=user.pk)
+    return user
+
+async def _google_login(request, data):
+    adapter = GoogleOAuth2Adapter(request)
+    app = adapter.get_provider().get_app(request)
+    code = data.get('code')
+
+    # Case 1: Exchange the authorization code for tokens
+    if code:
+        import aiohttp # Imported on first use, as in oauth_client
+        from .urls import GoogleLogin # Imported here since urls.py imports this module
+        token_data = {
+            'redirect_uri': GoogleLogin.callback_url,
+            'grant_type': 'authorization_code',
+            'code': code,
+            'client_id': app.client_id,
+            'client_secret': app.secret,
+        }
+        try:
+            status, tokens, _ = await async_http_request('POST', adapter.access_token_url, data=token_data)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            status, tokens = None, None
+        if status not in (200, 201) or not tokens or 'access_token' not in tokens or 'id_token' not in tokens:
+            raise LoginError('Failed to exchange code for access token')
+        tokens = {key: tokens[key] for key in ('access_token', 'refresh_token', 'id_token', adapter.expires_in_key) if key in tokens}
+
+    # Case 2: The client sent the id_token directly (as access_token, like dj-rest-auth)
+    elif data.get('access_token'):
+        tokens = {'access_token': data['access_token'], 'id_token': data.get('id_token') or data['access_token']}
+    else:
+        raise LoginError('Incorrect input. access_token or code is required.')
+
+    # Verify the id_token on the loop when the keys are cached, otherwise fetch them in a thread
+    try:
+        if google_keys.can_verify_locally(tokens['id_token']):
+            identity_data = google_keys.verify_id_token(tokens['id_token'], audience=app.client_id)
+        else:
+            identity_data = await sync_to_async(google_keys.verify_id_token, thread_sensitive=False)(tokens['id_token'], audience=app.client_id)
+    except (jwt.PyJWTError, google_keys.KeyFetchError):
+        raise LoginError('Invalid id_token')
+
+    social_token = adapter.parse_token(tokens)
+    social_token.app = app
+    login = adapter.get_provider().sociallogin_from_response(request, identity_data)
+    login.token = social_token
+    return await sync_to_async(finish_social_login)(request, login)
+
+# Like dj-rest-auth/google/, which DRF exempts from CSRF for anonymous users. Set directly
+# since Django 4.0's csrf_exempt decorator does not support async views.
+google_login_async.csrf_exempt = True
+
+# Read a JSON or form field from a POST body.
+def _post_field(request, name):
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body).get(name)
+        except (ValueError, AttributeError):
+            return None
+    return request.POST.get(name)
+
+# View to exchange a refresh token for a new access and refresh token (stateless mode).
+# Exempt from CSRF since it does not use cookies.
+@csrf_exempt
+@require_POST
+def token_refresh(request):
+    refresh_token = _post_field(request, 'refresh')
+    if not refresh_token:
+        return JsonResponse({'detail': 'refresh is required.'}, status=400)
+    try:
+        return JsonResponse(rotate_refresh_token(refresh_token))
+    except TokenError as e:
+        return JsonResponse({'detail': str(e)}, status=401)
+
+# View to log out the login of the access token in the Authorization header, or of the
+# refresh token in the body (stateless mode).
+@csrf_exempt
+@require_POST
+def token_logout(request):
+    if not revoke_request_tokens(request, refresh_token=_post_field(request, 'refresh')):
+        return JsonResponse({'detail': 'A valid access or refresh token is required.'}, status=401)
+    return HttpResponse(status=204)
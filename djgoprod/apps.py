@@ -0,0 +1,23 @@
+"""
+apps.py file for djgoprod app.
+"""
+
+from django.apps import AppConfig
+from django.conf import settings
+
+class DjgoprodConfig(AppConfig):
+    name = 'djgoprod'
+
+    def ready(self):
+        # Check persistent database connections before reusing them
+        from .db import connect_health_checks
+        connect_health_checks()
+
+        from .pages import warm_templates
+        warm_templates()
+
+        # Count queries per request for the metrics endpoint
+        if settings.METRICS_ENABLED:
+            from django.db.backends.signals import connection_created
+            from .metrics import install_query_instrumentation
+            connection_created.connect(install_query_instrumentation, dispatch_uid='djgoprod_install_query_instrumentation')
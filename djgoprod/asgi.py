@@ -0,0 +1,53 @@
+"""
+asgi.py file for djgoprod app.
+
+ASGI config for djgoprod project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Gunicorn's UvicornWorker serves this callable natively, so async views run
+on the event loop instead of going through a WSGI adapter and a thread.
+HTTP requests go to Django, and WebSocket connections to the Channels
+consumers in accounts/routing.py. The lifespan handler closes the worker's
+pooled connections to Google when Uvicorn shuts the worker down.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
+"""
+
+# Import OS for environment variables
+import os
+
+# Import Django libraries
+from django.core.asgi import get_asgi_application
+
+# Set the default Django settings module
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djgoprod.settings')
+
+# Set up Django before importing the consumers, which import models.
+django_asgi_application = get_asgi_application()
+
+# Import Channels libraries
+from channels.auth import AuthMiddlewareStack
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
+
+from accounts.oauth_client import close_async_sessions
+from accounts.routing import websocket_urlpatterns
+
+# ASGI lifespan protocol. Uvicorn sends startup when the worker starts and shutdown when it stops.
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_sessions()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+application = ProtocolTypeRouter({
+    'http': django_asgi_application,
+    # Only accept WebSockets from ALLOWED_HOSTS, since the session cookie authenticates them.
+    'websocket': AllowedHostsOriginValidator(AuthMiddlewareStack(URLRouter(websocket_urlpatterns))),
+    'lifespan': lifespan,
+})
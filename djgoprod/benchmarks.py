@@ -0,0 +1,30 @@
+"""
+benchmarks.py file for djgoprod app. Helpers shared by the
+benchmark management commands.
+"""
+
+# Import required libraries for benchmark databases and statistics
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+#------- [Functions] -------#
+
+# Run the benchmark in a separate test database so benchmark rows never reach
+# the real one. SQLite uses a file next to the configured database, not memory,
+# so results are comparable with the configured setup.
+@contextmanager
+def benchmark_database(keepdb=False):
+    if connection.vendor == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = connection.settings_dict['NAME'].replace('.sqlite3', '_bench.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+# Value at the given fraction (0.95 for p95) of an already sorted list.
+def percentile(sorted_values, fraction):
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
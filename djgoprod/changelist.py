@@ -0,0 +1,136 @@
+"""
+changelist.py file for djgoprod app. Admin changelist pieces for
+tables too large to count or page through with OFFSET.
+
+The stock changelist runs an exact COUNT(*) on every page load and pages
+with LIMIT/OFFSET, which reads and throws away every row before the page.
+LargeTableAdmin counts with the planner's estimate on PostgreSQL, and pages
+with a cursor on the ordering column when the list is ordered by a unique
+field, so every page is an index range scan.
+"""
+
+# Import required libraries for estimated counts and keyset pagination
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+#------- [Variables] -------#
+
+# Query string parameters holding the cursor: the ordering value of the row the page starts after or ends before.
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+
+# Below this many estimated rows the exact count is cheap enough to run.
+EXACT_COUNT_BELOW = 10_000
+
+
+#------- [Classes] -------#
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that counts large PostgreSQL results with the planner's row estimate."""
+
+    estimated = False
+
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is None or estimate < EXACT_COUNT_BELOW:
+            return super().count
+        self.estimated = True
+        return estimate
+
+
+class KeysetChangeList(ChangeList):
+    """
+    ChangeList that pages with ?after= and ?before= cursors on the ordering
+    field when the list is ordered by a unique field (such as username or the
+    primary key). Other orderings, show all, and list_editable fall back to
+    page numbers.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(AFTER_VAR, None)
+        lookup_params.pop(BEFORE_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.keyset = None
+        self.count_estimated = getattr(self.paginator, 'estimated', False)
+        key = self.keyset_field()
+        if key is None or not self.multi_page or (self.show_all and self.can_show_all) or self.list_editable:
+            return
+        name, field, descending = key
+        after, before = request.GET.get(AFTER_VAR), request.GET.get(BEFORE_VAR)
+        try:
+            cursor = field.to_python(before if before is not None else after)
+        except ValidationError:
+            raise IncorrectLookupParameters
+
+        queryset = self.queryset
+        if before is not None:
+            queryset = queryset.filter(**{f'{name}__{"gt" if descending else "lt"}': cursor}).reverse()
+        elif after is not None:
+            queryset = queryset.filter(**{f'{name}__{"lt" if descending else "gt"}': cursor})
+        # One row more than the page shows whether there is another page past it
+        rows = list(queryset[:self.list_per_page + 1])
+        more = len(rows) > self.list_per_page
+        rows = rows[:self.list_per_page]
+        if before is not None:
+            rows.reverse()
+
+        self.result_list = rows
+        self.keyset = {
+            'first_url': self.get_query_string({AFTER_VAR: None, BEFORE_VAR: None}) if after is not None or before is not None else None,
+            'previous_url': self.cursor_url(BEFORE_VAR, rows[0], name) if rows and (after is not None or (before is not None and more)) else None,
+            'next_url': self.cursor_url(AFTER_VAR, rows[-1], name) if rows and (before is not None or more) else None,
+        }
+
+    # The ordering field, if it is unique: (lookup name, field, descending), or None.
+    def keyset_field(self):
+        ordering = self.queryset.query.order_by
+        if not ordering or not isinstance(ordering[0], str):
+            return None
+        descending = ordering[0].startswith('-')
+        name = ordering[0].lstrip('-')
+        try:
+            field = self.lookup_opts.pk if name == 'pk' else self.lookup_opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if not (field.unique and field.concrete and not field.null):
+            return None
+        return name, field, descending
+
+    def cursor_url(self, var, row, name):
+        value = row.pk if name == 'pk' else getattr(row, name)
+        return self.get_query_string({AFTER_VAR: None, BEFORE_VAR: None, var: value})
+
+
+class LargeTableAdmin:
+    """ModelAdmin mixin with estimated counts and keyset pagination, for tables with millions of rows."""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False # Otherwise every page load counts the whole table
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+#------- [Functions] -------#
+
+# The planner's row estimate for a queryset on PostgreSQL, or None on other databases.
+# EXPLAIN only plans the query, so this costs about as much as a primary key lookup.
+def estimated_count(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    return int(plan[0]['Plan']['Plan Rows'])
@@ -0,0 +1,245 @@
+"""
+db.py file for djgoprod app. Database connection
+helpers for persistent connections, and routing of
+read-only requests to replicas (PSQL_REPLICA_URLS).
+"""
+
+# Import required libraries for connection health checks and replica routing
+import contextvars
+import logging
+import random
+import threading
+import time
+from functools import wraps
+
+import django
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+
+#------- [Variables] -------#
+
+# A persistent connection idle for longer than this is checked before reuse.
+# Busy connections are not pinged, so the hot path pays no extra round trip.
+HEALTH_CHECK_IDLE_SECONDS = 5
+
+# Cookie that keeps a client's reads on the primary for a while after one of its requests wrote.
+PRIMARY_COOKIE_NAME = 'db_primary'
+
+# GET requests under these paths write, so their reads go to the primary too. The allauth
+# views (OAuth callback, logout, email confirmation) log users in and out on GET. Views of
+# this project that write on GET use the primary_database decorator instead.
+PRIMARY_PATHS = ('/allauth/',)
+
+# Each replica's lag is checked at most this often per worker.
+REPLICA_LAG_CHECK_SECONDS = 5
+
+# PostgreSQL replica lag in seconds. A replica that has replayed everything it received is
+# not lagging, however long ago the last write on the primary was.
+REPLICA_LAG_SQL = (
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END'
+)
+
+
+#------- [Classes] -------#
+
+class RoutingState:
+    """Where the reads of the request being served go."""
+
+    __slots__ = ('primary', 'wrote', 'replica')
+
+    def __init__(self, primary):
+        self.primary = primary # Reads go to the primary
+        self.wrote = False # The request wrote, so the client sticks to the primary
+        self.replica = None # Replica chosen for the request's reads
+
+
+class ReplicaLag:
+    """Last known lag of each replica in this worker, checked every REPLICA_LAG_CHECK_SECONDS."""
+
+    def __init__(self):
+        self._checked = {} # Alias -> (time checked, healthy)
+        self._lock = threading.Lock()
+
+    def is_healthy(self, alias):
+        checked_at, healthy = self._checked.get(alias, (None, False))
+        now = time.monotonic()
+        if checked_at is not None and now - checked_at < REPLICA_LAG_CHECK_SECONDS:
+            return healthy
+        with self._lock:
+            checked_at, healthy = self._checked.get(alias, (None, False))
+            if checked_at is not None and now - checked_at < REPLICA_LAG_CHECK_SECONDS:
+                return healthy
+            self._checked[alias] = (now, healthy) # Other threads use the last result meanwhile
+        healthy = self._check(alias)
+        self._checked[alias] = (time.monotonic(), healthy)
+        return healthy
+
+    def _check(self, alias):
+        connection = connections[alias]
+        if connection.vendor != 'postgresql':
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(REPLICA_LAG_SQL)
+                lag = cursor.fetchone()[0]
+        except Exception:
+            logger.warning('Checking the lag of replica %s failed, reading from the primary.', alias, exc_info=True)
+            return False
+        if lag > settings.DB_REPLICA_MAX_LAG:
+            logger.warning('Replica %s is %.1fs behind, reading from the primary.', alias, lag)
+            return False
+        return True
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of read-only requests to a replica. The primary gets all
+    writes, and the reads of unsafe requests (POST and so on), of GET requests
+    that write (PRIMARY_PATHS and views decorated with primary_database), of
+    requests after their first write, of transactions, of clients that wrote
+    within DB_REPLICA_STICKY_SECONDS, and of anything outside a request
+    (commands, background threads). Replicas that lag more than
+    DB_REPLICA_MAX_LAG are skipped.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = routing_state.get()
+        if state is None or state.primary or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        if state.replica is None:
+            healthy = [alias for alias in replica_aliases() if replica_lag.is_healthy(alias)]
+            state.replica = random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = routing_state.get()
+        if state is not None:
+            state.primary = state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True # Replicas hold the same data as the primary
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Sets where each request's reads go, for ReplicaRouter. After a request
+    writes, a short-lived cookie keeps the client's next requests on the
+    primary, so they read their own writes while the replicas catch up.
+    Placed before SessionMiddleware, so session saves count as writes.
+
+    The stickiness is kept in a cookie (PRIMARY_COOKIE_NAME), not in the
+    session, so routing a request never reads the session first. It only
+    follows clients that keep cookies: one that drops them can read from a
+    replica up to DB_REPLICA_MAX_LAG behind its own writes.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state = request_routing_state(request)
+        token = routing_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            routing_state.reset(token)
+        return stick_to_primary(response, state)
+
+    async def __acall__(self, request):
+        state = request_routing_state(request)
+        token = routing_state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            routing_state.reset(token)
+        return stick_to_primary(response, state)
+
+
+#------- [Functions] -------#
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS]
+
+def request_routing_state(request):
+    safe = request.method in ('GET', 'HEAD', 'OPTIONS') and not request.path_info.startswith(PRIMARY_PATHS)
+    return RoutingState(primary=not safe or PRIMARY_COOKIE_NAME in request.COOKIES)
+
+# View decorator for views that write on GET, so their reads see the primary's data.
+def primary_database(view):
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            read_from_primary()
+            return await view(request, *args, **kwargs)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            read_from_primary()
+            return view(request, *args, **kwargs)
+    return wrapper
+
+# Send the rest of the request's reads to the primary.
+def read_from_primary():
+    state = routing_state.get()
+    if state is not None:
+        state.primary = True
+
+def stick_to_primary(response, state):
+    if state.wrote:
+        response.set_cookie(
+            PRIMARY_COOKIE_NAME, '1', max_age=settings.DB_REPLICA_STICKY_SECONDS,
+            secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+        )
+    return response
+
+# Close reused connections that died while idle (database restart, pooler or
+# firewall timeout) so Django reconnects instead of failing the request.
+def check_connection_health(**kwargs):
+    now = time.monotonic()
+    for conn in connections.all():
+        if conn.connection is None or not conn.settings_dict.get('CONN_HEALTH_CHECKS'):
+            continue
+        if now - getattr(conn, 'last_request_finished', now) < HEALTH_CHECK_IDLE_SECONDS:
+            continue
+        if not conn.is_usable():
+            conn.close()
+
+# Record when each open connection was last used by a request.
+def mark_connections_idle(**kwargs):
+    now = time.monotonic()
+    for conn in connections.all():
+        if conn.connection is not None:
+            conn.last_request_finished = now
+
+# Connect the health check signals. Django 4.1+ supports CONN_HEALTH_CHECKS natively.
+def connect_health_checks():
+    if django.VERSION >= (4, 1):
+        return
+    request_started.connect(check_connection_health, dispatch_uid='djgoprod_check_connection_health')
+    request_finished.connect(mark_connections_idle, dispatch_uid='djgoprod_mark_connections_idle')
+
+
+#------- [Instances] -------#
+
+# Routing of the request being served in this thread or task (None outside a request).
+routing_state = contextvars.ContextVar('djgoprod_routing_state', default=None)
+
+replica_lag = ReplicaLag()
@@ -0,0 +1,157 @@
+"""
+Bench_server.py management command for djgoprod app.
+Benchmarks starting Gunicorn with the command line entrypoint.sh used
+before (--workers 4 -k uvicorn.workers.UvicornWorker, no preload or
+warm-up) and with gunicorn.conf.py, at the same number of workers.
+
+For each, starts the server on a free local port and reports the time until
+every worker is accepting requests, the latency of the workers' first
+requests and of later ones, and memory: the master's and the workers'
+resident memory (RSS), the memory only each worker uses (USS), and the
+server's total proportional memory (PSS), which counts pages the workers
+share copy-on-write once. Memory is read from /proc, so this runs on Linux.
+
+Usage: python manage.py bench_server --workers 4 --requests 200
+"""
+
+# Import required libraries for the benchmark
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from djgoprod.benchmarks import percentile
+
+
+#------- [Variables] -------#
+
+READY_LINE = 'Application startup complete.' # Logged by each Uvicorn worker once it accepts requests
+
+START_TIMEOUT_SECONDS = 60
+
+PATHS = ('/', '/accounts/login/')
+
+
+#------- [Functions] -------#
+
+def free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as file:
+            return [int(child) for child in file.read().split()]
+    except OSError:
+        return []
+
+# RSS, PSS, and USS of a process in KiB.
+def memory(pid):
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as file:
+        for line in file:
+            name, _, rest = line.partition(':')
+            if rest.strip().endswith('kB'):
+                values[name] = int(rest.split()[0])
+    return {
+        'rss': values.get('Rss', 0), 'pss': values.get('Pss', 0),
+        'uss': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0),
+    }
+
+# Latency in seconds of a GET request on a new connection, with a Host header ALLOWED_HOSTS accepts.
+def timed_get(url):
+    host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+    request = urllib.request.Request(url, headers={'Host': host})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Compare Gunicorn startup, first request latency, and memory with the old command line and gunicorn.conf.py.'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Workers started by both servers.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests timed after the first ones.')
+
+    def handle(self, *args, **options):
+        if not os.path.exists('/proc/self/smaps_rollup'):
+            raise CommandError('bench_server reads memory from /proc and runs on Linux only.')
+        workers = options['workers']
+        with tempfile.TemporaryDirectory() as directory:
+            # An empty config file, so the old command line does not pick up ./gunicorn.conf.py
+            empty_config = os.path.join(directory, 'empty.conf.py')
+            open(empty_config, 'w').close()
+            servers = (
+                ('entrypoint', ['-c', empty_config, '--workers', str(workers), '-k', 'uvicorn.workers.UvicornWorker', 'djgoprod.asgi:application']),
+                ('gunicorn.conf.py', ['-c', 'gunicorn.conf.py']),
+            )
+            results = [(label, self.run_server(arguments, workers, options['requests'])) for label, arguments in servers]
+
+        self.stdout.write(f'{workers} workers, {options["requests"]} requests after the first ones, pages {", ".join(PATHS)}:')
+        self.stdout.write(
+            f'  {"server":<18}{"ready s":>9}{"first p50":>11}{"first max":>11}{"later p50":>11}{"later p99":>11}'
+            f'{"master RSS":>12}{"worker RSS":>12}{"worker USS":>12}{"total PSS":>11}'
+        )
+        for label, result in results:
+            self.stdout.write(
+                f'  {label:<18}{result["ready"]:>9.2f}{result["first_p50"] * 1000:>9.1f}ms{result["first_max"] * 1000:>9.1f}ms'
+                f'{result["later_p50"] * 1000:>9.1f}ms{result["later_p99"] * 1000:>9.1f}ms'
+                f'{result["master_rss"] / 1024:>9.0f}MiB{result["worker_rss"] / 1024:>9.0f}MiB{result["worker_uss"] / 1024:>9.0f}MiB{result["total_pss"] / 1024:>8.0f}MiB'
+            )
+
+    def run_server(self, arguments, workers, requests):
+        port = free_port()
+        environment = dict(os.environ, SETTINGS_TRANSCRIPT='quiet', WEB_CONCURRENCY=str(workers))
+        log = tempfile.TemporaryFile(mode='w+')
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', *arguments],
+            cwd=settings.BASE_DIR, env=environment, stdout=log, stderr=subprocess.STDOUT,
+        )
+        try:
+            while True:
+                log.seek(0)
+                output = log.read()
+                if output.count(READY_LINE) >= workers:
+                    break
+                if process.poll() is not None or time.perf_counter() - start > START_TIMEOUT_SECONDS:
+                    raise CommandError(f'Gunicorn did not start:\n{output[-2000:]}')
+                time.sleep(0.01)
+            ready = time.perf_counter() - start
+
+            # Two requests per worker, all at once, so most workers serve their first requests
+            urls = [f'http://127.0.0.1:{port}{PATHS[number % len(PATHS)]}' for number in range(workers * 2)]
+            with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+                first = list(executor.map(timed_get, urls))
+            later = [timed_get(f'http://127.0.0.1:{port}{PATHS[number % len(PATHS)]}') for number in range(requests)]
+
+            master = memory(process.pid)
+            worker_memory = [memory(pid) for pid in children(process.pid)]
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=30)
+            log.close()
+        return {
+            'ready': ready,
+            'first_p50': statistics.median(first), 'first_max': max(first),
+            'later_p50': statistics.median(later), 'later_p99': percentile(sorted(later), 0.99),
+            'master_rss': master['rss'],
+            'worker_rss': statistics.mean(item['rss'] for item in worker_memory),
+            'worker_uss': statistics.mean(item['uss'] for item in worker_memory),
+            'total_pss': master['pss'] + sum(item['pss'] for item in worker_memory),
+        }
@@ -0,0 +1,35 @@
+"""
+Check_settings.py management command for djgoprod app.
+Validates settings.py for the current environment once, prints the
+deployment transcript, and caches the result.
+
+Worker processes with SETTINGS_TRANSCRIPT=once (the default outside local)
+find the cached result and skip printing the transcript, so run this once
+before starting the server, as entrypoint.sh does.
+
+Usage: python manage.py check_settings --fail-on-critical
+"""
+
+# Import required libraries for checking settings
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from djgoprod import settings_check
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Validate settings.py for this environment, print the transcript, and cache the result for the workers.'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail-on-critical', action='store_true', help='Exit with an error if critical warnings exist.')
+
+    def handle(self, *args, **options):
+        # settings.py already validated the environment on import, and printed the transcript unless it was cached
+        if not settings.DEPLOYMENT_TRANSCRIPT_PRINTED:
+            settings_check.print_transcript(settings.DEPLOYMENT_TRANSCRIPT, settings.CRIT_WARNINGS_EXIST, settings.DEPLOYMENT)
+        settings_check.save_result(settings_check.environment_fingerprint(), settings.CRIT_WARNINGS_EXIST, settings.DEPLOYMENT)
+        if settings.CRIT_WARNINGS_EXIST and options['fail_on_critical']:
+            raise CommandError('Critical warnings exist in settings.py.')
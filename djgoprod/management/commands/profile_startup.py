@@ -0,0 +1,152 @@
+"""
+Profile_startup.py management command for djgoprod app.
+Reports what a worker spends its cold start on: importing settings, each
+installed app (importing it, its models, and its ready()), the ASGI
+application, and the URLconf, then the modules and packages that take
+the longest to import.
+
+Each run starts a fresh Python process, so nothing is already imported.
+Phase timings are the median of --runs processes. The module table comes
+from one more process run with python -X importtime, which inflates the
+total a little.
+
+Usage: python manage.py profile_startup --runs 5 --top 25
+"""
+
+# Import required libraries for profiling startup
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+#------- [Variables] -------#
+
+# Run in each child process. Times every startup phase and prints them as JSON on the last line.
+CHILD_SCRIPT = '''
+import json, os, time
+start = time.perf_counter()
+timings = {}
+apps = {}
+
+def timed(label, phase, function):
+    def wrapper(*args, **kwargs):
+        phase_start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            apps.setdefault(label, {})[phase] = time.perf_counter() - phase_start
+    return wrapper
+
+import django
+from django.apps.config import AppConfig
+create = AppConfig.create.__func__
+
+def timed_create(cls, entry):
+    create_start = time.perf_counter()
+    app_config = create(cls, entry)
+    apps.setdefault(app_config.label, {})['import'] = time.perf_counter() - create_start
+    app_config.import_models = timed(app_config.label, 'models', app_config.import_models)
+    app_config.ready = timed(app_config.label, 'ready', app_config.ready)
+    return app_config
+
+AppConfig.create = classmethod(timed_create)
+timings['django'] = time.perf_counter() - start
+
+phase_start = time.perf_counter()
+from django.conf import settings
+settings.INSTALLED_APPS
+timings['settings'] = time.perf_counter() - phase_start
+
+phase_start = time.perf_counter()
+django.setup(set_prefix=False)
+timings['apps'] = time.perf_counter() - phase_start
+
+phase_start = time.perf_counter()
+import djgoprod.asgi
+timings['asgi'] = time.perf_counter() - phase_start
+
+phase_start = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().reverse_dict
+timings['urls'] = time.perf_counter() - phase_start
+
+timings['total'] = time.perf_counter() - start
+print(json.dumps({'timings': timings, 'apps': apps}))
+'''
+
+PHASES = (
+    ('django', 'Import Django'),
+    ('settings', 'Import settings.py'),
+    ('apps', 'Set up installed apps'),
+    ('asgi', 'Import the ASGI application'),
+    ('urls', 'Load the URLconf'),
+    ('total', 'Total'),
+)
+
+
+#------- [Functions] -------#
+
+# Run the child script in a fresh interpreter and return its JSON result and stderr.
+def run_child(*flags):
+    environment = dict(os.environ, SETTINGS_TRANSCRIPT='quiet', DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'djgoprod.settings'))
+    process = subprocess.run(
+        [sys.executable, *flags, '-c', CHILD_SCRIPT], cwd=settings.BASE_DIR, env=environment,
+        capture_output=True, text=True,
+    )
+    if process.returncode != 0:
+        raise CommandError(f'Startup failed:\n{process.stderr[-2000:]}')
+    return json.loads(process.stdout.strip().splitlines()[-1]), process.stderr
+
+# Self and cumulative import times in seconds per module, from python -X importtime output.
+def parse_importtime(output):
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return modules
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Report worker cold start time per phase, installed app, module, and package.'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=3, help='Fresh processes timed. The median of each phase is reported.')
+        parser.add_argument('--top', type=int, default=20, help='Modules and packages listed.')
+
+    def handle(self, *args, **options):
+        runs = [run_child()[0] for _ in range(options['runs'])]
+
+        self.stdout.write(f'Cold start, median of {len(runs)} processes:')
+        for key, label in PHASES:
+            self.stdout.write(f'  {label:<32}{statistics.median(run["timings"][key] for run in runs) * 1000:>9.1f} ms')
+
+        self.stdout.write(f'\nInstalled apps (ms), in INSTALLED_APPS order:')
+        self.stdout.write(f'  {"app":<24}{"import":>9}{"models":>9}{"ready":>9}')
+        for label in runs[0]['apps']:
+            row = [statistics.median(run['apps'].get(label, {}).get(phase, 0) for run in runs) * 1000 for phase in ('import', 'models', 'ready')]
+            self.stdout.write(f'  {label:<24}{row[0]:>9.1f}{row[1]:>9.1f}{row[2]:>9.1f}')
+
+        modules = parse_importtime(run_child('-X', 'importtime')[1])
+        packages = defaultdict(float)
+        for name, (self_seconds, _) in modules.items():
+            packages[name.split('.')[0]] += self_seconds
+
+        self.stdout.write(f'\nPackages by import time (python -X importtime, {sum(packages.values()) * 1000:.0f} ms in all):')
+        for name, seconds in sorted(packages.items(), key=lambda item: -item[1])[:options['top']]:
+            self.stdout.write(f'  {name:<48}{seconds * 1000:>9.1f} ms')
+
+        self.stdout.write('\nModules by import time, excluding the modules they import (ms):')
+        self.stdout.write(f'  {"module":<48}{"self":>9}{"cumulative":>12}')
+        for name, (self_seconds, cumulative_seconds) in sorted(modules.items(), key=lambda item: -item[1][0])[:options['top']]:
+            self.stdout.write(f'  {name:<48}{self_seconds * 1000:>9.1f}{cumulative_seconds * 1000:>12.1f}')
@@ -0,0 +1,95 @@
+"""
+Purge_sessions.py management command for djgoprod app.
+Deletes expired database sessions, and expired refresh tokens of the
+stateless authentication mode (STATELESS_AUTH), in small batches.
+
+Django's clearsessions deletes every expired session in one statement,
+which holds locks and bloats the table for as long as it takes when there
+are millions of rows. This command deletes at most --batch-size rows
+per statement, walking the expiry index, and pauses between batches
+(--sleep, --max-rate) so logins are not slowed down while it runs. With
+--interval it keeps running and purges again every so many seconds, so it
+can run as its own process instead of a nightly cron job.
+
+Usage: python manage.py purge_sessions --batch-size 1000 --max-rate 5000 --interval 300
+"""
+
+# Import required libraries for purging sessions
+import argparse
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from accounts.models import RefreshToken
+
+
+#------- [Functions] -------#
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be a positive whole number, not {value}')
+    return number
+
+
+#------- [Command] -------#
+
+class Command(BaseCommand):
+    help = 'Delete expired database sessions and refresh tokens in throttled batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=positive_int, default=1000, help='Rows deleted per statement.')
+        parser.add_argument('--sleep', type=float, default=0.05, help='Seconds to pause between batches.')
+        parser.add_argument('--max-rate', type=float, default=0, help='Most rows deleted per second. 0 means no limit.')
+        parser.add_argument('--report-every', type=float, default=10, help='Seconds between progress reports.')
+        parser.add_argument('--interval', type=float, default=0, help='Keep running and purge again every this many seconds.')
+
+    def handle(self, *args, **options):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        Session = store.get_model_class() if hasattr(store, 'get_model_class') else None
+        if Session is None:
+            self.stdout.write(f'Sessions are not stored in the database ({settings.SESSION_ENGINE}), only refresh tokens are purged.')
+        try:
+            while True:
+                close_old_connections() # Drop a connection the database or pooler closed since the last round
+                if Session is not None:
+                    self.purge('sessions', Session, 'expire_date', options)
+                self.purge('refresh tokens', RefreshToken, 'expires_at', options)
+                if not options['interval']:
+                    return
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped.')
+
+    # Delete the rows of model whose expiry field is in the past.
+    def purge(self, label, model, expiry_field, options):
+        cutoff = timezone.now()
+        expired = model.objects.filter(**{f'{expiry_field}__lt': cutoff}).order_by(expiry_field)
+        start = last_report = time.monotonic()
+        deleted = 0
+        while True:
+            batch_start = time.monotonic()
+            keys = list(expired.values_list('pk', flat=True)[:options['batch_size']])
+            if keys:
+                deleted += model.objects.filter(pk__in=keys).delete()[0]
+            now = time.monotonic()
+            if now - last_report >= options['report_every'] and keys:
+                self.stdout.write(f'  {deleted} {label} deleted, {deleted / (now - start):.0f} rows/s')
+                last_report = now
+            if len(keys) < options['batch_size']:
+                break
+
+            # Pause between batches, long enough to stay under --max-rate
+            pause = options['sleep']
+            if options['max_rate']:
+                pause = max(pause, len(keys) / options['max_rate'] - (now - batch_start))
+            time.sleep(pause)
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {deleted} {label} that expired before {cutoff:%Y-%m-%d %H:%M:%S} in {elapsed:.1f}s ({deleted / elapsed if elapsed else 0:.0f} rows/s).'
+        ))
@@ -0,0 +1,420 @@
+"""
+metrics.py file for djgoprod app. Low-overhead request metrics,
+exposed in the Prometheus text format at /metrics.
+
+Figures are aggregated in memory per worker process as they happen
+(counters and fixed-bucket histograms), so nothing is logged or stored
+per request. Each worker writes its figures to a shared directory about
+once a second, and /metrics adds up every worker's (djgoprod/metrics_store.py),
+so every scrape reports the whole server. With METRICS_TRACE_SAMPLE_RATE
+set, a sample of requests is also logged as a single-line trace with its
+slowest queries.
+"""
+
+# Import required libraries for collecting and rendering metrics
+import bisect
+import contextvars
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+from urllib.parse import urlsplit
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware
+
+from . import metrics_store
+
+logger = logging.getLogger(__name__)
+
+
+#------- [Variables] -------#
+
+# Upper bounds in seconds for the latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds for the number of queries per request.
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Requests that did not resolve to a route share one label, so unknown paths add no series.
+UNMATCHED_ROUTE = 'unmatched'
+
+KNOWN_METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+# Slowest queries kept in a sampled trace, and how much of their SQL.
+TRACE_MAX_QUERIES = 10
+TRACE_MAX_SQL = 300
+
+# Seconds between writes of a worker's figures to the shared directory.
+FLUSH_SECONDS = 1
+
+
+#------- [Classes] -------#
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.registry = None
+        self.reset()
+
+    def reset(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        self.registry.track()
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(label_values), value] for label_values, value in self.values.items()]
+
+    # Samples for the figures added up across the workers.
+    def samples(self, values):
+        for label_values, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.registry = None
+        self.reset()
+
+    def reset(self):
+        self.values = {} # Label values -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        self.registry.track()
+        with self._lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(label_values), list(counts)] for label_values, counts in self.values.items()]
+
+    # Samples for the figures added up across the workers.
+    def samples(self, values):
+        for label_values, counts in sorted(values.items()):
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', {**labels, 'le': str(bound)}, cumulative
+            yield f'{self.name}_count', labels, cumulative
+            yield f'{self.name}_sum', labels, counts[-1]
+
+
+class Registry:
+    """
+    The metrics of this process. Once it records its first figure, the process
+    writes its figures to the shared directory every FLUSH_SECONDS from a
+    background thread, under a name of its own.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.process = None # Name of this process's file, set on its first figure
+        self.started = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # A forked worker starts from zero, the figures it inherits are its parent's
+        os.register_at_fork(after_in_child=self._reset)
+
+    def register(self, metric):
+        metric.registry = self
+        self.metrics.append(metric)
+        return metric
+
+    # Called with each figure. Starts this process's writer on the first one.
+    def track(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.process = f'{self._pid}-{secrets.token_hex(4)}'
+                self.started = time.time()
+                threading.Thread(target=self._flush_periodically, name='metrics-flush', daemon=True).start()
+
+    # Write this process's figures to the shared directory.
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        metrics_store.write_process(self.process, {'started': self.started, 'metrics': {metric.name: metric.snapshot() for metric in self.metrics}})
+
+    # Render every worker's figures, added up, in the Prometheus text exposition format.
+    def render(self):
+        self.flush()
+        started, totals = metrics_store.read_all()
+        lines = []
+        if started is not None:
+            lines += [
+                '# HELP process_start_time_seconds Start time of the server\'s first worker since the epoch. Counters restart from zero when it changes.',
+                '# TYPE process_start_time_seconds gauge',
+                f'process_start_time_seconds {started}',
+            ]
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples(totals.get(metric.name, {})):
+                rendered = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+                lines.append(f'{name}{{{rendered}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _flush_periodically(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(FLUSH_SECONDS)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception('Could not write the metrics to %s.', metrics_store.METRICS_DIR)
+
+    def _reset(self):
+        self._pid = None
+        self._lock = threading.Lock()
+        for metric in self.metrics:
+            metric.reset()
+
+
+class RequestStats:
+    """Figures for the request being served, read by the middleware when it finishes."""
+
+    __slots__ = ('started', 'queries', 'db_seconds', 'oauth_seconds', 'session_seconds', 'cache', 'trace')
+
+    def __init__(self, sampled=False):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.oauth_seconds = 0.0
+        self.session_seconds = 0.0
+        self.cache = {} # (cache, result) -> count
+        self.trace = {'queries': [], 'oauth': []} if sampled else None
+
+
+class MetricsMiddleware:
+    """
+    Records each request's latency, queries, cache lookups, OAuth calls, and
+    session time under its route. Works for both sync and async views, so it
+    does not add a thread hop under ASGI.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        stats = RequestStats(sampled=is_sampled())
+        token = current_stats.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        record_request(request, response, stats)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats(sampled=is_sampled())
+        token = current_stats.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        record_request(request, response, stats)
+        return response
+
+
+# Drop-in replacement for django.contrib.sessions.middleware.SessionMiddleware
+# that times the session backend's loads, saves, and deletes.
+class TimedSessionMiddleware(SessionMiddleware):
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.SessionStore = timed_session_store(self.SessionStore)
+
+
+#------- [Metrics] -------#
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    'django_http_request_duration_seconds', 'Time from the first middleware to the response, by route.', ('route', 'method')))
+responses = registry.register(Counter(
+    'django_http_responses_total', 'Responses by route and status code.', ('route', 'method', 'status')))
+db_queries = registry.register(Histogram(
+    'django_db_queries_per_request', 'Database queries run per request, by route.', ('route',), buckets=QUERY_COUNT_BUCKETS))
+db_seconds = registry.register(Counter(
+    'django_db_query_duration_seconds_total', 'Time spent in database queries, by route.', ('route',)))
+cache_requests = registry.register(Counter(
+    'django_cache_requests_total', 'Application cache lookups by route, cache, and result (hit or miss).', ('route', 'cache', 'result')))
+session_duration = registry.register(Histogram(
+    'django_session_backend_duration_seconds', 'Time per session backend operation.', ('operation',)))
+session_seconds = registry.register(Counter(
+    'django_session_backend_duration_seconds_total', 'Time spent in the session backend, by route.', ('route',)))
+oauth_duration = registry.register(Histogram(
+    'oauth_http_request_duration_seconds', 'Outbound OAuth HTTP calls, including retries, by host and status.', ('host', 'method', 'status')))
+login_queries = registry.register(Histogram(
+    'accounts_login_db_queries', 'Database queries made to persist a Google login, by outcome (returning or signup).', ('outcome',), buckets=QUERY_COUNT_BUCKETS))
+oauth_seconds = registry.register(Counter(
+    'oauth_http_request_duration_seconds_total', 'Time spent in outbound OAuth HTTP calls, by route.', ('route',)))
+
+# Stats for the request being served in this thread or task (None outside a request).
+current_stats = contextvars.ContextVar('djgoprod_request_stats', default=None)
+
+
+#------- [Functions] -------#
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def is_sampled():
+    rate = settings.METRICS_TRACE_SAMPLE_RATE
+    return rate > 0 and random.random() < rate
+
+# The route pattern the request resolved to, such as /accounts/check-auth/.
+def get_route(request):
+    match = getattr(request, 'resolver_match', None)
+    return '/' + match.route if match is not None else UNMATCHED_ROUTE
+
+def record_request(request, response, stats):
+    elapsed = time.perf_counter() - stats.started
+    route = get_route(request)
+    method = request.method if request.method in KNOWN_METHODS else 'other'
+    request_duration.observe((route, method), elapsed)
+    responses.inc((route, method, str(response.status_code)))
+    db_queries.observe((route,), stats.queries)
+    if stats.queries:
+        db_seconds.inc((route,), stats.db_seconds)
+    if stats.session_seconds:
+        session_seconds.inc((route,), stats.session_seconds)
+    if stats.oauth_seconds:
+        oauth_seconds.inc((route,), stats.oauth_seconds)
+    for (cache_name, result), count in stats.cache.items():
+        cache_requests.inc((route, cache_name, result), count)
+    if stats.trace is not None:
+        log_trace(route, method, response.status_code, elapsed, stats)
+
+def log_trace(route, method, status, elapsed, stats):
+    slowest = sorted(stats.trace['queries'], reverse=True)[:TRACE_MAX_QUERIES]
+    logger.info('trace %s', json.dumps({
+        'route': route,
+        'method': method,
+        'status': status,
+        'ms': round(elapsed * 1000, 2),
+        'queries': stats.queries,
+        'db_ms': round(stats.db_seconds * 1000, 2),
+        'session_ms': round(stats.session_seconds * 1000, 2),
+        'cache': {f'{cache_name}:{result}': count for (cache_name, result), count in stats.cache.items()},
+        'oauth': stats.trace['oauth'],
+        'slowest_queries': [{'ms': round(seconds * 1000, 2), 'sql': sql[:TRACE_MAX_SQL]} for seconds, sql in slowest],
+    }))
+
+# Database execute wrapper. Installed on every connection, it only counts while a request is being served.
+def instrument_query(execute, sql, params, many, context):
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start
+        stats.queries += 1
+        stats.db_seconds += seconds
+        if stats.trace is not None:
+            stats.trace['queries'].append((seconds, sql))
+
+# Connected to connection_created. Wrappers stay on the connection object across reconnects.
+def install_query_instrumentation(sender, connection, **kwargs):
+    if instrument_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrument_query)
+
+# Count a lookup in an application cache, such as the user cache or Google's keys.
+def record_cache(cache_name, hit):
+    result = 'hit' if hit else 'miss'
+    stats = current_stats.get()
+    if stats is None:
+        cache_requests.inc(('background', cache_name, result))
+        return
+    stats.cache[(cache_name, result)] = stats.cache.get((cache_name, result), 0) + 1
+
+# Receiver for accounts.signals.oauth_http_call.
+def record_oauth_call(sender, method, url, status, seconds, **kwargs):
+    host = urlsplit(url).hostname or ''
+    oauth_duration.observe((host, method, str(status) if status is not None else 'error'), seconds)
+    stats = current_stats.get()
+    if stats is not None:
+        stats.oauth_seconds += seconds
+        if stats.trace is not None:
+            stats.trace['oauth'].append({'host': host, 'status': status, 'ms': round(seconds * 1000, 2)})
+
+# Receiver for accounts.signals.social_login_persisted.
+def record_login_queries(sender, outcome, queries, **kwargs):
+    login_queries.observe((outcome,), queries)
+
+def record_session(operation, seconds):
+    session_duration.observe((operation,), seconds)
+    stats = current_stats.get()
+    if stats is not None:
+        stats.session_seconds += seconds
+
+# Subclass a session store so its backend operations are timed.
+def timed_session_store(store_class):
+
+    class TimedSessionStore(store_class):
+
+        # Sessions are signed with a salt named after the store class, keep the original.
+        @property
+        def key_salt(self):
+            return 'django.contrib.sessions.' + store_class.__qualname__
+
+        def load(self):
+            start = time.perf_counter()
+            try:
+                return super().load()
+            finally:
+                record_session('load', time.perf_counter() - start)
+
+        def save(self, must_create=False):
+            start = time.perf_counter()
+            try:
+                return super().save(must_create=must_create)
+            finally:
+                record_session('save', time.perf_counter() - start)
+
+        def delete(self, session_key=None):
+            start = time.perf_counter()
+            try:
+                return super().delete(session_key)
+            finally:
+                record_session('delete', time.perf_counter() - start)
+
+    return TimedSessionStore
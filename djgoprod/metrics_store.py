@@ -0,0 +1,141 @@
+"""
+metrics_store.py file for djgoprod app. Shares the request metrics between
+the server's worker processes, so /metrics reports the whole server
+whichever worker serves the scrape.
+
+Each worker keeps its figures in memory (djgoprod/metrics.py) and writes
+them to its own file in METRICS_DIR about once a second and when it exits.
+A scrape adds up every file. Once a worker has exited, for one replaced
+after its max requests, the next scrape merges its file into the totals of
+the exited workers, so counters never go down and there are only about as
+many files as workers. Merges and scrapes take a file lock, so a scrape
+never counts a worker twice or misses it. The lock is not taken in the
+Gunicorn master, whose hooks can run inside its signal handlers. Gunicorn
+clears the directory when the server starts (gunicorn.conf.py). Only the
+standard library is used, since gunicorn.conf.py imports this in the master.
+"""
+
+# Import required libraries for sharing the metrics between processes
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+
+#------- [Variables] -------#
+
+# One directory per checkout, unless METRICS_DIR is set.
+METRICS_DIR = Path(os.environ.get('METRICS_DIR') or Path(tempfile.gettempdir()) / f'djgoprod-metrics-{hashlib.sha256(str(Path(__file__).resolve().parent).encode()).hexdigest()[:12]}')
+
+# Totals of the workers that exited.
+EXITED_FILE = 'exited.json'
+
+LOCK_FILE = '.lock'
+
+
+#------- [Functions] -------#
+
+# Write a worker's figures: {'started': seconds since the epoch, 'metrics': {name: [[label values, value], ...]}}.
+# A value is a number, or a list of numbers for a histogram. The file is named <pid>-<anything>.json.
+def write_process(name, snapshot):
+    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+    _write(METRICS_DIR / f'{name}.json', snapshot)
+
+# The figures of every worker added up, with those of the exited workers: (earliest start, {name: {label values: value}}).
+# Files of workers that exited are merged first.
+def read_all():
+    if not METRICS_DIR.is_dir():
+        return None, {}
+    merge_exited()
+    started, totals = None, {}
+    with _lock(fcntl.LOCK_SH):
+        for path in [METRICS_DIR / EXITED_FILE, *_process_files()]:
+            snapshot = _read(path)
+            if snapshot is not None:
+                started = min(started or snapshot['started'], snapshot['started'])
+                _add(totals, snapshot['metrics'])
+    return started, totals
+
+# Merge the files of the workers no longer running into the exited totals.
+def merge_exited():
+    paths = [path for path in _process_files() if not _is_running(_pid(path))]
+    if not paths:
+        return
+    with _lock(fcntl.LOCK_EX):
+        exited = _read(METRICS_DIR / EXITED_FILE)
+        started, totals = (exited['started'], {}) if exited else (None, {})
+        if exited:
+            _add(totals, exited['metrics'])
+        for path in paths:
+            snapshot = _read(path)
+            if snapshot is not None:
+                started = min(started or snapshot['started'], snapshot['started'])
+                _add(totals, snapshot['metrics'])
+        if started is not None:
+            _write(METRICS_DIR / EXITED_FILE, {
+                'started': started,
+                'metrics': {name: [[list(labels), value] for labels, value in series.items()] for name, series in totals.items()},
+            })
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+# Remove every worker's figures. Gunicorn calls this when the server starts, before any worker.
+def clear():
+    if METRICS_DIR.is_dir():
+        for path in METRICS_DIR.glob('*.json'):
+            path.unlink(missing_ok=True)
+
+def _process_files():
+    return [path for path in METRICS_DIR.glob('*.json') if path.name != EXITED_FILE]
+
+def _pid(path):
+    pid = path.stem.partition('-')[0]
+    return int(pid) if pid.isdigit() else None
+
+def _is_running(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Add a snapshot's metrics into the totals. Histogram values are added bucket by bucket.
+def _add(totals, metrics):
+    for name, series in metrics.items():
+        merged = totals.setdefault(name, {})
+        for labels, value in series:
+            labels = tuple(labels)
+            current = merged.get(labels)
+            if current is None:
+                merged[labels] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                merged[labels] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[labels] = current + value
+
+def _read(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+def _write(path, snapshot):
+    temporary = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    temporary.write_text(json.dumps(snapshot))
+    os.replace(temporary, path) # Atomic, so a scrape never reads a partial file
+
+@contextmanager
+def _lock(operation):
+    with open(METRICS_DIR / LOCK_FILE, 'a') as file:
+        fcntl.flock(file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
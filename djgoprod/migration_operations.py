@@ -0,0 +1,39 @@
+"""
+migration_operations.py file for djgoprod app. Migration operations
+that build indexes without locking tables on PostgreSQL and fall back
+to plain operations on other databases (such as local SQLite).
+"""
+
+# Import required libraries for migration operations
+from django.contrib.postgres.operations import AddIndexConcurrently as PostgresAddIndexConcurrently
+from django.db.migrations.operations import AddIndex, RunSQL
+
+
+#------- [Classes] -------#
+
+# CREATE INDEX CONCURRENTLY on PostgreSQL, a normal CREATE INDEX elsewhere.
+# Migrations using it must set atomic = False.
+class AddIndexConcurrently(PostgresAddIndexConcurrently):
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+        super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+        super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+# Raw SQL that only runs on PostgreSQL, for indexes on tables owned by
+# third-party apps or index types Django cannot express.
+class PostgresRunSQL(RunSQL):
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
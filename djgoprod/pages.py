@@ -0,0 +1,74 @@
+"""
+pages.py file for djgoprod app. Cached rendering of the server-rendered
+pages (welcome and login) for anonymous visitors.
+
+An anonymous visitor's page only differs from another's by its CSRF token.
+The page is rendered once with a placeholder in place of the token and the
+HTML is cached. Each response then swaps in the visitor's own token, so
+every visitor still gets a token that matches their CSRF cookie. The cache
+key includes a hash of the template source and of the static files
+manifest, so a deploy that changes either never serves the old page.
+"""
+
+# Import required libraries for cached page rendering
+import hashlib
+
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.template.loader import get_template
+from django.urls import get_script_prefix
+from django.utils.cache import patch_cache_control
+
+
+#------- [Variables] -------#
+
+# Rendered where the {% csrf_token %} value goes, and replaced per response.
+CSRF_PLACEHOLDER = 'djgoprod-csrf-token-placeholder'
+
+# Seconds a rendered page is cached. Pages only change with a deploy, which changes the key.
+PAGE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Templates compiled when the app is ready, so the first request does not pay for it.
+WARM_TEMPLATES = ('welcome.html', 'login.html')
+
+_template_versions = {} # Template name -> (compiled template, source hash)
+_static_version = None
+
+
+#------- [Functions] -------#
+
+# Render an anonymous visitor's page from the cache, rendering and caching it on a miss.
+def render_anonymous_page(request, template_name):
+    key = f'pages:{template_name}:{_template_version(template_name)}:{static_files_version()}:{get_script_prefix()}'
+    content = cache.get(key)
+    if content is None:
+        content = get_template(template_name).render({'csrf_token': CSRF_PLACEHOLDER}, request)
+        cache.set(key, content, timeout=PAGE_CACHE_TIMEOUT)
+    # get_token also makes CsrfViewMiddleware set the CSRF cookie on the response
+    response = HttpResponse(content.replace(CSRF_PLACEHOLDER, get_token(request)))
+    patch_cache_control(response, private=True) # The token is per visitor, so shared caches must not keep it
+    return response
+
+# Compile the page templates into the cached template loader.
+def warm_templates():
+    for template_name in WARM_TEMPLATES:
+        _template_version(template_name)
+
+# Hash of the static files manifest, which maps {% static %} names to hashed file names.
+def static_files_version():
+    global _static_version
+    if _static_version is None:
+        hashed_files = getattr(staticfiles_storage, 'hashed_files', {})
+        _static_version = hashlib.sha256(repr(sorted(hashed_files.items())).encode()).hexdigest()[:12]
+    return _static_version
+
+# Hash of the template's source. Recomputed when the cached loader is reset, which
+# runserver does when a template changes.
+def _template_version(template_name):
+    template = get_template(template_name)
+    cached = _template_versions.get(template_name)
+    if cached is None or cached[0] is not template:
+        cached = _template_versions[template_name] = (template, hashlib.sha256(template.template.source.encode()).hexdigest()[:12])
+    return cached[1]
@@ -0,0 +1,69 @@
+"""
+server.py file for djgoprod app. Sizes the Gunicorn server in
+gunicorn.conf.py to the CPU and memory the container may use.
+
+Limits come from the cgroup (v2, or v1 on older hosts), since os.cpu_count()
+and the machine's memory are the host's, not the container's. Uvicorn
+workers serve requests on an event loop, so the server runs one worker per
+CPU. Threaded (gthread) workers run one worker per CPU with enough threads
+between them for 2 x CPUs + 1 requests at once. Either way there are no more
+workers than fit in the memory limit. Only the standard library is used,
+since gunicorn.conf.py imports this before Django is configured.
+"""
+
+# Import required libraries for reading the container limits
+import math
+import os
+from pathlib import Path
+
+
+#------- [Variables] -------#
+
+CGROUP_ROOT = Path('/sys/fs/cgroup')
+
+# cgroup v1 reports "no memory limit" as a huge number rather than "max".
+UNLIMITED_MEMORY = 2 ** 60
+
+# Memory kept free for the master process and the page cache.
+MASTER_MEMORY_MB = 128
+
+
+#------- [Functions] -------#
+
+# CPUs the container may use, possibly fractional (a 1.5 CPU quota is 1.5).
+def cpu_limit():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    return min(cpus, quota) if quota else cpus
+
+# Bytes of memory the container may use, or None without a limit.
+def memory_limit():
+    limit = _read_cgroup('memory.max') or _read_cgroup('memory/memory.limit_in_bytes')
+    if limit is None or limit == 'max' or not limit.isdigit() or int(limit) >= UNLIMITED_MEMORY:
+        return None
+    return int(limit)
+
+# Workers and threads per worker for the worker class ('uvicorn' or 'gthread').
+def size_workers(worker_class, cpus, memory_bytes, worker_memory_mb):
+    workers = max(1, math.ceil(cpus))
+    if memory_bytes is not None:
+        workers = max(1, min(workers, (memory_bytes // 2 ** 20 - MASTER_MEMORY_MB) // worker_memory_mb))
+    if worker_class != 'gthread':
+        return workers, 1
+    return workers, max(1, math.ceil((2 * cpus + 1) / workers))
+
+def _cgroup_cpu_quota():
+    quota = _read_cgroup('cpu.max') # v2: "<quota> <period>" or "max <period>"
+    if quota is not None:
+        quota, _, period = quota.partition(' ')
+    else:
+        quota, period = _read_cgroup('cpu/cpu.cfs_quota_us'), _read_cgroup('cpu/cpu.cfs_period_us') # v1: -1 for no quota
+    if quota is None or not quota.isdigit() or not period or not period.isdigit() or int(period) == 0:
+        return None
+    return int(quota) / int(period)
+
+def _read_cgroup(name):
+    try:
+        return (CGROUP_ROOT / name).read_text().strip()
+    except OSError:
+        return None
@@ -7,9 +7,10 @@ Date: 2024-06-01
 
 # ------------- [Import Libraries] -------------
 
-# Import the pathlib, os, warnings, and inspect libraries.
+# Import the pathlib, os, sys, warnings, and inspect libraries.
 from pathlib import Path
 import os
+import sys
 import warnings
 import inspect
 
@@ -17,7 +18,13 @@ import inspect
 import dj_database_url
 
 # Import functions from the global_utils.py file.
-from .global_utils import green_success, yellow_warning, red_critical
+from .global_utils import yellow_warning, red_critical
+
+# Import the cached validation of this file (see SETTINGS_TRANSCRIPT).
+from . import settings_check
+
+# Import the directory the workers share their metrics through (see METRICS_DIR).
+from . import metrics_store
 
 
 # ------------- [Important Variables] -------------
@@ -33,6 +40,9 @@ critical_warnings_exist = False
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Set when running the tests (python manage.py test).
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+
 
 # ------------- [Environment Variables] -------------
 
@@ -210,6 +220,68 @@ else:
         CSRF_TRUSTED_ORIGINS.append("https://"+host)
 
 
+"""
+Set the database connection reuse based upon the environment variables.
+These only apply to the PostgreSQL database.
+
+Requirements:
+    - DB_CONN_MAX_AGE: Seconds to keep a database connection open between
+requests. 0 closes the connection after each request. Only applies with
+GUNICORN_WORKER_CLASS=gthread, where the default is 60. Under ASGI (the
+uvicorn workers, the default) it is always 0: Django 4.0 runs each ASGI
+request's database work in a thread of its own, so a connection kept open
+past the request is never reused or closed and they pile up until the
+database refuses new ones (Django ticket #33497). Put PgBouncer in front of
+the database (DB_POOLER) to reuse connections under ASGI.
+        [Environment variable in: development, production (optional)]
+    - GUNICORN_WORKER_CLASS: uvicorn (ASGI, default) or gthread (WSGI), as read
+by gunicorn.conf.py.
+        [Environment variable in: development, production (optional)]
+    - DB_CONN_HEALTH_CHECKS: true or false. Checks that a reused connection is
+still alive before using it after it has been idle. The default is true.
+        [Environment variable in: development, production (optional)]
+    - DB_POOLER: Set to pgbouncer when PSQL_DATABASE_URL points at PgBouncer
+in transaction mode. This disables server-side cursors.
+        [Environment variable in: development, production (optional)]
+"""
+
+# Persistent connections are only safe with the threaded WSGI workers (see above).
+SERVES_WSGI = os.environ.get('GUNICORN_WORKER_CLASS', 'uvicorn').lower() == 'gthread'
+DB_CONN_MAX_AGE = os.environ.get('DB_CONN_MAX_AGE', '60' if SERVES_WSGI else '0')
+DB_CONN_HEALTH_CHECKS = os.environ.get('DB_CONN_HEALTH_CHECKS', 'true').lower()
+DB_POOLER = os.environ.get('DB_POOLER')
+
+# Check that the connection max age is a whole number of seconds. Otherwise, set it to 60 and warn the user.
+if not DB_CONN_MAX_AGE.isdigit():
+    running_deployment_transcript+= red_critical(f'[Critical] DB_CONN_MAX_AGE environment variable is invalid ("{DB_CONN_MAX_AGE}"). It must be a whole number of seconds. Defaulting to {60 if SERVES_WSGI else 0}. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    DB_CONN_MAX_AGE = '60' if SERVES_WSGI else '0'
+DB_CONN_MAX_AGE = int(DB_CONN_MAX_AGE)
+
+# Check that persistent connections are only asked for with the WSGI workers. Otherwise, close them after each request and warn the user.
+if DB_CONN_MAX_AGE and not SERVES_WSGI:
+    running_deployment_transcript+= red_critical(f'[Critical] DB_CONN_MAX_AGE is {DB_CONN_MAX_AGE} but the server runs ASGI workers, where persistent connections leak (Django ticket #33497). Using 0. Set GUNICORN_WORKER_CLASS=gthread to keep connections open, or use PgBouncer (DB_POOLER). (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    DB_CONN_MAX_AGE = 0
+
+# Check that health checks are set to true or false.
+if DB_CONN_HEALTH_CHECKS != 'true' and DB_CONN_HEALTH_CHECKS != 'false':
+    running_deployment_transcript+= red_critical(f'[Critical] DB_CONN_HEALTH_CHECKS environment variable is invalid ("{DB_CONN_HEALTH_CHECKS}"). Options are true or false. Defaulting to true. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    DB_CONN_HEALTH_CHECKS = 'true'
+DB_CONN_HEALTH_CHECKS = DB_CONN_HEALTH_CHECKS == 'true'
+
+# Make pooler all lowercase and check that it is valid.
+if DB_POOLER != None:
+    DB_POOLER = DB_POOLER.lower()
+    if DB_POOLER != 'pgbouncer':
+        running_deployment_transcript+= red_critical(f'[Critical] DB_POOLER environment variable is invalid ("{DB_POOLER}"). The only option is pgbouncer. Ignoring it. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_warnings_exist = True
+        DB_POOLER = None
+    elif PSQL_DATABASE_URL==None:
+        running_deployment_transcript+= yellow_warning(f'[Warning] DB_POOLER is set but PSQL_DATABASE_URL is not. DB_POOLER only applies to PostgreSQL. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+
+
 """
 Set the database based upon the deployment environment and 
 the environment variables.
@@ -234,8 +306,200 @@ if PSQL_DATABASE_URL==None:
 else:
     #connect to postgresql database from environment variables
     DATABASES = {
-        'default': dj_database_url.config(default=PSQL_DATABASE_URL)
-    }  
+        'default': dj_database_url.config(
+            default=PSQL_DATABASE_URL,
+            conn_max_age=DB_CONN_MAX_AGE,
+            conn_health_checks=DB_CONN_HEALTH_CHECKS,
+        )
+    }
+
+    # PgBouncer in transaction mode does not keep server-side cursors between transactions.
+    if DB_POOLER == 'pgbouncer':
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+    # Set the deployment transcript.
+    running_deployment_transcript+= f'\n [Logging] Database connections: max age {DB_CONN_MAX_AGE}s, health checks {"on" if DB_CONN_HEALTH_CHECKS else "off"}, pooler {DB_POOLER or "none"}. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n'
+
+
+"""
+The following environment variables are optional and add PostgreSQL read
+replicas. Reads of read-only requests (GET, HEAD, OPTIONS), such as
+check-auth, admin changelists, and profile reads, go to a replica. Writes,
+the reads of other requests (such as logins), and the requests of a client
+for a short while after it wrote stay on the primary (PSQL_DATABASE_URL).
+
+Requirements:
+    - PSQL_REPLICA_URLS: Comma-separated database URLs of the read replicas.
+        [Environment variable in: development, production (optional)]
+    - DB_REPLICA_STICKY_SECONDS: Seconds a client's reads stay on the primary
+after one of its requests wrote, tracked with a cookie. The default is 10.
+        [Environment variable in: development, production (optional)]
+    - DB_REPLICA_MAX_LAG: Seconds a replica may lag behind the primary before
+its reads go to the primary instead. The default is 5.
+        [Environment variable in: development, production (optional)]
+"""
+
+PSQL_REPLICA_URLS = os.environ.get('PSQL_REPLICA_URLS')
+DB_REPLICA_STICKY_SECONDS = os.environ.get('DB_REPLICA_STICKY_SECONDS', '10')
+DB_REPLICA_MAX_LAG = os.environ.get('DB_REPLICA_MAX_LAG', '5')
+
+# Check that the stickiness and lag are whole numbers of seconds. Otherwise, use the defaults and warn the user.
+if not DB_REPLICA_STICKY_SECONDS.isdigit() or not DB_REPLICA_MAX_LAG.isdigit():
+    running_deployment_transcript+= red_critical(f'[Critical] DB_REPLICA_STICKY_SECONDS or DB_REPLICA_MAX_LAG environment variable is not a valid whole number. Defaulting to 10 and 5. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    DB_REPLICA_STICKY_SECONDS, DB_REPLICA_MAX_LAG = '10', '5'
+DB_REPLICA_STICKY_SECONDS = int(DB_REPLICA_STICKY_SECONDS)
+DB_REPLICA_MAX_LAG = int(DB_REPLICA_MAX_LAG)
+
+# Add a database for each valid replica URL.
+REPLICA_DATABASES = []
+if PSQL_REPLICA_URLS != None:
+    if PSQL_DATABASE_URL==None:
+        running_deployment_transcript+= red_critical(f'[Critical] PSQL_REPLICA_URLS is set but PSQL_DATABASE_URL is not. Replicas are only supported with PostgreSQL. Ignoring them. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_warnings_exist = True
+    else:
+        for replica_url in [url.strip() for url in PSQL_REPLICA_URLS.split(',') if url.strip()]:
+            if not replica_url.startswith(('postgres://', 'postgresql://', 'pgsql://')):
+                running_deployment_transcript+= red_critical(f'[Critical] A PSQL_REPLICA_URLS entry is likely invalid (must start with postgres:// or postgresql://). Ignoring it. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+                critical_warnings_exist = True
+                continue
+            if replica_url == PSQL_DATABASE_URL:
+                running_deployment_transcript+= yellow_warning(f'[Warning] A PSQL_REPLICA_URLS entry is the same as PSQL_DATABASE_URL. Reads will go to the primary through a second connection. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+            alias = f'replica_{len(REPLICA_DATABASES) + 1}'
+            DATABASES[alias] = dj_database_url.parse(replica_url, conn_max_age=DB_CONN_MAX_AGE, conn_health_checks=DB_CONN_HEALTH_CHECKS)
+            DATABASES[alias]['TEST'] = {'MIRROR': 'default'} # Tests read the test primary
+            if DB_POOLER == 'pgbouncer':
+                DATABASES[alias]['DISABLE_SERVER_SIDE_CURSORS'] = True
+            REPLICA_DATABASES.append(alias)
+
+# Tests get a replica alias that mirrors the test database, so the routing rules can be
+# tested without replicas. The router is only enabled by the tests that use it.
+if TESTING and not REPLICA_DATABASES:
+    DATABASES['replica_1'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+
+if REPLICA_DATABASES:
+    DATABASE_ROUTERS = ['djgoprod.db.ReplicaRouter']
+
+    # Stickiness must outlast the allowed lag, or a client could read rows older than its own write.
+    if DB_REPLICA_MAX_LAG >= DB_REPLICA_STICKY_SECONDS:
+        running_deployment_transcript+= yellow_warning(f'[Warning] DB_REPLICA_MAX_LAG ({DB_REPLICA_MAX_LAG}s) is not below DB_REPLICA_STICKY_SECONDS ({DB_REPLICA_STICKY_SECONDS}s). Clients may not see their own writes after a login. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+
+    # Set the deployment transcript.
+    running_deployment_transcript+= f'\n [Logging] Read replicas: {len(REPLICA_DATABASES)}, sticky for {DB_REPLICA_STICKY_SECONDS}s after a write, max lag {DB_REPLICA_MAX_LAG}s. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n'
+
+
+"""
+Set the cache and session storage based upon the environment variables.
+If REDIS_URL is provided, a shared Redis cache is used, otherwise a local
+memory cache is used in each worker process.
+
+Requirements:
+    - REDIS_URL: A Redis URL (redis://, rediss://, or unix://) for the shared cache.
+        [Environment variable in: development, production (optional)]
+    - SESSION_STORAGE: Where sessions are stored. Options are db (database only),
+cached_db (database with cache reads), and cache (cache only, requires REDIS_URL).
+The default is cached_db if REDIS_URL is set, otherwise db.
+        [Environment variable in: local, development, production (optional)]
+"""
+
+REDIS_URL = os.environ.get('REDIS_URL')
+SESSION_STORAGE = os.environ.get('SESSION_STORAGE')
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+if REDIS_URL==None:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'djgoprod',
+        }
+    }
+    if DEPLOYMENT == 'production':
+        running_deployment_transcript+= yellow_warning(f'[Warning] REDIS_URL environment variable not set. Each worker uses its own local memory cache. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+else:
+    if not REDIS_URL.startswith(('redis://', 'rediss://', 'unix://')):
+        running_deployment_transcript+= red_critical(f'[Critical] REDIS_URL environment variable is likely invalid (must start with redis://, rediss://, or unix://). (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_warnings_exist = True
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'djgoprod',
+            'OPTIONS': {
+                # Fail fast instead of hanging requests when Redis is unreachable.
+                'socket_connect_timeout': 2,
+                'socket_timeout': 2,
+            },
+        }
+    }
+
+# Make session storage all lowercase and set the default.
+if SESSION_STORAGE != None:
+    SESSION_STORAGE = SESSION_STORAGE.lower()
+else:
+    SESSION_STORAGE = 'db' if REDIS_URL==None else 'cached_db'
+
+# Check that the session storage is valid. Otherwise, set it to 'db' and warn the user.
+if SESSION_STORAGE != 'db' and SESSION_STORAGE != 'cached_db' and SESSION_STORAGE != 'cache':
+    running_deployment_transcript+= red_critical(f'[Critical] SESSION_STORAGE environment variable is invalid ("{SESSION_STORAGE}"). Options are db, cached_db, or cache. Defaulting to db. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    SESSION_STORAGE = 'db'
+
+# Cache-only sessions in a local memory cache would be lost on restart and not shared between workers.
+if SESSION_STORAGE == 'cache' and REDIS_URL==None:
+    running_deployment_transcript+= red_critical(f'[Critical] SESSION_STORAGE is set to cache but REDIS_URL is not set. Sessions would not be shared between workers. Defaulting to db. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    SESSION_STORAGE = 'db'
+
+# Cached sessions are only shared between workers with a shared cache.
+if SESSION_STORAGE == 'cached_db' and REDIS_URL==None:
+    running_deployment_transcript+= yellow_warning(f'[Warning] SESSION_STORAGE is set to cached_db without REDIS_URL. Each worker caches sessions separately. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+
+SESSION_ENGINE = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+}[SESSION_STORAGE]
+
+"""
+Set the authenticated user cache. When enabled, request.user is served from a
+cached snapshot of the user instead of a database query on every request.
+Snapshots are dropped when the user is saved or deleted, so the cache must be
+shared between workers (REDIS_URL).
+
+Requirements:
+    - AUTH_USER_CACHE: true or false. The default is true if REDIS_URL is set, otherwise false.
+        [Environment variable in: local, development, production (optional)]
+    - AUTH_USER_CACHE_TIMEOUT: Seconds a snapshot is kept. The default is 300.
+        [Environment variable in: local, development, production (optional)]
+"""
+
+AUTH_USER_CACHE = os.environ.get('AUTH_USER_CACHE', 'false' if REDIS_URL==None else 'true').lower()
+AUTH_USER_CACHE_TIMEOUT = os.environ.get('AUTH_USER_CACHE_TIMEOUT', '300')
+
+# Check that the user cache is set to true or false.
+if AUTH_USER_CACHE != 'true' and AUTH_USER_CACHE != 'false':
+    running_deployment_transcript+= red_critical(f'[Critical] AUTH_USER_CACHE environment variable is invalid ("{AUTH_USER_CACHE}"). Options are true or false. Defaulting to false. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    AUTH_USER_CACHE = 'false'
+AUTH_USER_CACHE = AUTH_USER_CACHE == 'true'
+
+# A local memory cache would keep serving a changed user from other workers' caches.
+if AUTH_USER_CACHE and REDIS_URL==None:
+    running_deployment_transcript+= red_critical(f'[Critical] AUTH_USER_CACHE is set to true but REDIS_URL is not set. User changes would not reach other workers. Defaulting to false. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    AUTH_USER_CACHE = False
+
+# Check that the timeout is a whole number of seconds.
+if not AUTH_USER_CACHE_TIMEOUT.isdigit():
+    running_deployment_transcript+= red_critical(f'[Critical] AUTH_USER_CACHE_TIMEOUT environment variable is invalid ("{AUTH_USER_CACHE_TIMEOUT}"). It must be a whole number of seconds. Defaulting to 300. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    AUTH_USER_CACHE_TIMEOUT = '300'
+AUTH_USER_CACHE_TIMEOUT = int(AUTH_USER_CACHE_TIMEOUT)
+
+# Set the deployment transcript.
+running_deployment_transcript+= f'\n [Logging] Using {CACHES["default"]["BACKEND"].split(".")[-1]} cache with {SESSION_STORAGE} sessions. User cache is {"on" if AUTH_USER_CACHE else "off"}. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n'
 
 
 """
@@ -252,6 +516,245 @@ SOCIALACCOUNT_PROVIDERS = {
     }
 }
 
+# Keeps the Google profile fields on the user in sync on each login
+SOCIALACCOUNT_ADAPTER = 'accounts.adapters.SocialAccountAdapter'
+
+
+"""
+The following environment variables are optional and used to override where
+Google's OpenID discovery document and signing keys (JWKS) are fetched from,
+for example to test against a local stand-in key server.
+
+Requirements:
+    - GOOGLE_DISCOVERY_URL: URL of the OpenID discovery document.
+        The default is Google's discovery document.
+    - GOOGLE_JWKS_URL: URL of the signing keys. The default is the jwks_uri
+        from the discovery document.
+"""
+
+GOOGLE_DISCOVERY_URL = os.environ.get("GOOGLE_DISCOVERY_URL", "https://accounts.google.com/.well-known/openid-configuration")
+GOOGLE_JWKS_URL = os.environ.get("GOOGLE_JWKS_URL")
+
+for google_url in (GOOGLE_DISCOVERY_URL, GOOGLE_JWKS_URL):
+    if google_url != None and not google_url.startswith("https://"):
+        if DEPLOYMENT == 'production':
+            running_deployment_transcript+= red_critical(f'[Critical] {google_url} is not an https URL. Google keys must be fetched over https in production. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+            critical_warnings_exist = True
+        else:
+            running_deployment_transcript+= yellow_warning(f'[Warning] Fetching Google keys from {google_url}. This is ok if using a local stand-in key server. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+
+
+"""
+The following environment variables are optional and configure the shared
+HTTP session used for outbound calls to Google (code exchange and keys).
+
+Requirements:
+    - OAUTH_HTTP_CONNECT_TIMEOUT: Connect timeout in seconds. The default is 3.05.
+    - OAUTH_HTTP_READ_TIMEOUT: Read timeout in seconds. The default is 10.
+    - OAUTH_HTTP_RETRIES: Retries for connection errors, and for idempotent
+        calls that fail or return a 429/5xx status. The default is 2.
+    - OAUTH_HTTP_POOL_SIZE: Keep-alive connections per host per worker. The default is 10.
+"""
+
+OAUTH_HTTP_CONNECT_TIMEOUT = os.environ.get('OAUTH_HTTP_CONNECT_TIMEOUT', '3.05')
+OAUTH_HTTP_READ_TIMEOUT = os.environ.get('OAUTH_HTTP_READ_TIMEOUT', '10')
+OAUTH_HTTP_RETRIES = os.environ.get('OAUTH_HTTP_RETRIES', '2')
+OAUTH_HTTP_POOL_SIZE = os.environ.get('OAUTH_HTTP_POOL_SIZE', '10')
+
+# Check that the timeouts are positive numbers. Otherwise, use the defaults and warn the user.
+try:
+    OAUTH_HTTP_CONNECT_TIMEOUT = float(OAUTH_HTTP_CONNECT_TIMEOUT)
+    OAUTH_HTTP_READ_TIMEOUT = float(OAUTH_HTTP_READ_TIMEOUT)
+    assert OAUTH_HTTP_CONNECT_TIMEOUT > 0 and OAUTH_HTTP_READ_TIMEOUT > 0
+except (ValueError, AssertionError):
+    running_deployment_transcript+= red_critical(f'[Critical] OAUTH_HTTP_CONNECT_TIMEOUT or OAUTH_HTTP_READ_TIMEOUT environment variable is not a positive number. Defaulting to 3.05 and 10. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    OAUTH_HTTP_CONNECT_TIMEOUT, OAUTH_HTTP_READ_TIMEOUT = 3.05, 10.0
+
+# Check that the retries and pool size are whole numbers. Otherwise, use the defaults and warn the user.
+if not OAUTH_HTTP_RETRIES.isdigit() or not OAUTH_HTTP_POOL_SIZE.isdigit() or int(OAUTH_HTTP_POOL_SIZE) < 1:
+    running_deployment_transcript+= red_critical(f'[Critical] OAUTH_HTTP_RETRIES or OAUTH_HTTP_POOL_SIZE environment variable is not a valid whole number. Defaulting to 2 and 10. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    OAUTH_HTTP_RETRIES, OAUTH_HTTP_POOL_SIZE = '2', '10'
+OAUTH_HTTP_RETRIES = int(OAUTH_HTTP_RETRIES)
+OAUTH_HTTP_POOL_SIZE = int(OAUTH_HTTP_POOL_SIZE)
+
+
+"""
+The following environment variables are optional and configure admission
+control for the Google login endpoints. Each worker runs at most
+LOGIN_CONCURRENCY_LIMIT logins at once (each waits on calls to Google), and
+answers any more with a fast 503 and a Retry-After header instead of queuing
+them. Requests from one client (CSRF or session cookie) repeating an
+authorization code that is still being exchanged are coalesced into one login,
+across workers when the cache is shared (REDIS_URL). Once the login finishes,
+a repeated code goes to Google, which rejects it.
+
+Requirements:
+    - LOGIN_CONCURRENCY_LIMIT: Logins in progress per worker. 0 means no limit. The default is 20.
+    - LOGIN_RETRY_AFTER: Seconds a shed request is told to wait before retrying.
+        Each response adds up to the same again as jitter. The default is 2.
+"""
+
+LOGIN_CONCURRENCY_LIMIT = os.environ.get('LOGIN_CONCURRENCY_LIMIT', '20')
+LOGIN_RETRY_AFTER = os.environ.get('LOGIN_RETRY_AFTER', '2')
+
+# Check that the limit and retry delay are whole numbers. Otherwise, use the defaults and warn the user.
+if not LOGIN_CONCURRENCY_LIMIT.isdigit() or not LOGIN_RETRY_AFTER.isdigit() or int(LOGIN_RETRY_AFTER) < 1:
+    running_deployment_transcript+= red_critical(f'[Critical] LOGIN_CONCURRENCY_LIMIT or LOGIN_RETRY_AFTER environment variable is not a valid whole number. Defaulting to 20 and 2. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    LOGIN_CONCURRENCY_LIMIT, LOGIN_RETRY_AFTER = '20', '2'
+LOGIN_CONCURRENCY_LIMIT = int(LOGIN_CONCURRENCY_LIMIT)
+LOGIN_RETRY_AFTER = int(LOGIN_RETRY_AFTER)
+
+
+"""
+The following environment variables are optional and configure the request
+metrics served in the Prometheus text format at /metrics. Metrics are
+aggregated in memory per worker, so they are cheap enough to leave on, and
+added up across the workers through files in METRICS_DIR.
+
+Requirements:
+    - METRICS_ENABLED: true or false. The default is true.
+    - METRICS_TOKEN: Bearer token required to read /metrics. Without it,
+        /metrics is public, and in production it is not served at all.
+    - METRICS_DIR: Directory the workers share their figures through. The
+        default is a directory in the system temporary directory. Read by
+        djgoprod/metrics_store.py.
+    - METRICS_TRACE_SAMPLE_RATE: Fraction of requests (0 to 1) logged as a
+        single-line trace with their slowest queries. The default is 0.
+"""
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower()
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_TRACE_SAMPLE_RATE = os.environ.get('METRICS_TRACE_SAMPLE_RATE', '0')
+
+# Check that metrics are set to true or false.
+if METRICS_ENABLED != 'true' and METRICS_ENABLED != 'false':
+    running_deployment_transcript+= red_critical(f'[Critical] METRICS_ENABLED environment variable is invalid ("{METRICS_ENABLED}"). Options are true or false. Defaulting to true. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    METRICS_ENABLED = 'true'
+METRICS_ENABLED = METRICS_ENABLED == 'true'
+
+# Check that the sample rate is a fraction. Otherwise, turn tracing off and warn the user.
+try:
+    METRICS_TRACE_SAMPLE_RATE = float(METRICS_TRACE_SAMPLE_RATE)
+    assert 0 <= METRICS_TRACE_SAMPLE_RATE <= 1
+except (ValueError, AssertionError):
+    running_deployment_transcript+= red_critical(f'[Critical] METRICS_TRACE_SAMPLE_RATE environment variable is invalid ("{METRICS_TRACE_SAMPLE_RATE}"). It must be a number from 0 to 1. Defaulting to 0. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    METRICS_TRACE_SAMPLE_RATE = 0.0
+
+# Route and timing data must not be public in production, so /metrics is only served there with a token.
+METRICS_SERVED = METRICS_ENABLED
+if METRICS_ENABLED and METRICS_TOKEN==None and DEPLOYMENT == 'production':
+    running_deployment_transcript+= yellow_warning(f'[Warning] METRICS_TOKEN is not set. /metrics is not served in production without it. Metrics are still recorded for the request traces. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    METRICS_SERVED = False
+
+if METRICS_SERVED:
+    running_deployment_transcript+= f'\n [Logging] Metrics are served at /metrics{" (token required)" if METRICS_TOKEN else ""}, shared by the workers in {metrics_store.METRICS_DIR}. Trace sample rate is {METRICS_TRACE_SAMPLE_RATE}. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n'
+
+
+
+"""
+The following environment variables are optional and configure the stateless
+authentication mode for the REST API. When enabled, the Google login endpoints
+return a short-lived signed access token and a rotating refresh token instead
+of starting a session, and API requests authenticate with the access token
+without a session, user, or cache lookup.
+
+Requirements:
+    - STATELESS_AUTH: true or false. The default is false.
+    - STATELESS_ACCESS_TOKEN_LIFETIME: Seconds an access token is valid. The default is 300.
+    - STATELESS_REFRESH_TOKEN_LIFETIME: Seconds a refresh token is valid. The default is 1209600 (14 days).
+        Every login and refresh stores a row, and python manage.py purge_sessions deletes
+        the expired ones.
+"""
+
+STATELESS_AUTH = os.environ.get('STATELESS_AUTH', 'false').lower()
+STATELESS_ACCESS_TOKEN_LIFETIME = os.environ.get('STATELESS_ACCESS_TOKEN_LIFETIME', '300')
+STATELESS_REFRESH_TOKEN_LIFETIME = os.environ.get('STATELESS_REFRESH_TOKEN_LIFETIME', '1209600')
+
+# Check that the stateless mode is set to true or false.
+if STATELESS_AUTH != 'true' and STATELESS_AUTH != 'false':
+    running_deployment_transcript+= red_critical(f'[Critical] STATELESS_AUTH environment variable is invalid ("{STATELESS_AUTH}"). Options are true or false. Defaulting to false. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    STATELESS_AUTH = 'false'
+STATELESS_AUTH = STATELESS_AUTH == 'true'
+
+# Check that the lifetimes are positive whole numbers of seconds. Otherwise, use the defaults and warn the user.
+if not STATELESS_ACCESS_TOKEN_LIFETIME.isdigit() or not STATELESS_REFRESH_TOKEN_LIFETIME.isdigit() or int(STATELESS_ACCESS_TOKEN_LIFETIME) < 1 or int(STATELESS_REFRESH_TOKEN_LIFETIME) <= int(STATELESS_ACCESS_TOKEN_LIFETIME):
+    running_deployment_transcript+= red_critical(f'[Critical] STATELESS_ACCESS_TOKEN_LIFETIME or STATELESS_REFRESH_TOKEN_LIFETIME environment variable is invalid. They must be whole numbers of seconds, with the refresh token living longer. Defaulting to 300 and 1209600. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    STATELESS_ACCESS_TOKEN_LIFETIME, STATELESS_REFRESH_TOKEN_LIFETIME = '300', '1209600'
+STATELESS_ACCESS_TOKEN_LIFETIME = int(STATELESS_ACCESS_TOKEN_LIFETIME)
+STATELESS_REFRESH_TOKEN_LIFETIME = int(STATELESS_REFRESH_TOKEN_LIFETIME)
+
+# Logouts reach other workers through the shared cache.
+if STATELESS_AUTH and REDIS_URL==None:
+    running_deployment_transcript+= yellow_warning(f'[Warning] STATELESS_AUTH is set to true without REDIS_URL. After a logout, other workers accept the access token until it expires ({STATELESS_ACCESS_TOKEN_LIFETIME}s). (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+
+if STATELESS_AUTH:
+    running_deployment_transcript+= f'\n [Logging] Stateless API authentication is on. Access tokens last {STATELESS_ACCESS_TOKEN_LIFETIME}s, refresh tokens {STATELESS_REFRESH_TOKEN_LIFETIME}s. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n'
+
+
+
+"""
+Set the channel layer that pushes login, logout, and session expiry events
+to WebSocket clients on /ws/auth/. The redis layer reaches clients connected
+to any worker or node. The memory layer only reaches clients connected to
+the worker that handled the login or logout.
+
+Requirements:
+    - CHANNEL_LAYER: memory or redis. The default is redis if REDIS_URL is set, otherwise memory.
+        [Environment variable in: local, development, production (optional)]
+"""
+
+CHANNEL_LAYER = os.environ.get('CHANNEL_LAYER', 'memory' if REDIS_URL==None else 'redis').lower()
+
+# Check that the channel layer is valid. Otherwise, set it to memory and warn the user.
+if CHANNEL_LAYER != 'memory' and CHANNEL_LAYER != 'redis':
+    running_deployment_transcript+= red_critical(f'[Critical] CHANNEL_LAYER environment variable is invalid ("{CHANNEL_LAYER}"). Options are memory or redis. Defaulting to memory. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    CHANNEL_LAYER = 'memory'
+
+# The redis layer needs a Redis server.
+if CHANNEL_LAYER == 'redis' and REDIS_URL==None:
+    running_deployment_transcript+= red_critical(f'[Critical] CHANNEL_LAYER is set to redis but REDIS_URL is not set. Defaulting to memory. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_warnings_exist = True
+    CHANNEL_LAYER = 'memory'
+
+# With several workers, the memory layer misses most clients.
+if CHANNEL_LAYER == 'memory' and DEPLOYMENT == 'production':
+    running_deployment_transcript+= yellow_warning(f'[Warning] CHANNEL_LAYER is memory. Auth events only reach WebSocket clients on the same worker. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+
+running_deployment_transcript+= f'\n [Logging] Using {CHANNEL_LAYER} channel layer for auth events on /ws/auth/. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n'
+
+
+"""
+Set how the deployment transcript of this file is reported. Every worker
+process imports settings.py, so printing the transcript in each one repeats
+it (and any critical warnings) once per worker on every start and restart.
+
+Requirements:
+    - SETTINGS_TRANSCRIPT: always, once, or quiet. The default is always in local, otherwise once.
+        always prints the transcript in every process. once prints it only
+        when this environment has not been validated yet (python manage.py
+        check_settings, or the first process to start), and caches the result.
+        quiet never prints it. once and quiet still print one line if
+        critical warnings exist.
+        [Environment variable in: local, development, production (optional)]
+"""
+
+SETTINGS_TRANSCRIPT = os.environ.get('SETTINGS_TRANSCRIPT', 'always' if DEPLOYMENT == 'local' else 'once').lower()
+
+# Check that the transcript mode is valid. Otherwise, set it to always and warn the user.
+if SETTINGS_TRANSCRIPT not in ('always', 'once', 'quiet'):
+    running_deployment_transcript+= yellow_warning(f'[Warning] SETTINGS_TRANSCRIPT environment variable is invalid ("{SETTINGS_TRANSCRIPT}"). Options are always, once, or quiet. Defaulting to always. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    SETTINGS_TRANSCRIPT = 'always'
+
+running_deployment_transcript+= f'\n [Logging] Settings transcript is reported {SETTINGS_TRANSCRIPT}. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n'
+
 
 # ------------- [Other Application Settings] -------------
 
@@ -309,7 +812,7 @@ AUTH_USER_MODEL = "accounts.CustomUser"
 # Using session-based auth instead of JWT or other token-based auth. This can be reconfigured. It is an opinionated design choice that Django makes easy to change.
 REST_AUTH = {
     'TOKEN_MODEL': None,
-    'SESSION_LOGIN': True,
+    'SESSION_LOGIN': True, # In stateless mode the session login is dropped and signed tokens are returned
 }
 
 REST_FRAMEWORK = {
@@ -322,6 +825,10 @@ REST_FRAMEWORK = {
     ]
 }
 
+# Accept signed access tokens before falling back to sessions.
+if STATELESS_AUTH:
+    REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'].insert(0, 'accounts.authentication.SignedTokenAuthentication')
+
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -335,14 +842,35 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Serve request.user from the user cache when enabled.
+if AUTH_USER_CACHE:
+    MIDDLEWARE[MIDDLEWARE.index('django.contrib.auth.middleware.AuthenticationMiddleware')] = 'accounts.middleware.CachedAuthenticationMiddleware'
+
+# Route the reads of read-only requests to replicas. Placed before the session middleware,
+# so a session save counts as a write.
+if REPLICA_DATABASES:
+    MIDDLEWARE.insert(MIDDLEWARE.index('django.contrib.sessions.middleware.SessionMiddleware'), 'djgoprod.db.ReplicaRoutingMiddleware')
+
+# Record request metrics first, so the time spent in every other middleware is included.
+if METRICS_ENABLED:
+    MIDDLEWARE.insert(0, 'djgoprod.metrics.MetricsMiddleware')
+    MIDDLEWARE[MIDDLEWARE.index('django.contrib.sessions.middleware.SessionMiddleware')] = 'djgoprod.metrics.TimedSessionMiddleware'
+
 ROOT_URLCONF = 'djgoprod.urls'
 
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compiled templates are cached in every deployment, and warmed when the djgoprod app
+            # is ready (djgoprod/pages.py). runserver resets the cache when a template changes.
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -354,12 +882,26 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'djgoprod.wsgi.application'
-
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-    },
-}
+ASGI_APPLICATION = 'djgoprod.asgi.application'
+
+# Channel layer for the auth state WebSocket. Redis pub/sub fits events that
+# are only useful to clients connected right now.
+if CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+            "CONFIG": {
+                "hosts": [REDIS_URL],
+                "prefix": "djgoprod",
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
 
 
 # Password validation
@@ -399,6 +941,14 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# collectstatic writes content-hashed, gzip and Brotli precompressed copies of the static
+# files, which WhiteNoise serves with immutable caching. See djgoprod/storage.py.
+STATICFILES_STORAGE = 'djgoprod.storage.StaticFilesStorage'
+
+# Tests render pages without running collectstatic first, so there is no manifest to read.
+if TESTING:
+    STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
@@ -406,20 +956,26 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
-# ------------- [Print Results] -------------
+# Logging
+# Sampled request traces are logged at INFO by djgoprod.metrics.
 
-# Print divider
-print("--------------------------")
+if METRICS_TRACE_SAMPLE_RATE > 0:
+    LOGGING = {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'handlers': {
+            'console': {'class': 'logging.StreamHandler'},
+        },
+        'loggers': {
+            'djgoprod.metrics': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+        },
+    }
 
-# Print the deployment transcript.
-print(running_deployment_transcript)
 
-# Print the results of the settings.py deployment.
-if critical_warnings_exist:
-    print(red_critical(f'Critical warnings exist. Please fix before deploying. ({DEPLOYMENT} deployment)'))
-else:
-    print(green_success(f'No errors found in settings.py {DEPLOYMENT} deployment.'))
-print("\n")
+# ------------- [Print Results] -------------
 
+# Print the deployment transcript and the results of the settings.py deployment, or
+# stay quiet if this environment was already validated (see SETTINGS_TRANSCRIPT).
 DEPLOYMENT_TRANSCRIPT = running_deployment_transcript
-CRIT_WARNINGS_EXIST = critical_warnings_exist
\ No newline at end of file
+CRIT_WARNINGS_EXIST = critical_warnings_exist
+DEPLOYMENT_TRANSCRIPT_PRINTED = settings_check.report(SETTINGS_TRANSCRIPT, running_deployment_transcript, critical_warnings_exist, DEPLOYMENT)
@@ -0,0 +1,92 @@
+"""
+settings_check.py file for djgoprod app. Caches the result of the
+settings.py validation per environment, so the deployment transcript is
+reported once instead of by every worker.
+
+The cache is keyed by a fingerprint of settings.py and the environment
+variables it reads. python manage.py check_settings validates and caches
+the current environment (run it in the entrypoint before the server starts),
+and settings.py then stays quiet in every worker with the same environment
+(SETTINGS_TRANSCRIPT=once). Only the standard library is used, since
+settings.py imports this before Django is configured.
+"""
+
+# Import required libraries for fingerprinting and caching the validation
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+from .global_utils import green_success, red_critical
+
+
+#------- [Variables] -------#
+
+SETTINGS_FILE = Path(__file__).resolve().with_name('settings.py')
+
+# Environment variables read by settings.py, found in its source.
+ENV_VAR_PATTERN = re.compile(rb'os\.environ\.get\(\s*[\'"]([A-Z0-9_]+)[\'"]')
+
+# One cached result per checkout, shared by every process on the machine.
+CACHE_FILE = Path(tempfile.gettempdir()) / f'djgoprod-settings-check-{hashlib.sha256(str(SETTINGS_FILE).encode()).hexdigest()[:12]}.json'
+
+
+#------- [Functions] -------#
+
+# Fingerprint of settings.py and the values of the environment variables it reads.
+def environment_fingerprint():
+    source = SETTINGS_FILE.read_bytes()
+    digest = hashlib.sha256(source)
+    for name in sorted(set(ENV_VAR_PATTERN.findall(source))):
+        value = os.environ.get(name.decode())
+        digest.update(name + b'=' + (b'\x00' if value is None else value.encode()) + b'\n')
+    return digest.hexdigest()
+
+# The cached result ({'critical': bool, 'deployment': str}) for this fingerprint, or None.
+def cached_result(fingerprint):
+    try:
+        result = json.loads(CACHE_FILE.read_text())
+    except (OSError, ValueError):
+        return None
+    return result if isinstance(result, dict) and result.get('fingerprint') == fingerprint else None
+
+def save_result(fingerprint, critical, deployment):
+    temporary = CACHE_FILE.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        temporary.write_text(json.dumps({'fingerprint': fingerprint, 'critical': critical, 'deployment': deployment}))
+        os.replace(temporary, CACHE_FILE) # Atomic, so workers never read a partial file
+    except OSError:
+        pass # The cache only saves printing, so a read-only filesystem is not an error
+
+# Printed to stderr, so the transcript never mixes with a command's output on stdout
+# (python manage.py export_users - for one).
+def print_transcript(transcript, critical, deployment):
+    print("--------------------------", file=sys.stderr)
+    print(transcript, file=sys.stderr)
+    if critical:
+        print(red_critical(f'Critical warnings exist. Please fix before deploying. ({deployment} deployment)'), file=sys.stderr)
+    else:
+        print(green_success(f'No errors found in settings.py {deployment} deployment.'), file=sys.stderr)
+    print("\n", file=sys.stderr)
+
+# Print the transcript as SETTINGS_TRANSCRIPT asks. Returns True if it was printed.
+#   always: every process prints it.
+#   once: printed unless this environment was already validated, then cached. Critical
+#         warnings are still reported in one line.
+#   quiet: never printed, except the one line for critical warnings.
+def report(mode, transcript, critical, deployment):
+    if mode == 'always':
+        print_transcript(transcript, critical, deployment)
+        return True
+    if mode == 'once':
+        fingerprint = environment_fingerprint()
+        if cached_result(fingerprint) is None:
+            print_transcript(transcript, critical, deployment)
+            save_result(fingerprint, critical, deployment)
+            return True
+    if critical:
+        print(red_critical(f'Critical warnings exist in settings.py ({deployment} deployment). Run python manage.py check_settings to see them.'), file=sys.stderr)
+    return False
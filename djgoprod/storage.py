@@ -0,0 +1,75 @@
+"""
+storage.py file for djgoprod app. Static files storage used by
+collectstatic to build the assets WhiteNoise serves.
+
+Each file is written under a content-hashed name (logo.3f2a1b9c.png) next to
+its original name, with gzip and Brotli variants of every compressible file
+(WhiteNoise's CompressedManifestStaticFilesStorage). WhiteNoise serves the
+hashed names with a ten year, immutable Cache-Control header, and picks the
+smallest variant the client accepts, so nothing is compressed per request.
+PNG images are also recompressed losslessly as they are written.
+"""
+
+# Import required libraries for the static files pipeline
+import struct
+import zlib
+
+from django.core.files.base import ContentFile
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+#------- [Variables] -------#
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Chunks that change how a PNG looks. Ancillary chunks not listed here (text,
+# timestamps, and other editor metadata) are dropped.
+PNG_KEPT_CHUNKS = {b'IHDR', b'PLTE', b'IDAT', b'IEND', b'tRNS', b'gAMA', b'cHRM', b'sRGB', b'iCCP', b'sBIT', b'pHYs'}
+
+
+#------- [Classes] -------#
+
+class StaticFilesStorage(CompressedManifestStaticFilesStorage):
+    """Hashed, precompressed static files, with PNGs losslessly optimized."""
+
+    def _save(self, name, content):
+        if name.lower().endswith('.png'):
+            data = content.read()
+            content = ContentFile(optimize_png(data))
+        return super()._save(name, content)
+
+
+#------- [Functions] -------#
+
+# Recompress a PNG's image data at the highest zlib level and drop its metadata chunks.
+# The pixels are unchanged. Returns the original bytes if that is not smaller, or if
+# the file is not a PNG this can parse (such as an APNG, whose frames are left alone).
+def optimize_png(data):
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    chunks, image_data = [], []
+    position = len(PNG_SIGNATURE)
+    try:
+        while position < len(data):
+            length, kind = struct.unpack('>I4s', data[position:position + 8])
+            body = data[position + 8:position + 8 + length]
+            position += 12 + length
+            if kind == b'IDAT':
+                if not image_data:
+                    chunks.append((kind, None)) # Where the merged image data goes
+                image_data.append(body)
+            elif kind in (b'acTL', b'fdAT'):
+                return data
+            elif kind in PNG_KEPT_CHUNKS:
+                chunks.append((kind, body))
+        pixels = zlib.decompress(b''.join(image_data))
+    except (struct.error, zlib.error):
+        return data
+
+    output = [PNG_SIGNATURE]
+    for kind, body in chunks:
+        if body is None:
+            body = zlib.compress(pixels, 9)
+        output.append(struct.pack('>I4s', len(body), kind) + body + struct.pack('>I', zlib.crc32(kind + body)))
+    optimized = b''.join(output)
+    return optimized if len(optimized) < len(data) else data
@@ -0,0 +1,271 @@
+"""
+Tests.py file for djgoprod app. Run with python manage.py test djgoprod.
+
+The replica routing tests use the replica_1 alias that settings.py adds
+when testing, a mirror of the test database.
+"""
+
+# Import required libraries for the tests
+import re
+import struct
+import tempfile
+import zlib
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import db, server
+from .storage import PNG_SIGNATURE, optimize_png
+
+
+#------- [Variables] -------#
+
+CSRF_INPUT_RE = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+USER_CHANGELIST_URL = '/admin/accounts/customuser/'
+
+
+#------- [Functions] -------#
+
+def png_chunk(kind, body):
+    return struct.pack('>I4s', len(body), kind) + body + struct.pack('>I', zlib.crc32(kind + body))
+
+# A 64 x 64 RGB PNG with its image data uncompressed in two IDAT chunks, a text chunk, and any extra chunks.
+def make_png(*extra_chunks):
+    rows = b''.join(b'\x00' + b''.join(bytes((x * 4, y * 4, (x * y) % 256)) for x in range(64)) for y in range(64)) # Filter byte, then pixels
+    image_data = zlib.compress(rows, 0)
+    return PNG_SIGNATURE + b''.join((
+        png_chunk(b'IHDR', struct.pack('>IIBBBBB', 64, 64, 8, 2, 0, 0, 0)),
+        *extra_chunks,
+        png_chunk(b'tEXt', b'Software\x00Editor'),
+        png_chunk(b'IDAT', image_data[:1000]),
+        png_chunk(b'IDAT', image_data[1000:]),
+        png_chunk(b'IEND', b''),
+    ))
+
+# The decompressed image data of a PNG and the kinds of its chunks.
+def read_png(data):
+    position, kinds, image_data = len(PNG_SIGNATURE), [], b''
+    while position < len(data):
+        length, kind = struct.unpack('>I4s', data[position:position + 8])
+        kinds.append(kind)
+        if kind == b'IDAT':
+            image_data += data[position + 8:position + 8 + length]
+        position += 12 + length
+    return zlib.decompress(image_data), kinds
+
+# Views that answer with the database their reads would use.
+def read_view(request):
+    return HttpResponse(get_user_model().objects.all().db)
+
+def write_view(request):
+    get_user_model().objects.create_user(username='ada')
+    return HttpResponse(get_user_model().objects.all().db)
+
+async def async_read_view(request):
+    return HttpResponse(get_user_model().objects.all().db)
+
+
+#------- [Classes] -------#
+
+# Not a TestCase, whose transaction would keep every read on the primary.
+@override_settings(DATABASE_ROUTERS=['djgoprod.db.ReplicaRouter'])
+class ReplicaRoutingTests(TransactionTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        patcher = mock.patch.object(db, 'replica_lag', db.ReplicaLag()) # No lag results from other tests
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def route(self, view, method='get', path='/', cookies=None):
+        request = getattr(self.factory, method)(path)
+        request.COOKIES.update(cookies or {})
+        middleware = db.ReplicaRoutingMiddleware(view)
+        return async_to_sync(middleware)(request) if middleware.async_mode else middleware(request)
+
+    def test_get_reads_from_a_replica(self):
+        response = self.route(read_view)
+        self.assertEqual(response.content, b'replica_1')
+        self.assertNotIn(db.PRIMARY_COOKIE_NAME, response.cookies)
+
+    def test_unsafe_methods_and_primary_paths_read_from_the_primary(self):
+        self.assertEqual(self.route(read_view, method='post').content, b'default')
+        self.assertEqual(self.route(read_view, path='/allauth/google/login/callback/').content, b'default')
+
+    def test_write_sticks_the_client_to_the_primary(self):
+        response = self.route(write_view)
+        self.assertEqual(response.content, b'default') # Reads after the write
+        cookie = response.cookies[db.PRIMARY_COOKIE_NAME]
+        self.assertEqual(cookie['max-age'], settings.DB_REPLICA_STICKY_SECONDS)
+        self.assertTrue(cookie['httponly'])
+        self.assertEqual(self.route(read_view, cookies={db.PRIMARY_COOKIE_NAME: cookie.value}).content, b'default')
+
+    def test_primary_database_forces_the_primary(self):
+        self.assertEqual(self.route(db.primary_database(read_view)).content, b'default')
+        self.assertEqual(self.route(db.primary_database(async_read_view)).content, b'default')
+        self.assertEqual(self.route(async_read_view).content, b'replica_1')
+
+    def test_lagging_replica_is_skipped_until_checked_again(self):
+        with mock.patch.object(db.ReplicaLag, '_check', return_value=False) as check:
+            self.assertEqual(self.route(read_view).content, b'default')
+            self.assertEqual(self.route(read_view).content, b'default')
+        self.assertEqual(check.call_count, 1) # The result is kept for REPLICA_LAG_CHECK_SECONDS
+        with mock.patch.object(db.time, 'monotonic', return_value=db.time.monotonic() + db.REPLICA_LAG_CHECK_SECONDS):
+            self.assertEqual(self.route(read_view).content, b'replica_1')
+
+    def test_reads_outside_a_request_go_to_the_primary(self):
+        self.assertEqual(get_user_model().objects.all().db, 'default')
+
+
+class OptimizePngTests(SimpleTestCase):
+
+    def test_pixels_are_kept_and_metadata_dropped(self):
+        original = make_png()
+        optimized = optimize_png(original)
+        self.assertLess(len(optimized), len(original))
+        pixels, kinds = read_png(optimized)
+        self.assertEqual(pixels, read_png(original)[0])
+        self.assertEqual(kinds, [b'IHDR', b'IDAT', b'IEND'])
+
+    def test_apng_is_unchanged(self):
+        apng = make_png(png_chunk(b'acTL', struct.pack('>II', 1, 0)))
+        self.assertEqual(optimize_png(apng), apng)
+
+    def test_other_files_are_unchanged(self):
+        for data in (b'GIF89a not a png', PNG_SIGNATURE + b'truncated', b''):
+            self.assertEqual(optimize_png(data), data)
+
+
+class AnonymousPageTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_each_visitor_gets_a_valid_token_in_the_cached_page(self):
+        pages = []
+        for _ in range(2):
+            client = Client(enforce_csrf_checks=True)
+            response = client.get('/accounts/login/')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('private', response['Cache-Control'])
+            pages.append((client, response.content.decode(), CSRF_INPUT_RE.search(response.content.decode()).group(1)))
+        (first, first_html, first_token), (second, second_html, second_token) = pages
+        self.assertNotEqual(first_token, second_token)
+        self.assertEqual(first_html.replace(first_token, ''), second_html.replace(second_token, '')) # Same cached page
+
+        self.assertEqual(first.post('/accounts/logout/', {'csrfmiddlewaretoken': first_token}).status_code, 302)
+        self.assertEqual(second.post('/accounts/logout/', {'csrfmiddlewaretoken': second_token}).status_code, 302)
+        self.assertEqual(second.post('/accounts/logout/', {'csrfmiddlewaretoken': first_token}).status_code, 403) # Another visitor's token
+
+    def test_logged_in_users_bypass_the_cache(self):
+        self.client.force_login(get_user_model().objects.create_user(username='ada'))
+        with mock.patch('djgoprod.views.render_anonymous_page') as render_anonymous_page:
+            self.assertEqual(self.client.get('/').status_code, 200)
+        render_anonymous_page.assert_not_called()
+        self.assertRedirects(self.client.get('/accounts/login/'), '/', fetch_redirect_response=False)
+
+
+class KeysetChangeListTests(TestCase):
+
+    def setUp(self):
+        User = get_user_model()
+        self.client.force_login(User.objects.create_superuser(username='admin', email='admin@example.com', password='password'))
+        for username in ('ada', 'bob', 'cy', 'dee', 'eve'):
+            User.objects.create_user(username=username, email=f'{username}@example.com')
+        patcher = mock.patch.object(admin.site._registry[User], 'list_per_page', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def changelist(self, query=''):
+        response = self.client.get(f'{USER_CHANGELIST_URL}{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl']
+
+    def usernames(self, changelist):
+        return [user.username for user in changelist.result_list]
+
+    def test_cursors_page_forward_and_back(self):
+        first = self.changelist()
+        self.assertEqual(self.usernames(first), ['ada', 'admin'])
+        self.assertEqual((first.keyset['first_url'], first.keyset['previous_url']), (None, None))
+
+        second = self.changelist(first.keyset['next_url'])
+        self.assertEqual(self.usernames(second), ['bob', 'cy'])
+        last = self.changelist(second.keyset['next_url'])
+        self.assertEqual(self.usernames(last), ['dee', 'eve'])
+        self.assertIsNone(last.keyset['next_url'])
+
+        back = self.changelist(last.keyset['previous_url'])
+        self.assertEqual(self.usernames(back), ['bob', 'cy'])
+        self.assertEqual(self.usernames(self.changelist(back.keyset['previous_url'])), ['ada', 'admin'])
+        self.assertEqual(self.usernames(self.changelist(back.keyset['next_url'])), ['dee', 'eve'])
+
+    def test_non_unique_ordering_falls_back_to_page_numbers(self):
+        by_email = self.changelist('?o=1')
+        self.assertIsNone(by_email.keyset)
+        self.assertEqual(len(by_email.result_list), 2)
+        self.assertEqual(self.changelist('?o=1&p=2').result_list[0].email, 'bob@example.com')
+
+    def test_large_tables_show_the_estimated_count(self):
+        with mock.patch('djgoprod.changelist.estimated_count', return_value=2_000_000):
+            response = self.client.get(USER_CHANGELIST_URL)
+        self.assertTrue(response.context['cl'].count_estimated)
+        self.assertEqual(response.context['cl'].result_count, 2_000_000)
+        self.assertContains(response, 'About 2000000')
+
+    def test_small_tables_are_counted_exactly(self):
+        with mock.patch('djgoprod.changelist.estimated_count', return_value=50):
+            changelist = self.changelist()
+        self.assertFalse(changelist.count_estimated)
+        self.assertEqual(changelist.result_count, 6)
+
+
+class ServerSizingTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = Path(directory.name)
+        for patcher in (mock.patch.object(server, 'CGROUP_ROOT', self.root), mock.patch.object(server.os, 'sched_getaffinity', return_value=set(range(8)))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_cgroup(self, files):
+        for name, value in files.items():
+            path = self.root / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(f'{value}\n')
+
+    def test_v2_without_a_cpu_quota_uses_every_cpu(self):
+        self.write_cgroup({'cpu.max': 'max 100000', 'memory.max': 'max'})
+        self.assertEqual((server.cpu_limit(), server.memory_limit()), (8, None))
+        self.assertEqual(server.size_workers('uvicorn', 8, None, 128), (8, 1))
+
+    def test_v2_fractional_quota(self):
+        self.write_cgroup({'cpu.max': '150000 100000'})
+        self.assertEqual(server.cpu_limit(), 1.5)
+        self.assertEqual(server.size_workers('uvicorn', 1.5, None, 128), (2, 1))
+        self.assertEqual(server.size_workers('gthread', 1.5, None, 128), (2, 2)) # 2 x 1.5 + 1 requests at once
+
+    def test_memory_cap_limits_the_workers(self):
+        self.write_cgroup({'memory.max': 512 * 2 ** 20})
+        self.assertEqual(server.memory_limit(), 512 * 2 ** 20)
+        self.assertEqual(server.size_workers('uvicorn', 8, 512 * 2 ** 20, 128), (3, 1)) # 128 MiB kept for the master
+        self.assertEqual(server.size_workers('gthread', 8, 512 * 2 ** 20, 128), (3, 6))
+        self.assertEqual(server.size_workers('uvicorn', 8, 64 * 2 ** 20, 128), (1, 1))
+
+    def test_v1_fallback(self):
+        self.write_cgroup({'cpu/cpu.cfs_quota_us': 200000, 'cpu/cpu.cfs_period_us': 100000, 'memory/memory.limit_in_bytes': 2 ** 30})
+        self.assertEqual((server.cpu_limit(), server.memory_limit()), (2, 2 ** 30))
+
+    def test_v1_without_limits(self):
+        self.write_cgroup({'cpu/cpu.cfs_quota_us': -1, 'cpu/cpu.cfs_period_us': 100000, 'memory/memory.limit_in_bytes': 9223372036854771712})
+        self.assertEqual((server.cpu_limit(), server.memory_limit()), (8, None))
@@ -6,10 +6,11 @@ Date: 2024-06-01
 """
 
 # Import Django Modules
+from django.conf import settings
 from django.conf.urls import include
 from django.contrib import admin
 from django.urls import path
-from .views import welcome_view
+from .views import metrics_view, welcome_view
 
 # Url Patterns
 urlpatterns = [
@@ -19,3 +20,7 @@ urlpatterns = [
     path('allauth/', include('allauth.urls')), # Include allauth urls
     # path('allauth/', include('allauth.socialaccount.providers.google.urls')), # You can use this instead of include('allauth.urls') to only enable Google OAuth allauth endpoints.
 ]
+
+# Prometheus metrics endpoint. Not served in production without METRICS_TOKEN.
+if settings.METRICS_SERVED:
+    urlpatterns.append(path('metrics', metrics_view, name='metrics'))
@@ -1,5 +1,22 @@
 # views.py
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
 
+from .metrics import registry
+from .pages import render_anonymous_page
+
+# Welcome page. Anonymous visitors get the cached page.
 def welcome_view(request):
-    return render(request, 'welcome.html')
+    if request.user.is_authenticated:
+        return render(request, 'welcome.html')
+    return render_anonymous_page(request, 'welcome.html')
+
+# Serve the metrics of every worker, added up, in the Prometheus text format.
+def metrics_view(request):
+    if settings.METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if not constant_time_compare(authorization, f'Bearer {settings.METRICS_TOKEN}'):
+            return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,91 @@
+"""
+warmup.py file for djgoprod app. Warm-up run by the Gunicorn hooks in
+gunicorn.conf.py, so a worker's first requests are not slower than the rest.
+
+warm_process() runs once in the master after the app is preloaded, before
+the workers are forked. It builds the state that is the same in every
+worker (URL resolver, compiled templates, static files manifest, modules
+imported on first use), so the workers share it copy-on-write instead of
+each building its own. It opens no connections, since a socket inherited
+by several workers would be shared between them.
+
+warm_worker() runs in each worker after it is forked and before it accepts
+requests. It connects to each database and the cache, loads the Google
+signing keys, and renders the cached anonymous pages. Under ASGI Django
+keeps database connections per request, so the worker's connections are
+closed again. If a database or the cache is down, the error is logged and
+the worker starts anyway, as it would have without the warm-up.
+"""
+
+# Import required libraries for warming up the workers
+import importlib
+import logging
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import connections
+from django.http import HttpRequest
+from django.urls import get_resolver
+
+from . import pages
+
+logger = logging.getLogger(__name__)
+
+
+#------- [Variables] -------#
+
+# Modules imported on first use to keep cold starts fast. With a preloaded app, importing
+# them in the master costs each worker nothing.
+DEFERRED_IMPORTS = ('aiohttp',)
+
+
+#------- [Functions] -------#
+
+# Build the state every worker shares. Runs in the master, before forking.
+def warm_process():
+    start = time.perf_counter()
+    for module in DEFERRED_IMPORTS:
+        importlib.import_module(module)
+    get_resolver().reverse_dict # Populates the resolver's lookup tables
+    pages.warm_templates()
+    pages.static_files_version() # Loads the manifest and hashes it for the page cache keys
+    close_connections()
+    return time.perf_counter() - start
+
+# Open the worker's connections and fill its caches. Runs in each worker, before it accepts requests.
+def warm_worker():
+    start = time.perf_counter()
+    for alias in connections:
+        try:
+            connections[alias].ensure_connection()
+        except Exception:
+            logger.exception('Warm-up could not connect to the %s database.', alias)
+    try:
+        caches['default'].get('djgoprod:warmup')
+    except Exception:
+        logger.exception('Warm-up could not reach the cache.')
+
+    from accounts import google_keys
+    for document in (google_keys.discovery, google_keys.jwks):
+        try:
+            document.get()
+        except google_keys.KeyFetchError:
+            logger.warning('Warm-up could not load the Google %s document.', document.name)
+
+    for template_name in pages.WARM_TEMPLATES:
+        pages.render_anonymous_page(anonymous_request(), template_name)
+    close_connections()
+    return time.perf_counter() - start
+
+# A bare anonymous GET request, for rendering pages outside a request.
+def anonymous_request():
+    request = HttpRequest()
+    request.method = 'GET'
+    request.user = AnonymousUser()
+    return request
+
+def close_connections():
+    connections.close_all()
+    for cache in caches.all(initialized_only=True):
+        cache.close()
@@ -1,3 +1,7 @@
 #!/bin/sh
 
-gunicorn --bind 0.0.0.0:8000 --workers 4 -k uvicorn.workers.UvicornWorker djgoprod.wsgi:application
\ No newline at end of file
+# Validate settings once, so the workers do not each print the transcript (SETTINGS_TRANSCRIPT=once)
+python manage.py check_settings
+
+# Workers sized to the container's limits, preloaded and warmed up (gunicorn.conf.py)
+gunicorn -c gunicorn.conf.py
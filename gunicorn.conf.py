@@ -0,0 +1,117 @@
+"""
+gunicorn.conf.py file for djgoprod. Gunicorn configuration, loaded by
+entrypoint.sh with gunicorn -c gunicorn.conf.py.
+
+Sizes the server to the container's CPU and memory limits (djgoprod/server.py),
+preloads the app in the master so the workers share its memory copy-on-write,
+recycles workers after a jittered number of requests, and warms each worker
+up before it accepts requests (djgoprod/warmup.py). The workers' request
+metrics are added up through files cleared when the server starts
+(djgoprod/metrics_store.py).
+
+Requirements (environment variables, all optional):
+    - GUNICORN_WORKER_CLASS: uvicorn (default, ASGI with WebSockets) or gthread
+      (threaded WSGI workers, no WebSockets).
+    - WEB_CONCURRENCY: Number of workers. Defaults to one per CPU, within the
+      memory limit.
+    - GUNICORN_THREADS: Threads per gthread worker. Defaults to enough for
+      2 x CPUs + 1 requests at once across the workers.
+    - GUNICORN_WORKER_MEMORY_MB: Memory budgeted per worker when fitting the
+      workers in the memory limit. Default 128.
+    - GUNICORN_MAX_REQUESTS: Requests after which a worker is replaced, 0 to
+      never replace it. Default 10000. Each worker's limit is raised by a random
+      amount up to GUNICORN_MAX_REQUESTS_JITTER (default a tenth of it), so the
+      workers are not all replaced at once.
+    - GUNICORN_PRELOAD: true or false. Load the app in the master before
+      forking. Default true.
+    - GUNICORN_WARMUP: true or false. Warm each worker up before it accepts
+      requests. Default true.
+"""
+
+# Import required libraries for the server configuration
+import os
+import sys
+
+from djgoprod import metrics_store
+from djgoprod.global_utils import yellow_warning
+from djgoprod.server import cpu_limit, memory_limit, size_workers
+
+
+#------- [Functions] -------#
+
+# Read a whole number setting, warning and using the default if it is invalid.
+def integer_setting(name, default):
+    value = os.environ.get(name, str(default))
+    if not value.isdigit():
+        print(yellow_warning(f'[Warning] {name} environment variable is invalid ("{value}"). It must be a whole number. Defaulting to {default}.'), file=sys.stderr)
+        return default
+    return int(value)
+
+# Read a true or false setting, warning and using the default if it is invalid.
+def boolean_setting(name, default):
+    value = os.environ.get(name, str(default).lower()).lower()
+    if value not in ('true', 'false'):
+        print(yellow_warning(f'[Warning] {name} environment variable is invalid ("{value}"). Options are true or false. Defaulting to {str(default).lower()}.'), file=sys.stderr)
+        return default
+    return value == 'true'
+
+
+#------- [Settings] -------#
+
+GUNICORN_WORKER_CLASS = os.environ.get('GUNICORN_WORKER_CLASS', 'uvicorn')
+if GUNICORN_WORKER_CLASS not in ('uvicorn', 'gthread'):
+    print(yellow_warning(f'[Warning] GUNICORN_WORKER_CLASS environment variable is invalid ("{GUNICORN_WORKER_CLASS}"). Options are uvicorn or gthread. Defaulting to uvicorn.'), file=sys.stderr)
+    GUNICORN_WORKER_CLASS = 'uvicorn'
+
+cpus = cpu_limit()
+memory_bytes = memory_limit()
+sized_workers, sized_threads = size_workers(GUNICORN_WORKER_CLASS, cpus, memory_bytes, integer_setting('GUNICORN_WORKER_MEMORY_MB', 128) or 128)
+
+bind = '0.0.0.0:8000'
+if GUNICORN_WORKER_CLASS == 'uvicorn':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    wsgi_app = 'djgoprod.asgi:application'
+else:
+    worker_class = 'gthread'
+    wsgi_app = 'djgoprod.wsgi:application'
+workers = integer_setting('WEB_CONCURRENCY', sized_workers) or sized_workers
+threads = integer_setting('GUNICORN_THREADS', sized_threads) or sized_threads
+
+max_requests = integer_setting('GUNICORN_MAX_REQUESTS', 10000)
+max_requests_jitter = integer_setting('GUNICORN_MAX_REQUESTS_JITTER', max_requests // 10)
+
+preload_app = boolean_setting('GUNICORN_PRELOAD', True)
+GUNICORN_WARMUP = boolean_setting('GUNICORN_WARMUP', True)
+
+
+#------- [Hooks] -------#
+
+# Runs in the master before the server starts. Metrics from an earlier run are not this server's.
+def on_starting(server):
+    metrics_store.clear()
+
+# Runs in the master once the server is listening, before the workers are forked.
+def when_ready(server):
+    memory = f'{memory_bytes // 2 ** 20} MiB' if memory_bytes is not None else 'no'
+    server.log.info(
+        f'{workers} {GUNICORN_WORKER_CLASS} workers{f" x {threads} threads" if worker_class == "gthread" else ""} for {cpus:g} CPUs and {memory} memory limit. '
+        f'Preload {"on" if preload_app else "off"}, warm-up {"on" if GUNICORN_WARMUP else "off"}, '
+        f'max requests {max_requests or "off"} + up to {max_requests_jitter if max_requests else 0}.'
+    )
+    if preload_app and GUNICORN_WARMUP:
+        from djgoprod.warmup import warm_process
+        server.log.info(f'Warmed up the preloaded app in {warm_process() * 1000:.0f} ms.')
+
+# Runs in each worker after it loads the app, before it accepts requests.
+def post_worker_init(worker):
+    if not GUNICORN_WARMUP:
+        return
+    from djgoprod.warmup import warm_process, warm_worker
+    seconds = 0 if preload_app else warm_process() # Without preload, each worker builds its own
+    worker.log.info(f'Worker {worker.pid} warmed up in {(seconds + warm_worker()) * 1000:.0f} ms.')
+
+# Runs in each worker as it exits, so the figures since its last write are kept.
+def worker_exit(server, worker):
+    metrics = sys.modules.get('djgoprod.metrics')
+    if metrics is not None:
+        metrics.registry.flush()